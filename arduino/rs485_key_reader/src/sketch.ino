@@ -24,6 +24,7 @@
 #include <EEPROM.h>     // We are going to read and write PICC's UIDs from/to EEPROM
 #include <SPI.h>        // RC522 Module uses SPI protocol
 #include <MFRC522.h>  // Library for Mifare RC522 Devices
+#include <util/crc16.h> // CRC of binary frames
 
 /*
   Instead of a Relay you may want to use a servo. Servos can lock and unlock door locks too
@@ -64,6 +65,23 @@
 
 #define DE_RE_PIN 9
 
+// Binary frames, see okm/backend/codec.py
+// SOF | address | opcode | length | payload | CRC16 (CCITT, init 0xFFFF, big endian)
+// Text orders keep working, we answer in the format we were asked in
+#define FRAME_SOF 0xA5
+#define FRAME_HEADER 4
+#define FRAME_MAX_PAYLOAD 16
+
+#define OP_ASK_FOR_NEW 0x01
+#define OP_LOCK 0x02
+#define OP_UNLOCK 0x03
+#define OP_DENIED 0x04
+#define OP_NEW_READ 0x10
+#define OP_CONFIRM 0x11
+#define OP_UNKNOWN_ORDER 0x12
+
+byte frame[FRAME_HEADER + FRAME_MAX_PAYLOAD + 2];
+
 String in_msg;
 String rsp_msg;
 String msg;
@@ -136,7 +154,9 @@ void loop () {
   // Read potential new badge
   getID();
 
-  if (Serial.available() > 0) {
+  if (Serial.available() > 0 && Serial.peek() == FRAME_SOF) {
+    read_frame();
+  } else if (Serial.available() > 0) {
     // read until ; or timeout after 1 sec
     in_msg = Serial.readStringUntil(';');
     // discard eventual extra bytes after ;
@@ -166,6 +186,9 @@ void loop () {
       } else if (msg == "denied") {
         send_message("confirm:denied");
         denied();
+      } else if (msg == "proto_binary") {
+        // Tell okm we understand binary frames
+        send_message("confirm:proto_binary");
       } else { // If the message is not known, simply echo with id
         rsp_msg = String(KEYREADER_ID) + ":unknown_order";
         send_message(rsp_msg);
@@ -191,7 +214,8 @@ void loop () {
 
 void splitArray(String data, String splittedMsg[2], char separator)
 {
-  int sepAt;
+  // -1 : no separator, eg. bytes of a binary frame read as text
+  int sepAt = -1;
   int maxIndex = data.length(); 
 
   for (int i=0; i < maxIndex; i++){
@@ -199,6 +223,11 @@ void splitArray(String data, String splittedMsg[2], char separator)
       sepAt = i;
     }
   }                                
+  if (sepAt < 0) {
+    splittedMsg[0] = "";
+    splittedMsg[1] = "";
+    return;
+  }
   splittedMsg[0] = data.substring(0, sepAt);
   splittedMsg[1] = data.substring(sepAt+1, maxIndex);
 }
@@ -221,6 +250,87 @@ void send_message(String msg){
     set_receive_mode();
 }
 
+/////////////////////////////////////////  Binary frames //////////////////////////////
+uint16_t crc16(const byte *data, uint8_t length){
+  uint16_t crc = 0xFFFF;
+  for (uint8_t i = 0; i < length; i++) {
+    crc = _crc_xmodem_update(crc, data[i]);
+  }
+  return crc;
+}
+
+void read_frame(){
+  // Header : SOF, address, opcode, length
+  if (Serial.readBytes(frame, FRAME_HEADER) < FRAME_HEADER) {
+    return;
+  }
+  uint8_t length = frame[3];
+  if (length > FRAME_MAX_PAYLOAD) {
+    return;
+  }
+  if (Serial.readBytes(frame + FRAME_HEADER, length + 2) < length + 2) {
+    return;
+  }
+  uint16_t crc = (frame[FRAME_HEADER + length] << 8) | frame[FRAME_HEADER + length + 1];
+  // Garbled frames are ignored, okm sends the order again
+  if (crc != crc16(frame + 1, FRAME_HEADER - 1 + length) || frame[1] != KEYREADER_ID) {
+    return;
+  }
+
+  byte confirmed = frame[2];
+  switch (frame[2]) {
+    case OP_ASK_FOR_NEW:
+      if (new_read) {
+        send_frame(OP_NEW_READ, readCard, 4);
+        new_read = false;
+      } else {
+        send_frame(OP_NEW_READ, NULL, 0);
+      }
+      break;
+    case OP_LOCK:
+      send_frame(OP_CONFIRM, &confirmed, 1);
+      lock();
+      break;
+    case OP_UNLOCK:
+      send_frame(OP_CONFIRM, &confirmed, 1);
+      unlock();
+      break;
+    case OP_DENIED:
+      send_frame(OP_CONFIRM, &confirmed, 1);
+      denied();
+      break;
+    default:
+      send_frame(OP_UNKNOWN_ORDER, NULL, 0);
+      unknown();
+  }
+}
+
+void send_frame(byte opcode, const byte *payload, uint8_t length){
+  frame[0] = FRAME_SOF;
+  frame[1] = KEYREADER_ID;
+  frame[2] = opcode;
+  frame[3] = length;
+  for (uint8_t i = 0; i < length; i++) {
+    frame[FRAME_HEADER + i] = payload[i];
+  }
+  uint16_t crc = crc16(frame + 1, FRAME_HEADER - 1 + length);
+  frame[FRAME_HEADER + length] = crc >> 8;
+  frame[FRAME_HEADER + length + 1] = crc & 0xFF;
+
+  // Same timings as send_message()
+  delay(20);
+  set_send_mode();
+
+  Serial.write(frame, FRAME_HEADER + length + 2);
+
+  while (Serial.availableForWrite() < SERIAL_TX_BUFFER_SIZE - 1){
+    delay(1);
+  }
+  delay(20);
+
+  set_receive_mode();
+}
+
 void set_send_mode(){
   digitalWrite(DE_RE_PIN, HIGH);
 }
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import logging
+import threading
+
+from okm.backend.usb_transport import SerialConnection
+from okm.utils import Singleton
+
+"""
+Asyncio engine of the crawler (glob.CRAWLER_ENGINE = 'asyncio')
+
+EventLoop runs an asyncio loop in a single thread. The crawler runs a
+coroutine per arduino there (see ArduinoCrawler.async_loop), and USB serial
+ports are watched with loop.add_reader by AsyncioTransport, instead of the
+threads of the default engine
+
+Other threads talk to the loop with EventLoop().call() and run(). The way
+back to the GUI is call_in_gui() : the wx main loop is not thread safe
+"""
+
+
+class EventLoop(metaclass=Singleton):
+    """ The asyncio loop of okm, running in its own thread """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        # Daemon : like USBTransport, nothing to clean up at exit
+        self._thread = threading.Thread(name="EventLoop", target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def call(self, func, *args):
+        """ Call func(*args) in the loop, from any thread """
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def run(self, coro):
+        """
+        Run coro in the loop, from any thread
+
+        :return: concurrent.futures.Future of its result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class AsyncioTransport(metaclass=Singleton):
+    """ USBTransport API, serial ports being watched by the loop of EventLoop """
+
+    def __init__(self):
+        self.loop = EventLoop().loop
+
+    def register(self, ser, on_message):
+        """
+        Start reading ser
+
+        :ser: open serial.Serial
+        :on_message: callable(str) called from the loop for each message
+        :return: SerialConnection to pass to write() and unregister()
+        """
+        conn = SerialConnection(ser, on_message)
+        self.loop.call_soon_threadsafe(
+            self.loop.add_reader, conn.fd, self._on_readable, conn
+        )
+        return conn
+
+    def unregister(self, conn):
+        self.loop.call_soon_threadsafe(self.loop.remove_reader, conn.fd)
+
+    def write(self, conn, data):
+        """ Write data (bytes) now, from the calling thread """
+        conn.write(data)
+
+    def stop(self):
+        pass
+
+    def _on_readable(self, conn):
+        try:
+            count = conn.read()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            count = 0
+            logging.error(f"AsyncioTransport : error reading {conn.ser} : {e}")
+        except Exception:
+            logging.exception(f"AsyncioTransport : can't handle {conn.ser}")
+            return
+
+        if not count:
+            # Device unplugged
+            logging.error(f"AsyncioTransport : {conn.ser} closed")
+            self.loop.remove_reader(conn.fd)
+
+
+def call_in_gui(func, *args):
+    """
+    Call func(*args) in the wx main loop, from any thread. Right away if
+    there is no GUI (wx missing or no app running, eg. benchmarks)
+    """
+    try:
+        import wx
+    except ImportError:
+        wx = None
+
+    if wx is None or wx.GetApp() is None:
+        func(*args)
+    else:
+        wx.CallAfter(func, *args)
@@ -26,171 +26,478 @@ import logging
 import sys
 import datetime
 import sqlite3
+import concurrent.futures
+import asyncio
+import functools
+import math
 
 try:
-    from okm.glob import DB_PATH, LOCK
+    from okm.glob import DB_PATH
     import okm.glob as glob
     from okm.backend.arduinos import get_arduinos
-    from okm.utils import DbCursor
+    from okm.backend import eventbus, metrics, tracing
+    from okm.backend.aio import EventLoop
+    from okm.backend.perms import PermCache
+    from okm.backend.stamps import StampWriter
+    from okm.utils import Singleton
 except ImportError as e:
     logging.fatal("okm not importable here. Might be a problem")
     raise (e)
 
 
-class Singleton(type):
-    _instances = {}
-
-    def __call__(cls, *args, **kwargs):
-        if cls not in cls._instances:
-            new_instance = super(Singleton, cls).__call__(*args, **kwargs)
-            new_instance._instances = cls._instances
-            cls._instances[cls] = new_instance
-        return cls._instances[cls]
+BADGES = metrics.Counter("okm_badges_total", "Badges read", ["outcome"])
+BADGE_SECONDS = metrics.Histogram(
+    "okm_badge_seconds", "From a badge read to its stamp, or its last order"
+)
+PIPELINE_ERRORS = metrics.Counter(
+    "okm_crawler_errors_total", "Crawler pipelines that raised"
+)
 
 
 class ArduinoCrawler(metaclass=Singleton):
 
     """Un thread qui poll les arduino pour savoir si on badge"""
 
-    def __init__(self):
+    def __init__(self, arduinos=None):
         """
         Initialisation du crawler
         C'est un singleton qui cause aux arduinos et gère les lock/unlocks
+
+        :arduinos: (list) devices to crawl. Default to get_arduinos()
         """
 
         self.loop_flag = threading.Event()
+        # Wakes concurrent_loop() up, see there
+        self._wake = threading.Event()
 
         # [arduinoInstance, ... ]
-        self.arduinos = get_arduinos()
-
-        #########################################################
-        # The following properties are API. Use with okm.glob.LOCK
-        # Both from inside and outside
-        #########################################################
+        if arduinos is None:
+            arduinos = get_arduinos()
+        self.arduinos = arduinos
 
         # {'arduino_id': 'unlock_key', ... }
         # with 'unlock_key' == 'key_id' | None if locked
+        # Each pipeline only writes the item of its arduino. Read with states()
         self.arduinos_states = {a.id: None for a in self.arduinos}
 
-        # {'unknown_key', 'key_id',
-        #
-        # }
-        self.mainwindow_notify = {}
-
-        t = threading.Thread(name="ArduinoCrawler", target=self.loop)
+        # Devices sharing a physical bus without arbitration of their own must
+        # not run transactions concurrently (RS485 has its BusArbiter)
+        # {bus: threading.Lock, ... }
+        self._bus_locks = {}
+        for a in self.arduinos:
+            self._bus_locks.setdefault(self._bus_of(a), threading.Lock())
+
+        metrics.Gauge(
+            "okm_unlocked_arduinos",
+            "Arduinos unlocked by a key",
+            func=lambda: sum(1 for key in self.states().values() if key),
+        )
+
+        if glob.CRAWLER_ENGINE == "asyncio":
+            # No thread of our own, coroutines run in the loop of EventLoop
+            self._async_task = None
+            self._async_crawl = EventLoop().run(self.async_loop())
+            return
+
+        if glob.CRAWLER_CONCURRENCY > 1:
+            target = self.concurrent_loop
+        else:
+            target = self.loop
+        t = threading.Thread(name="ArduinoCrawler", target=target)
         t.start()
 
+    def states(self):
+        """
+        :return: {'arduino_id': 'unlock_key' | None, ... } copy of current states
+        """
+        # Keys never change, so copying is atomic
+        return dict(self.arduinos_states)
+
+    @staticmethod
+    def publish(kind, a_id, key_id, timestamp=None):
+        """ Tell subscribers of okm.backend.eventbus what happened """
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        eventbus.bus.publish(eventbus.Event(kind, a_id, key_id, timestamp))
+
+    @staticmethod
+    def _bus_of(arduino):
+        """ Devices without a shared bus are their own bus """
+        return getattr(arduino, "bus", arduino)
+
     def loop(self):
+        """ Sequential crawl : one arduino after the other """
 
         print("Start crawler loop")
 
         while not self.loop_flag.is_set():
-            ############################################$
-            # En gros, dans ce loop sur les arduinos :
-            # - On essaie de recevoir un message. Si None : on passe
-            # - Si on a new_read:XXXX , XXXX est l'id de la clé, et on compare en DB
-            # - En envoie à l'arduine l'ordre pertinent :
-            #   order:lock | order:unlock | order:denied
-            # - Après envoi d'ordre, la fonction est bloquante jusqu'à reçevoir une réponse
-            # - Si la réponse est correcte, on effectue les incriptions en DB
-            ############################################$
             for a in self.arduinos:
+                self.process(a)
+
+            # FIXME : quasi sûr que ce sera contre productif quand on aura plusieurs arduinos
+            time.sleep(glob.CRAWLER_POLL_INTERVAL)
+
+    def concurrent_loop(self):
+        """
+        Concurrent crawl : each arduino has its own pipeline
+
+        At most one transaction per arduino is in flight, and at most
+        glob.CRAWLER_CONCURRENCY transactions overall. An arduino waiting for a
+        confirmation only holds its own worker, others keep being served.
+
+        Devices with set_listener() are only processed when they have a
+        message, others are polled every CRAWLER_POLL_INTERVAL. In between,
+        the loop sleeps on self._wake
+        """
 
-                msg_in = a.recv_message()
+        print("Start concurrent crawler loop")
 
-                if msg_in is None:
-                    continue
+        # {'arduino_id': monotonic time of next process, ... }
+        next_run = {a.id: 0 for a in self.arduinos}
+        # {'arduino_id': Future, ... }
+        in_flight = {}
+        # {'arduino_id', ... } with a message waiting, added by listeners
+        signalled = set()
+        # {'arduino_id', ... } without listener, polled when idle
+        polled = set()
 
-                msg_in = msg_in.split(":")
-                if len(msg_in) == 2:
-                    if msg_in[0] == "new_read":
-                        request_key = msg_in[1]
+        def listener(a_id):
+            signalled.add(a_id)
+            self._wake.set()
+
+        for a in self.arduinos:
+            try:
+                a.set_listener(functools.partial(listener, a.id))
+            except AttributeError:
+                polled.add(a.id)
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=glob.CRAWLER_CONCURRENCY, thread_name_prefix="ArduinoCrawler"
+        ) as pool:
+            while not self.loop_flag.is_set():
+                # Cleared before looking, whatever happens meanwhile sets it
+                self._wake.clear()
+
+                for a_id, future in list(in_flight.items()):
+                    if not future.done():
+                        continue
+                    del in_flight[a_id]
+                    try:
+                        busy = future.result()
+                    except Exception:
+                        logging.exception(f"Crawler pipeline of arduino {a_id} failed")
+                        PIPELINE_ERRORS.inc()
+                        busy = False
+                    # An arduino that just talked is asked again right away
+                    if busy:
+                        next_run[a_id] = 0
+                    elif a_id in polled:
+                        next_run[a_id] = time.monotonic() + glob.CRAWLER_POLL_INTERVAL
                     else:
+                        next_run[a_id] = math.inf
+
+                now = time.monotonic()
+                for a in self.arduinos:
+                    if a.id in in_flight:
                         continue
-                else:
-                    continue
+                    if a.id in signalled:
+                        signalled.discard(a.id)
+                        next_run[a.id] = 0
+                    if next_run[a.id] <= now:
+                        future = pool.submit(self.process, a)
+                        future.add_done_callback(lambda _: self._wake.set())
+                        in_flight[a.id] = future
+
+                # Wake up as soon as a pipeline is done, a message comes in or
+                # a polled arduino is due. Never otherwise
+                idle = [next_run[a_id] for a_id in next_run if a_id not in in_flight]
+                timeout = None
+                if idle and min(idle) != math.inf:
+                    timeout = max(0, min(idle) - now)
+                self._wake.wait(timeout)
+
+    async def async_loop(self):
+        """
+        Asyncio crawl : a coroutine per arduino, all in one thread
+
+        Devices with set_listener() wake their coroutine up when a message
+        comes in, others are polled every CRAWLER_POLL_INTERVAL
+        """
 
-                with DbCursor() as c:
-                    c.execute("SELECT * FROM perms WHERE key_id=?", (request_key,))
-                    # key_id is UNIQUE, so fetchone() makes sense
-                    r = c.fetchone()
+        print("Start asyncio crawler loop")
 
+        self._async_task = asyncio.current_task()
+        bus_locks = {bus: asyncio.Lock() for bus in self._bus_locks}
+        await asyncio.gather(
+            *(self._pipeline(a, bus_locks[self._bus_of(a)]) for a in self.arduinos)
+        )
+
+    async def _pipeline(self, a, bus_lock):
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+        try:
+            a.set_listener(lambda: loop.call_soon_threadsafe(wake.set))
+            timeout = None
+        except AttributeError:
+            timeout = glob.CRAWLER_POLL_INTERVAL
+
+        while not self.loop_flag.is_set():
+            # Cleared before reading, a message coming in meanwhile sets it
+            wake.clear()
+            async with bus_lock:
                 try:
-                    r[str(a.id)]
-                except TypeError:
-                    logging.warning(
-                        "Seems like an unknown key is used."
-                        " Notify windows and reject"
-                    )
-                    with LOCK:
-                        self.mainwindow_notify["unknown_key"] = request_key
-                    a.send_message("order:denied")
-                    continue
-
-                if r[str(a.id)] == 1:
-                    print("Cet utilisateur a le droit d'ouvrir cet arduino. Départ")
-                    timestamp = datetime.datetime.now()
-
-                    if self.arduinos_states[a.id] == None:
-
-                        print("On essaie de déverouiller")
-                        a.send_message("order:unlock")
-                        lock_state = "unlocked;"
-
-                        if is_answer(a, "confirm:unlock"):
-                            with DbCursor() as c:
-                                c.execute(
-                                    "INSERT INTO stamps VALUES (?, ?, ?, ?)",
-                                    (request_key, a.id, timestamp, lock_state),
-                                )
-                            with LOCK:
-                                self.arduinos_states[a.id] = request_key
-                            print("Le déverrouillage est un succès")
-                        else:
-                            print("Déverouillage pas marche")
-                            # Prevent unwanted unlock
-                            a.send_message("order:lock")
-
-                    elif self.arduinos_states[a.id] == request_key:
-
-                        print("Même user, on essaye de reverouiller")
-                        a.send_message("order:lock")
-                        lock_state = "locked"
-
-                        if is_answer(a, "confirm:lock"):
-                            with DbCursor() as c:
-                                c.execute(
-                                    "INSERT INTO stamps VALUES (?, ?, ?, ?)",
-                                    (request_key, a.id, timestamp, lock_state),
-                                )
-                            with LOCK:
-                                self.arduinos_states[a.id] = None
-                            print("Reverouillage effectué")
-                        else:
-                            print("Reverouillage pas marche")
-                            # Prevent unwanted lock
-                            a.send_message("order:unlock")
+                    busy = await self._async_process(a)
+                except Exception:
+                    logging.exception(f"Crawler pipeline of arduino {a.id} failed")
+                    PIPELINE_ERRORS.inc()
+                    busy = False
+            if busy:
+                continue
+            try:
+                await asyncio.wait_for(wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def process(self, a):
+        """
+        Handle one message of given arduino, and the transaction it triggers
 
-                    else:
-                        print("Déjà utilisé par quelqu'un d'autre ...")
-                        a.send_message("order:denied")
+        :a: arduino instance
+        :return: (bool) True if a message was received
+        """
+        with self._bus_locks[self._bus_of(a)]:
+            return self._process(a)
+
+    def _process(self, a):
+        msg_in = a.recv_message()
+
+        if msg_in is None:
+            return False
+
+        transaction = self._transaction(a, msg_in)
+        result = None
+        while True:
+            try:
+                order, answer = transaction.send(result)
+            except StopIteration:
+                return True
+            if answer is None:
+                a.send_message(order)
+                result = None
+            else:
+                result = send_order(a, order, answer)
+
+    async def _async_process(self, a):
+        """ Same as _process, confirmations are awaited """
+        msg_in = a.recv_message()
+
+        if msg_in is None:
+            return False
+
+        transaction = self._transaction(a, msg_in)
+        result = None
+        while True:
+            try:
+                order, answer = transaction.send(result)
+            except StopIteration:
+                return True
+            if answer is None:
+                a.send_message(order)
+                result = None
+            else:
+                result = await async_send_order(a, order, answer)
+
+    def _transaction(self, a, msg_in):
+        """
+        What to do with a message of arduino a, without doing any I/O
 
+        A generator yielding the orders to send, as (order, answer). If answer
+        is None the order is only sent, else the caller sends back whether
+        answer came in time. So both engines drive the same logic
+        """
+        ############################################$
+        # En gros, pour un arduino :
+        # - On essaie de recevoir un message. Si None : on passe
+        # - Si on a new_read:XXXX , XXXX est l'id de la clé, et on compare en DB
+        # - En envoie à l'arduine l'ordre pertinent :
+        #   order:lock | order:unlock | order:denied
+        # - Après envoi d'ordre, la fonction est bloquante jusqu'à reçevoir une réponse
+        # - Si la réponse est correcte, on effectue les incriptions en DB
+        ############################################$
+        msg_in = msg_in.split(":")
+        if len(msg_in) == 2:
+            if msg_in[0] == "new_read":
+                request_key = msg_in[1]
+            else:
+                return
+        else:
+            return
+
+        trace = tracing.Trace(a.id, request_key, getattr(a, "received_at", None))
+        try:
+            yield from self._badge(a, request_key, trace)
+        finally:
+            tracing.Tracer().finish(trace)
+            BADGES.inc(trace.outcome or "none")
+            BADGE_SECONDS.observe(trace.total)
+
+    def _badge(self, a, request_key, trace):
+        """ _transaction for a badge read, marking trace along the way """
+        # {'arduino_id', ... } allowed for this key, None if key is unknown
+        allowed = PermCache().allowed_arduinos(request_key)
+        trace.mark("permission")
+
+        if allowed is None:
+            logging.warning(
+                "Seems like an unknown key is used. Notify windows and reject"
+            )
+            trace.outcome = eventbus.UNKNOWN_KEY
+            trace.mark("order_sent")
+            yield "order:denied", None
+            self.publish(eventbus.UNKNOWN_KEY, a.id, request_key)
+            return
+
+        if a.id in allowed:
+            print("Cet utilisateur a le droit d'ouvrir cet arduino. Départ")
+            timestamp = datetime.datetime.now()
+
+            if self.arduinos_states[a.id] == None:
+
+                print("On essaie de déverouiller")
+                trace.mark("order_sent")
+                if (yield "order:unlock", "confirm:unlock"):
+                    trace.mark("confirmed")
+                    self.record_unlock(request_key, a.id, timestamp)
+                    trace.mark("stamped")
+                    trace.outcome = eventbus.UNLOCKED
+                    self.arduinos_states[a.id] = request_key
+                    self.publish(eventbus.UNLOCKED, a.id, request_key, timestamp)
+                    print("Le déverrouillage est un succès")
                 else:
-                    print("Verboooten !")
-                    a.send_message("order:denied")
-
-            # FIXME : quasi sûr que ce sera contre productif quand on aura plusieurs arduinos
-            time.sleep(0.2)
+                    print("Déverouillage pas marche")
+                    trace.mark("no_confirm")
+                    trace.outcome = "failed"
+                    # Prevent unwanted unlock
+                    trace.mark("order_sent")
+                    yield "order:lock", None
+
+            elif self.arduinos_states[a.id] == request_key:
+
+                print("Même user, on essaye de reverouiller")
+                trace.mark("order_sent")
+                if (yield "order:lock", "confirm:lock"):
+                    trace.mark("confirmed")
+                    self.record_lock(request_key, a.id, timestamp)
+                    trace.mark("stamped")
+                    trace.outcome = eventbus.LOCKED
+                    self.arduinos_states[a.id] = None
+                    self.publish(eventbus.LOCKED, a.id, request_key, timestamp)
+                    print("Reverouillage effectué")
+                else:
+                    print("Reverouillage pas marche")
+                    trace.mark("no_confirm")
+                    trace.outcome = "failed"
+                    # Prevent unwanted lock
+                    trace.mark("order_sent")
+                    yield "order:unlock", None
+
+            else:
+                print("Déjà utilisé par quelqu'un d'autre ...")
+                trace.outcome = eventbus.DENIED
+                trace.mark("order_sent")
+                yield "order:denied", None
+                self.publish(eventbus.DENIED, a.id, request_key, timestamp)
+
+        else:
+            print("Verboooten !")
+            trace.outcome = eventbus.DENIED
+            trace.mark("order_sent")
+            yield "order:denied", None
+            self.publish(eventbus.DENIED, a.id, request_key)
+
+    @staticmethod
+    def record_unlock(key_id, a_id, timestamp):
+        """ Stamp the unlock and open a session, written behind (see stamps) """
+        StampWriter().submit(key_id, a_id, timestamp, "unlocked")
+
+    @staticmethod
+    def record_lock(key_id, a_id, timestamp):
+        """ Stamp the lock and close the session, written behind (see stamps) """
+        StampWriter().submit(key_id, a_id, timestamp, "locked")
 
     def stop(self):
+        self.loop_flag.set()
+        self._wake.set()
         for a in self.arduinos:
             a.stop()
-        self.loop_flag.set()
+        if glob.CRAWLER_ENGINE == "asyncio":
+            # Wait for coroutines to be cancelled, they may be sending orders
+            EventLoop().run(self._async_stop()).result(timeout=5)
+        StampWriter().stop()
+
+    async def _async_stop(self):
+        if self._async_task is None:
+            # Not started yet
+            self._async_crawl.cancel()
+            return
+        self._async_task.cancel()
+        try:
+            await self._async_task
+        except asyncio.CancelledError:
+            pass
+
+
+def send_order(arduino, order, answer, timeout=2):
+    """
+    Send order to arduino and wait for its answer for given timeout
+
+    Devices implementing send_order() wake us up when the answer arrives.
+    Others are polled with is_answer()
+
+    :return Bool
+    """
+    try:
+        send = arduino.send_order
+    except AttributeError:
+        arduino.send_message(order)
+        return is_answer(arduino, answer, timeout)
+
+    return send(order, answer, timeout).wait()
+
+
+async def async_send_order(arduino, order, answer, timeout=2):
+    """
+    send_order() for the asyncio engine : the confirmation is awaited
+
+    The Command of the device wakes us up from whatever thread completes it.
+    Devices without send_order() are polled with is_answer() in an executor
+
+    :return Bool
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        send = arduino.send_order
+    except AttributeError:
+        arduino.send_message(order)
+        return await loop.run_in_executor(None, is_answer, arduino, answer, timeout)
+
+    done = loop.create_future()
+
+    def wake_up(command):
+        if not done.done():
+            done.set_result(True)
+
+    command = send(order, answer, timeout)
+    command.add_done_callback(lambda c: loop.call_soon_threadsafe(wake_up, c))
+    try:
+        return await asyncio.wait_for(done, timeout)
+    except asyncio.TimeoutError:
+        return False
 
 
 def is_answer(arduino, answer, timeout=2):
     """
-    Wait for an answer of arduino for givent timeout
+    Wait for an answer of arduino for givent timeout, by polling recv_message
 
     :return Bool
     """
@@ -210,9 +517,65 @@ def is_answer(arduino, answer, timeout=2):
 
 
 if __name__ == "__main__":
+    import shutil
+    import tempfile
+    from pathlib import Path
+
+    from okm.migrations import migrate
 
     class MocArduino:
+        """ Answer orders after `delay` seconds, or never if delay is None """
+
+        def __init__(self, a_id, delay):
+            self.id = a_id
+            self.delay = delay
+            self.badge_time = None
+            self.orders = queue.Queue()
+            self._recv_queue = queue.Queue()
+
+        def badge(self, key_id):
+            self.badge_time = time.monotonic()
+            self._recv_queue.put(f"new_read:{key_id}")
+
+        def send_message(self, msg):
+            self.orders.put((time.monotonic(), msg))
+            if self.delay is not None:
+                confirm = "confirm:" + msg.split(":")[1]
+                threading.Timer(self.delay, self._recv_queue.put, (confirm,)).start()
+
         def recv_message(self):
-            return "test"
+            try:
+                return self._recv_queue.get(timeout=0.01)
+            except queue.Empty:
+                return None
+
+        def stop(self):
+            pass
+
+    # The demo writes stamps, so work on a copy of the DB
+    glob.DB_PATH = Path(tempfile.mkdtemp()) / "db.sqlite3"
+    shutil.copy(DB_PATH, glob.DB_PATH)
+    migrate()
+
+    # python -m okm.backend.arduino_crawler asyncio
+    if "asyncio" in sys.argv:
+        glob.CRAWLER_ENGINE = "asyncio"
+
+    # Reader A never confirms, reader B confirms right away
+    reader_a, reader_b = MocArduino(10, None), MocArduino(20, 0)
+    crawler = ArduinoCrawler(arduinos=[reader_a, reader_b])
+
+    reader_a.badge("1")
+    time.sleep(0.05)
+    reader_b.badge("1")
+
+    order_time, order = reader_b.orders.get(timeout=5)
+    latency = (order_time - reader_b.badge_time) * 1000
+    print(f"Reader B got {order} after {latency:.1f} ms while reader A times out")
+
+    # Reader A's trace is over once its confirm timed out
+    time.sleep(2.5)
+    traces = [t.to_dict() for t in tracing.Tracer().slowest()]
+    print(tracing.format_traces(traces))
 
-    print(is_answer(MocArduino(), "test"))
+    crawler.stop()
@@ -21,13 +21,19 @@
 
 try:
     import okm.glob as glob
+    from okm.backend import metrics
+    from okm.backend.command import Command
     from okm.backend.max485 import Max485
+    from okm.backend.usb_transport import USBTransport
 except ImportError as e:
     import sys
 
     sys.path.append("/home/aurelien/sketchbook/open-key-manager")
     import okm.glob as glob
+    from okm.backend import metrics
+    from okm.backend.command import Command
     from okm.backend.max485 import Max485
+    from okm.backend.usb_transport import USBTransport
 
 import serial
 from serial.tools import list_ports
@@ -46,8 +52,33 @@ ARDUINOS_DESC déclaration in okm.glob
 
 MUST also implement API of crawler, nocitabley, recv_message & send_message
 
+MAY implement send_order(msg, answer, timeout), sending without blocking and
+returning a Command completed by the device's I/O thread. The crawler then
+sleeps until the confirmation arrives instead of polling recv_message
+
+MAY implement set_listener(callback), callback() being called from any thread
+when a message is ready for recv_message. The asyncio engine then waits for it
+instead of polling
+
 """
 
+USB_MESSAGES = metrics.Counter("okm_usb_messages_total", "Messages of USB arduinos")
+USB_REPLY_SECONDS = metrics.Histogram(
+    "okm_usb_reply_seconds", "From an order to its confirmation, USB arduinos"
+)
+USB_TIMEOUTS = metrics.Counter(
+    "okm_usb_timeouts_total", "Orders never confirmed, USB arduinos", ["a_id"]
+)
+
+
+def usb_transport():
+    """ Transport of USB arduinos for glob.CRAWLER_ENGINE """
+    if glob.CRAWLER_ENGINE == "asyncio":
+        from okm.backend.aio import AsyncioTransport
+
+        return AsyncioTransport()
+    return USBTransport()
+
 
 def get_arduinos():
     """
@@ -73,7 +104,11 @@ def get_arduinos():
 
 
 class USBArduino:
-    def __init__(self, a_id, serial_number):
+    def __init__(self, a_id, serial_number=None, device=None):
+        """
+        :serial_number: (str) of the arduino, to find its port
+        :device: (str) port to use instead, eg. a pty of okm.simulator
+        """
 
         # id of arduino
         self.id = a_id
@@ -81,66 +116,148 @@ class USBArduino:
         # name of arduino
         self.name = glob.ARDUINOS_DESC[self.id]
 
-        self.serial_device = None
+        self.serial_device = device
 
         self.type = "usb"
 
-        for p in list_ports.comports():
-            if p.serial_number == serial_number:
-                self.serial_device = p.device
+        if device is None:
+            for p in list_ports.comports():
+                if p.serial_number == serial_number:
+                    self.serial_device = p.device
         if self.serial_device is None:
             raise RuntimeError(
                 f"Arduino with serial_number : {serial_number} not found"
             )
 
-        self.loop_flag = threading.Event()
-        t = threading.Thread(name=f"USBArduino {serial_number} loop", target=self.loop)
-
-        self._send_queue = queue.Queue(maxsize=1)
+        # [(monotonic time, message), ... ] not received yet
         self._recv_queue = queue.Queue()
+        # When the last message recv_message() returned came in, for traces
+        self.received_at = None
+
+        # [Command, ... ] waiting for a reply, in order of sending
+        self._in_flight = []
+        self._in_flight_lock = threading.Lock()
+
+        # Counters, see stats()
+        self._replies = 0
+        self._timeouts = 0
+        self._max_in_flight = 0
+        self._latency_total = 0
+        self._latency_max = 0
+
+        # Set when arduino says confirm:ready
+        self._ready = threading.Event()
+
+        # See set_listener()
+        self._listener = None
+
+        # Non blocking : the transport only reads what's available
+        self._serial = serial.Serial(self.serial_device, 115200, timeout=0)
+        self._transport = usb_transport()
+        self._conn = self._transport.register(self._serial, self._on_message)
+
+    def _on_message(self, line):
+        """ Called by USBTransport thread for each message """
+        logging.info(f"{self} : arduino --> {line} ")
+        USB_MESSAGES.inc()
+
+        if not self._ready.is_set():
+            # Discard whatever arduino says while booting
+            if "confirm:ready" in line:
+                self._ready.set()
+            return
+
+        self._dispatch(line)
+
+    def _dispatch(self, line):
+        """ Complete the oldest command waiting for line, or queue it """
+        with self._in_flight_lock:
+            self._expire()
+            for command in self._in_flight:
+                if command.match(line):
+                    self._in_flight.remove(command)
+                    command.complete(line)
+                    self._replies += 1
+                    self._latency_total += command.latency
+                    self._latency_max = max(self._latency_max, command.latency)
+                    USB_REPLY_SECONDS.observe(command.latency)
+                    return
+        self._recv_queue.put((time.monotonic(), line))
+        if self._listener is not None:
+            self._listener()
+
+    def set_listener(self, callback):
+        """ callback() is called by the I/O thread when a message is queued """
+        self._listener = callback
+
+    def _expire(self):
+        """ Drop commands whose timeout is over. Call with _in_flight_lock """
+        now = time.monotonic()
+        for command in [c for c in self._in_flight if c.expired(now)]:
+            logging.warning(f"{self} : no {command.answer} for {command.msg}")
+            self._in_flight.remove(command)
+            self._timeouts += 1
+            USB_TIMEOUTS.inc(self.id)
 
-        t.start()
-
-    def loop(self):
-
-        with serial.Serial(self.serial_device, 115200, timeout=0.05) as ser:
-            # Wait for device ready
-            line = ""
-            while not "confirm:ready" in line:
-                line = ser.read_until(";").decode()
-
-            while not self.loop_flag.is_set():
+    def stop(self):
+        self._transport.unregister(self._conn)
+        self._serial.close()
 
-                if self._send_queue.empty():
-                    line = ser.read_until(";").decode()
-                    if line != "":
-                        logging.info(f"{self} loop : arduino --> {line} ")
-                        # remove ;
-                        line = line[:-1]
-                        self._recv_queue.put(line.strip())
+    def send_order(self, msg, answer=None, timeout=2):
+        """
+        Send order without waiting for the reply
 
-                try:
-                    line = self._send_queue.get(timeout=0.01)
-                except queue.Empty as e:
-                    pass
-                else:
-                    line += ";"
-                    logging.info(f"{self} loop : arduino <-- {line} ")
-                    ser.write(line.encode())
+        :answer: (str) expected reply. Default to 'confirm:<order>'
+        :timeout: (float) seconds to wait for the reply
+        :return: Command, wait() on it to get the reply
+        """
+        if answer is None:
+            answer = "confirm:" + msg.split(":")[-1]
 
-            print("end of loop")
+        command = Command(msg, answer, timeout)
+        # Registered before sending, the reply may come back very fast
+        with self._in_flight_lock:
+            self._expire()
+            self._in_flight.append(command)
+            self._max_in_flight = max(self._max_in_flight, len(self._in_flight))
 
-    def stop(self):
-        self.loop_flag.set()
+        try:
+            self.send_message(msg)
+        except Exception:
+            with self._in_flight_lock:
+                self._in_flight.remove(command)
+            raise
+
+        return command
+
+    def stats(self):
+        """ :return: (dict) in-flight depth and reply latency (s) of orders """
+        with self._in_flight_lock:
+            self._expire()
+            latency_avg = None
+            if self._replies:
+                latency_avg = self._latency_total / self._replies
+            return {
+                "in_flight": len(self._in_flight),
+                "max_in_flight": self._max_in_flight,
+                "replies": self._replies,
+                "timeouts": self._timeouts,
+                "latency_avg": latency_avg,
+                "latency_max": self._latency_max,
+            }
 
     def send_message(self, msg):
         """ Send message to arduino """
-        self._send_queue.put(msg, timeout=5)
+        if not self._ready.wait(timeout=5):
+            raise RuntimeError(f"{self} not ready, can't send {msg}")
+        line = msg + ";"
+        logging.info(f"{self} : arduino <-- {line} ")
+        self._transport.write(self._conn, line.encode())
 
     def recv_message(self):
-        """ Receive message from arduino """
+        """ Receive message from arduino. Doesn't block """
         try:
-            msg = self._recv_queue.get(timeout=0.01)
+            self.received_at, msg = self._recv_queue.get_nowait()
         except queue.Empty as e:
             msg = None
         return msg
@@ -150,27 +267,42 @@ class USBArduino:
 
 
 class RS485Arduino:
+
+    # No bus attribute : the arbiter of Max485 serializes the bus itself, so
+    # the crawler runs RS485 pipelines concurrently, confirm waits included
+
     def __init__(self, a_id):
         self.id = a_id
+        # When the last message recv_message() returned came in, for traces
+        self.received_at = None
+        Max485.arbiter.add(a_id)
 
     def send_message(self, msg):
         """ Send message to arduino """
         Max485.send_message(self.id, msg)
 
-    def recv_message(self):
-        """ Receive message from arduino """
-        # Try to get a new read
-        new_read = Max485.recv_message(self.id)
+    def send_order(self, msg, answer, timeout=2):
+        """
+        Queue msg, the bus arbiter sends it while other arduinos are served
 
-        p1, p2 = new_read.split(":")
+        :return: Transaction
+        """
+        return Max485.send_order(self.id, msg, answer, timeout)
 
-        if p1 == "new_read" and p2 == "none":
+    def recv_message(self):
+        """ Receive message from arduino, None if no badge was read """
+        read = Max485.arbiter.recv(self.id)
+        if read is None:
             return None
-        else:
-            return new_read
+        self.received_at, msg = read
+        return msg
+
+    def set_listener(self, callback):
+        """ callback() is called by the bus arbiter when a badge is read """
+        Max485.arbiter.listen(self.id, callback)
 
     def stop(self):
-        pass
+        Max485.arbiter.stop()
 
 
 class VirtualArduino:
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import binascii
+import collections
+import time
+
+"""
+Wire formats of the readers, and streaming decoders shared by the transports
+
+Text messages end with ';', eg. 'new_read:d7425919;'. This is what USB readers
+speak, and RS485 readers by default.
+
+Binary frames of the RS485 reader protocol
+
+The text protocol ('20:ask_for_new;' / 'new_read:d7425919;') spends most of
+the bus time on text, and a garbled message is only noticed if it doesn't
+parse. A frame is :
+
+    SOF | address | opcode | length | payload | CRC16
+
+SOF is 0xA5, length is the one of payload (at most MAX_PAYLOAD), CRC16 is
+CRC-CCITT (poly 0x1021, init 0xFFFF) of address to payload, big endian. It is
+what _crc_xmodem_update() of avr-libc computes, see arduino/rs485_key_reader
+
+Readers understanding frames confirm the 'proto_binary' text order, others
+answer 'unknown_order'. okm.backend.max485.BusArbiter negotiates it per reader
+and turns frames back into the text the reader would have sent, so nothing
+above the bus knows about frames
+
+Decoders accept bytes cut anywhere. They keep them in a StreamBuffer, which
+transports can also read into directly, and parse them in place through
+memoryviews : the only copy of a message is the object handed out
+"""
+
+SOF = 0xA5
+# SOF, address, opcode, length
+HEADER_SIZE = 4
+CRC_SIZE = 2
+MAX_PAYLOAD = 16
+
+# Opcodes, orders
+ASK_FOR_NEW = 0x01
+LOCK = 0x02
+UNLOCK = 0x03
+DENIED = 0x04
+# Opcodes, replies
+NEW_READ = 0x10  # payload : uid of the badge, empty if none
+CONFIRM = 0x11  # payload : opcode of the order confirmed
+UNKNOWN_ORDER = 0x12
+
+ORDERS = {"ask_for_new": ASK_FOR_NEW, "lock": LOCK, "unlock": UNLOCK, "denied": DENIED}
+ORDER_NAMES = {opcode: order for order, opcode in ORDERS.items()}
+
+# address : (int) id of arduino
+# opcode : (int) one of the above
+# payload : (bytes)
+Frame = collections.namedtuple("Frame", ["address", "opcode", "payload"])
+
+
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def encode(address, opcode, payload=b""):
+    """ :return: (bytes) the frame, ready to be written """
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"Payload of {len(payload)} bytes, max is {MAX_PAYLOAD}")
+    body = bytes((address, opcode, len(payload))) + payload
+    return bytes((SOF,)) + body + crc16(body).to_bytes(CRC_SIZE, "big")
+
+
+def encode_order(a_id, order):
+    """
+    :order: (str) text order, eg. 'unlock'
+    :return: (bytes) the frame
+    """
+    try:
+        return encode(a_id, ORDERS[order])
+    except KeyError:
+        raise ValueError(f"No opcode for order {order}")
+
+
+def reply_text(frame):
+    """
+    :frame: Frame sent by a reader
+    :return: (str) what the reader would have answered in text
+    """
+    if frame.opcode == NEW_READ:
+        if not frame.payload:
+            return "new_read:none"
+        # Like String(byte, HEX) of the sketch : lowercase, not zero padded
+        return "new_read:" + "".join(f"{b:x}" for b in frame.payload)
+    elif frame.opcode == CONFIRM and len(frame.payload) == 1:
+        return "confirm:" + ORDER_NAMES.get(frame.payload[0], "unknown")
+    elif frame.opcode == UNKNOWN_ORDER:
+        return f"{frame.address}:unknown_order"
+    return f"{frame.address}:unknown_reply"
+
+
+class TextMessage(str):
+    """ A text message without its ';', eg. 'new_read:d7425919' """
+
+    __slots__ = ()
+
+    @property
+    def kind(self):
+        """ 'new_read' """
+        return self.partition(":")[0]
+
+    @property
+    def value(self):
+        """ 'd7425919', None without ':' """
+        return self.partition(":")[2] or None
+
+
+class StreamBuffer:
+    """
+    Bytes received and not consumed yet
+
+    data is a bytearray used as a ring : bytes are appended after end and
+    consumed by moving start, without copying. When there is no room left
+    after end, the few bytes pending (a partial message) go back to the front.
+    Decoders parse data[start:end] in place
+    """
+
+    def __init__(self, capacity=4096):
+        self.data = bytearray(capacity)
+        self.view = memoryview(self.data)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def writable(self, size):
+        """
+        :return: (memoryview) of at least size free bytes, to read into. Call
+            commit() with the number of bytes actually written
+        """
+        if len(self.data) - self.end < size:
+            pending = self.end - self.start
+            if pending + size > len(self.data):
+                # Views handed out keep the old bytearray alive, never resize it
+                data = bytearray(max(2 * len(self.data), pending + size))
+                data[:pending] = self.view[self.start : self.end]
+                self.data = data
+                self.view = memoryview(data)
+            else:
+                self.view[:pending] = self.view[self.start : self.end]
+            self.start = 0
+            self.end = pending
+        return self.view[self.end :]
+
+    def commit(self, size):
+        self.end += size
+
+    def write(self, data):
+        size = len(data)
+        if len(self.data) - self.end < size:
+            self.writable(size)
+        self.data[self.end : self.end + size] = data
+        self.end += size
+
+    def consume(self, size):
+        self.start += size
+        if self.start >= self.end:
+            self.start = self.end = 0
+
+    def clear(self):
+        self.start = self.end = 0
+
+
+class StreamDecoder:
+    """
+    Base of decoders : subclasses implement decode(), parsing what is in
+    self.buffer into messages
+    """
+
+    def __init__(self, capacity=4096):
+        self.buffer = StreamBuffer(capacity)
+        # Messages dropped because they are malformed
+        self.errors = 0
+        # Bytes skipped outside of any message
+        self.skipped = 0
+
+    def feed(self, data):
+        """ :return: [message, ... ] completed by data (bytes) """
+        self.buffer.write(data)
+        return self.decode()
+
+    def fill(self, readinto, size=None):
+        """
+        Read straight into the buffer
+
+        :readinto: callable(memoryview) -> number of bytes read, eg.
+            ser.readinto, or lambda view: os.readv(fd, [view])
+        :size: (int) bytes to read at most, default to needed()
+        :return: (int) bytes read
+        """
+        if size is None:
+            size = self.needed()
+        view = self.buffer.writable(size)[:size]
+        count = readinto(view) or 0
+        view.release()
+        self.buffer.commit(count)
+        return count
+
+    def decode(self):
+        """ :return: [message, ... ] complete in buffer """
+        raise NotImplementedError
+
+    def needed(self):
+        """ :return: (int) bytes to read to (maybe) complete a message """
+        return 1
+
+    def reset(self):
+        self.buffer.clear()
+
+
+class TextDecoder(StreamDecoder):
+    """ Cut text messages on ';' into TextMessage, surrounding spaces stripped """
+
+    def __init__(self, capacity=4096, max_message=1024):
+        """ :max_message: (int) longer than that means we lost a ';' """
+        super().__init__(capacity)
+        self.max_message = max_message
+
+    def decode(self):
+        buffer = self.buffer
+        start, end = buffer.start, buffer.end
+        # All complete messages are decoded at once, then split in C
+        last = buffer.data.rfind(b";", start, end)
+        if last < 0:
+            messages = []
+        else:
+            text = str(buffer.view[start:last], "utf-8", "replace")
+            messages = [TextMessage(msg.strip()) for msg in text.split(";")]
+            buffer.consume(last + 1 - start)
+
+        if len(buffer) > self.max_message:
+            self.errors += 1
+            self.skipped += len(buffer)
+            buffer.clear()
+        return messages
+
+
+class FrameDecoder(StreamDecoder):
+    """
+    Incremental decoder of binary frames into Frame
+
+    Bytes before a SOF are skipped. A frame with a bad CRC or length is dropped
+    and decoding starts again right after its SOF, so a frame hidden in
+    garbage is still found
+    """
+
+    def __init__(self, capacity=256):
+        super().__init__(capacity)
+
+    def decode(self):
+        buffer = self.buffer
+        data, view = buffer.data, buffer.view
+        frames = []
+
+        while True:
+            start = data.find(SOF, buffer.start, buffer.end)
+            if start < 0:
+                self.skipped += len(buffer)
+                buffer.clear()
+                break
+            self.skipped += start - buffer.start
+            buffer.start = start
+
+            if buffer.end - start < HEADER_SIZE:
+                break
+            length = data[start + 3]
+            if length > MAX_PAYLOAD:
+                self.errors += 1
+                buffer.consume(1)
+                continue
+
+            end = start + HEADER_SIZE + length
+            if buffer.end < end + CRC_SIZE:
+                break
+            if crc16(view[start + 1 : end]) != (data[end] << 8) | data[end + 1]:
+                self.errors += 1
+                buffer.consume(1)
+                continue
+
+            payload = bytes(view[start + HEADER_SIZE : end])
+            frames.append(Frame(data[start + 1], data[start + 2], payload))
+            buffer.consume(end + CRC_SIZE - start)
+
+        return frames
+
+    def needed(self):
+        """ :return: (int) bytes missing to complete the frame in progress """
+        buffer = self.buffer
+        pending = len(buffer)
+        if pending < HEADER_SIZE:
+            return HEADER_SIZE - pending
+        length = buffer.data[buffer.start + 3]
+        return max(1, HEADER_SIZE + length + CRC_SIZE - pending)
+
+
+def read_message(ser, decoder):
+    """
+    Read one message from a serial port, within its timeout
+
+    :ser: serial.Serial
+    :decoder: StreamDecoder, reset first : what is left of a previous answer
+        isn't ours
+    :return: message, or None on timeout
+    """
+    decoder.reset()
+    deadline = time.monotonic() + (ser.timeout or 0)
+    while True:
+        if decoder.fill(ser.readinto, max(decoder.needed(), ser.in_waiting)):
+            messages = decoder.decode()
+            if messages:
+                return messages[0]
+        if time.monotonic() > deadline:
+            return None
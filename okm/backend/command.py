@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import threading
+import time
+
+"""
+Orders waiting for their reply, whatever the transport
+
+Completed by the thread receiving the reply, waited on by the crawler (see
+okm.backend.arduinos and okm.backend.max485)
+"""
+
+
+class Command:
+    """
+    An order sent to an arduino, and the reply it expects
+
+    Completed by the I/O thread of the device as soon as the matching reply
+    comes in, or expired once its timeout is over
+    """
+
+    def __init__(self, msg, answer, timeout):
+        # Order sent, eg. 'order:unlock'
+        self.msg = msg
+        # Expected reply, eg. 'confirm:unlock'
+        self.answer = answer
+        # Actual reply received, None until completed
+        self.reply = None
+
+        self.sent_at = time.monotonic()
+        self.deadline = self.sent_at + timeout
+        # Seconds between sending and reply
+        self.latency = None
+
+        self._done = threading.Event()
+        # [callable(self), ... ] see add_done_callback()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def match(self, msg):
+        return self.answer in msg
+
+    def complete(self, msg):
+        self.reply = msg
+        self.latency = time.monotonic() - self.sent_at
+        with self._callbacks_lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(self) once the reply is received, from the thread
+        receiving it. Right away if it is already
+        """
+        with self._callbacks_lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def expired(self, now):
+        return not self._done.is_set() and now >= self.deadline
+
+    def wait(self, timeout=None):
+        """
+        Block until reply is received, or timeout (default to the timeout of
+        the command)
+
+        :return: (bool) True if the reply was received
+        """
+        if timeout is None:
+            timeout = max(0, self.deadline - time.monotonic())
+        return self._done.wait(timeout)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import collections
+import logging
+import threading
+
+"""
+Internal publish/subscribe bus
+
+The crawler publishes what happens on arduinos. The GUI, loggers and whatever
+comes next subscribe to it. Each subscriber has its own queue, so a slow
+subscriber never slows down the crawler nor the others, and publishers never
+share a lock with each other or with subscribers
+
+Usage :
+    from okm.backend.eventbus import bus, UNLOCKED
+
+    sub = bus.subscribe("my_name")
+    event = sub.get(timeout=1)
+"""
+
+# Kinds of event
+UNLOCKED = "unlocked"
+LOCKED = "locked"
+DENIED = "denied"
+UNKNOWN_KEY = "unknown_key"
+
+# kind : one of the above
+# a_id : id of arduino concerned
+# key_id : key badged
+# timestamp : (datetime) when it happened
+Event = collections.namedtuple("Event", ["kind", "a_id", "key_id", "timestamp"])
+
+
+class Subscription:
+    """
+    Queue of events for one subscriber
+
+    The queue is unbounded : the publisher is the crawler, it never waits for
+    a subscriber and no event is ever lost. A subscriber falling behind by
+    more than warn_size events is logged, each time it does
+    """
+
+    def __init__(self, name, warn_size=1024, notify=None):
+        """
+        :notify: callable() called by the publisher when the queue goes from
+            empty to non-empty, eg. lambda: wx.CallAfter(drain_function)
+            Consumer is then expected to drain() the queue
+        """
+        self.name = name
+        self.warn_size = warn_size
+        self.notify = notify
+
+        # Biggest queue size seen
+        self.high_watermark = 0
+        # Whether the queue is above warn_size, to log once per excursion
+        self._lagging = False
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+
+    def put(self, event):
+        with self._cond:
+            was_empty = not self._queue
+            self._queue.append(event)
+            size = len(self._queue)
+            self.high_watermark = max(self.high_watermark, size)
+            starts_lagging = size > self.warn_size and not self._lagging
+            self._lagging = size > self.warn_size
+            self._cond.notify()
+
+        if starts_lagging:
+            logging.warning(f"Event subscriber {self.name} is {size} events behind")
+
+        if was_empty and self.notify is not None:
+            self.notify()
+
+    def get(self, timeout=None):
+        """ :return: next Event, None on timeout """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._queue, timeout):
+                return None
+            return self._queue.popleft()
+
+    def drain(self):
+        """ :return: [Event, ... ] all queued events, without waiting """
+        with self._cond:
+            events = list(self._queue)
+            self._queue.clear()
+            return events
+
+    def __len__(self):
+        return len(self._queue)
+
+
+class EventBus:
+    def __init__(self):
+        # Replaced, never mutated, so publish() can iterate without lock
+        self._subscriptions = ()
+        self._lock = threading.Lock()
+
+    def subscribe(self, name, **kw):
+        """
+        :kw: see Subscription
+        :return: Subscription receiving every event published from now on
+        """
+        subscription = Subscription(name, **kw)
+        with self._lock:
+            self._subscriptions += (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions = tuple(
+                s for s in self._subscriptions if s is not subscription
+            )
+
+    def publish(self, event):
+        for subscription in self._subscriptions:
+            try:
+                subscription.put(event)
+            except Exception:
+                logging.exception(f"Event subscriber {subscription.name} failed")
+
+
+bus = EventBus()
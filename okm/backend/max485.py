@@ -19,10 +19,22 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
-import RPi.GPIO as gpio
 import serial
+import serial.rs485
 import time
+import collections
 import logging
+import threading
+
+import okm.glob as glob
+from okm.backend import codec, metrics
+from okm.backend.command import Command
+
+try:
+    import RPi.GPIO as gpio
+except ImportError:
+    # Not on a Pi (dev machine, benchmarks). See FakeGpio
+    gpio = None
 
 
 # class Singleton(type):
@@ -42,55 +54,709 @@ import logging
 #         return cls._instances[cls]
 
 
+RS485_EXCHANGE_SECONDS = metrics.Histogram(
+    "okm_rs485_exchange_seconds", "Order or poll and its answer on the RS485 bus"
+)
+RS485_NO_REPLY = metrics.Counter(
+    "okm_rs485_no_reply_total", "RS485 exchanges without an answer"
+)
+RS485_ERRORS = metrics.Counter("okm_rs485_errors_total", "RS485 bus errors")
+RS485_RETRIES = metrics.Counter(
+    "okm_rs485_retries_total", "RS485 orders sent again, not confirmed yet"
+)
+RS485_TIMEOUTS = metrics.Counter(
+    "okm_rs485_timeouts_total", "RS485 orders never confirmed", ["a_id"]
+)
+
+
+###################################################
+# Direction control of the half-duplex bus
+# The max485 must be in send mode while we transmit, and back in receive mode
+# before the arduino answers. Each class below is a way to do it, used by
+# RS485Bus through configure(ser), before_write(ser) and after_write(ser)
+###################################################
+
+
+class NoDirection:
+    """ Nothing to drive (auto-direction adapter, pty in benchmarks) """
+
+    def configure(self, ser):
+        pass
+
+    def before_write(self, ser):
+        pass
+
+    def after_write(self, ser):
+        pass
+
+
+class FakeGpio:
+    """
+    Stand-in for RPi.GPIO module, for tests and dev machines
+    Remembers the last value written on each pin
+    """
+
+    BCM = "BCM"
+    OUT = "OUT"
+
+    def __init__(self):
+        # {pin: value, ... }
+        self.pins = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, mode):
+        self.pins[pin] = 0
+
+    def output(self, pin, value):
+        self.pins[pin] = value
+
+
+class GpioDirection:
+    """
+    Drive RE/DE pins of the max485 from Python
+
+    Transmission end is detected with flush() (tcdrain) plus the time of one
+    character, the last one leaving the shift register, computed from baudrate
+    """
+
+    def __init__(self, gpio_module, re_pin, de_pin):
+        self.gpio = gpio_module
+        # FIXME : only one pin is needed. To be updated on new hardware version
+        self.pins = (re_pin, de_pin)
+        self.char_time = 0
+
+        self.gpio.setmode(self.gpio.BCM)
+        for pin in self.pins:
+            self.gpio.setup(pin, self.gpio.OUT)
+
+    def configure(self, ser):
+        # start bit + 8 data bits + stop bit
+        self.char_time = 10 / ser.baudrate
+
+    def before_write(self, ser):
+        for pin in self.pins:
+            self.gpio.output(pin, 1)
+
+    def after_write(self, ser):
+        ser.flush()
+        time.sleep(self.char_time)
+        for pin in self.pins:
+            self.gpio.output(pin, 0)
+
+
+class KernelDirection:
+    """
+    Let the UART driver drive direction with RTS (wire RTS to RE/DE)
+
+    The kernel switches back to receive as soon as the last bit is out, no
+    timing guess on our side
+    """
+
+    def configure(self, ser):
+        ser.rs485_mode = serial.rs485.RS485Settings(
+            rts_level_for_tx=True, rts_level_for_rx=False
+        )
+
+    def before_write(self, ser):
+        pass
+
+    def after_write(self, ser):
+        pass
+
+
+def make_direction(kind, re_pin, de_pin):
+    """
+    :kind: 'gpio' | 'kernel' | 'none', see glob.RS485_DIRECTION
+    """
+    if kind == "kernel":
+        return KernelDirection()
+    elif kind == "gpio":
+        if gpio is None:
+            logging.warning("RPi.GPIO not available, RS485 direction pins faked")
+            return GpioDirection(FakeGpio(), re_pin, de_pin)
+        return GpioDirection(gpio, re_pin, de_pin)
+    elif kind == "none":
+        return NoDirection()
+    raise ValueError(f"Unknown RS485 direction control : {kind}")
+
+
+class RS485Bus:
+    """
+    The serial port of the RS485 bus, opened once for the lifetime of the process
+
+    Reopened on error, so that an unplugged adapter or a glitch doesn't kill
+    the crawler
+    """
+
+    def __init__(self, port, baudrate, direction=None, timeout=2, turnaround=0):
+        """
+        :direction: NoDirection | GpioDirection | KernelDirection
+        :turnaround: (float) seconds an arduino needs after answering before it
+            listens again
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.direction = direction if direction is not None else NoDirection()
+        self.timeout = timeout
+        self.turnaround = turnaround
+
+        self._ser = None
+        # Only one exchange at a time on a half-duplex bus
+        self.lock = threading.Lock()
+        # monotonic time before which the bus must stay quiet
+        self._quiet_until = 0
+
+        # Time spent exchanging (turnaround included), see utilization()
+        self.busy_time = 0
+        self._stats_since = time.monotonic()
+
+    def open(self):
+        if self._ser is None:
+            logging.info(f"Open RS485 bus on {self.port}")
+            self._ser = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
+            self.direction.configure(self._ser)
+        return self._ser
+
+    def close(self):
+        if self._ser is not None:
+            try:
+                self._ser.close()
+            except (serial.SerialException, OSError):
+                pass
+            self._ser = None
+
+    def exchange(self, frame, read=None):
+        """
+        Send frame and read the answer, up to ';' or timeout
+
+        :frame: (bytes) to send
+        :read: callable(ser) reading the answer instead, eg. with a codec decoder
+        :return: (bytes) answer, empty on timeout. Whatever read returns if given
+        """
+        with self.lock:
+            start = time.monotonic()
+            try:
+                return self._exchange(frame, read)
+            finally:
+                self.busy_time += time.monotonic() - start
+
+    def _exchange(self, frame, read):
+        # Only wait if the arduino that just answered may not listen yet
+        delay = self._quiet_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        for attempt in (1, 2):
+            try:
+                ser = self.open()
+                # Leftovers of a previous answer (timeout) aren't ours
+                ser.reset_input_buffer()
+                self.direction.before_write(ser)
+                ser.write(frame)
+                self.direction.after_write(ser)
+                if read is None:
+                    rsp = ser.read_until(b";")
+                else:
+                    rsp = read(ser)
+                self._quiet_until = time.monotonic() + self.turnaround
+                return rsp
+            except (serial.SerialException, OSError) as e:
+                self.close()
+                if attempt == 2:
+                    raise
+                logging.error(f"RS485 bus error, reconnecting : {e}")
+
+    def utilization(self, reset=False):
+        """ :return: (float) share of time the bus was busy, 0 to 1 """
+        now = time.monotonic()
+        utilization = self.busy_time / max(now - self._stats_since, 1e-9)
+        if reset:
+            self.busy_time = 0
+            self._stats_since = now
+        return utilization
+
+
+class BusScheduler:
+    """
+    Decide when each arduino of the bus is polled
+
+    Readers recently active (badge read) or currently unlocked are polled every
+    active_interval, idle ones every max_latency, which is the longest a badge
+    may wait before being noticed. Bus time is then spent where badges are
+    likely. The reader whose poll is the most overdue goes first
+    """
+
+    def __init__(self, active_interval, max_latency, active_window, slack=None):
+        """
+        :active_interval: (float) seconds between polls of an active reader
+        :max_latency: (float) longest seconds between polls of an idle reader
+        :active_window: (float) seconds a reader stays active after a read
+        :slack: (float) how late a due poll may actually happen. Idle polls are
+            scheduled that much earlier. None : set by the BusArbiter given
+            this scheduler, see BusArbiter.poll_slack()
+        """
+        self.active_interval = active_interval
+        self.max_latency = max_latency
+        self.active_window = active_window
+        self.slack = slack
+
+        # {'arduino_id': {'next_poll', 'last_activity', 'unlocked', 'max_latency',
+        #                 'polls', 'late', 'max_gap', 'last_poll'}, ... }
+        self._readers = {}
+        self._lock = threading.Lock()
+
+    def add(self, a_id, max_latency=None):
+        """ :max_latency: override default for this reader """
+        with self._lock:
+            self._readers.setdefault(
+                a_id,
+                {
+                    "next_poll": 0,
+                    "last_activity": -self.active_window,
+                    "unlocked": False,
+                    "max_latency": max_latency or self.max_latency,
+                    "polls": 0,
+                    "late": 0,
+                    "max_gap": 0,
+                    "last_poll": None,
+                },
+            )
+
+    def _interval(self, reader, now):
+        latency = max(reader["max_latency"] - (self.slack or 0), 0)
+        if reader["unlocked"] or now - reader["last_activity"] < self.active_window:
+            return min(self.active_interval, latency)
+        return latency
+
+    def is_due(self, a_id, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.add(a_id)
+        return self._readers[a_id]["next_poll"] <= now
+
+    def next_due(self):
+        """
+        :return: (a_id, monotonic time it is due) for the most urgent reader,
+            (None, None) without readers
+        """
+        with self._lock:
+            if not self._readers:
+                return None, None
+            a_id = min(self._readers, key=lambda a: self._readers[a]["next_poll"])
+            return a_id, self._readers[a_id]["next_poll"]
+
+    def polled(self, a_id, activity=False):
+        """
+        Record a poll of a_id and schedule the next one
+
+        :activity: (bool) a badge was read
+        """
+        self.add(a_id)
+        now = time.monotonic()
+        with self._lock:
+            reader = self._readers[a_id]
+            if reader["last_poll"] is not None:
+                gap = now - reader["last_poll"]
+                reader["max_gap"] = max(reader["max_gap"], gap)
+                if gap > reader["max_latency"]:
+                    reader["late"] += 1
+            reader["last_poll"] = now
+            reader["polls"] += 1
+            if activity:
+                reader["last_activity"] = now
+            reader["next_poll"] = now + self._interval(reader, now)
+
+    def set_unlocked(self, a_id, unlocked):
+        """ Unlocked readers are polled fast, their user will badge again """
+        self.add(a_id)
+        with self._lock:
+            reader = self._readers[a_id]
+            reader["unlocked"] = unlocked
+            reader["last_activity"] = time.monotonic()
+            reader["next_poll"] = min(
+                reader["next_poll"], time.monotonic() + self.active_interval
+            )
+
+    def defer(self, a_id, until):
+        """
+        Do not poll a_id before until (monotonic time), it would not answer
+
+        The reader does not read badges meanwhile either, so this gap doesn't
+        count against max_latency
+        """
+        self.add(a_id)
+        with self._lock:
+            reader = self._readers[a_id]
+            reader["next_poll"] = max(reader["next_poll"], until)
+            reader["last_poll"] = None
+
+    def report(self, bus=None):
+        """
+        :bus: RS485Bus, to include its utilization
+        :return: (dict) per reader polls, polls later than max_latency and
+            longest gap between polls (s)
+        """
+        with self._lock:
+            report = {
+                "readers": {
+                    a_id: {k: r[k] for k in ("polls", "late", "max_gap", "unlocked")}
+                    for a_id, r in self._readers.items()
+                }
+            }
+        if bus is not None:
+            report["utilization"] = bus.utilization()
+        return report
+
+
+class Transaction(Command):
+    """
+    An order for one arduino of the bus, and the confirmation it expects
+
+    Queued in the BusArbiter, completed by its thread when the confirmation
+    comes in. Its latency counts from queuing
+    """
+
+    def __init__(self, a_id, order, answer, timeout):
+        super().__init__(order, answer, timeout)
+        self.a_id = a_id
+        # Order sent, eg. 'unlock'
+        self.order = order
+        # Sendings of the order, and monotonic time of the next one
+        self.attempts = 0
+        self.next_try = self.sent_at
+
+
+class BusArbiter:
+    """
+    Own the RS485 bus and share it between its arduinos
+
+    Orders wait in a queue per arduino as Transaction. A single thread sends
+    them and, in between, polls the arduinos the BusScheduler says are due for
+    new reads. An order left unconfirmed is sent again later while other
+    arduinos are served, until its timeout. So waiting for one arduino
+    doesn't stall the others
+    """
+
+    # Seconds an arduino is deaf after confirming an order : it blinks its leds
+    # with delay() (see arduino/rs485_key_reader). Talking to it meanwhile would
+    # only get a late answer colliding with someone else's
+    DEAF_AFTER = {"unlock": 1.0, "lock": 2.0, "denied": 2.2}
+    RETRY_DELAY = 0.1
+
+    def __init__(self, bus, scheduler, binary=False):
+        """
+        :bus: RS485Bus
+        :scheduler: BusScheduler deciding when to poll each arduino
+        :binary: (bool) talk in binary frames (okm.backend.codec) once every
+            arduino of the bus understands them. An old sketch reads whatever
+            goes on the bus up to a ';' : frames addressed to others would
+            garble its next order. So a single one keeps the whole bus in text
+        """
+        self.bus = bus
+        self.scheduler = scheduler
+        self.binary = binary
+        if scheduler.slack is None:
+            scheduler.slack = self.poll_slack()
+
+        # {'arduino_id': True if it talks in frames, False if in text, ... }
+        # Not negotiated yet if missing
+        self._binary = {}
+        self._text_decoder = codec.TextDecoder(capacity=256)
+        self._frame_decoder = codec.FrameDecoder()
+
+        self._cond = threading.Condition()
+        # {'arduino_id': deque([Transaction, ... ]), ... } oldest first
+        self._orders = {}
+        # {'arduino_id': deque([(monotonic time, 'new_read:XXXX'), ... ]), ... }
+        self._inbox = {}
+        # {'arduino_id': monotonic time it listens again, ... }
+        self._deaf_until = {}
+        # {'arduino_id': callable() called when a new read is in inbox, ... }
+        self._listeners = {}
+
+        self._thread = None
+        self._stop = threading.Event()
+
+    def poll_slack(self):
+        """
+        :return: (float) how late a due poll may happen : the loop only looks
+            at the scheduler between exchanges, so it may have to wait for one
+            to time out, after the turnaround of the previous one
+        """
+        return self.bus.timeout + self.bus.turnaround
+
+    def add(self, a_id):
+        """ Declare an arduino of the bus, it gets polled from now on """
+        if a_id in self._orders:
+            return
+        with self._cond:
+            self._orders.setdefault(a_id, collections.deque())
+            self._inbox.setdefault(a_id, collections.deque())
+            self._deaf_until.setdefault(a_id, 0)
+        self.scheduler.add(a_id)
+
+    def start(self):
+        """ Start the arbiter thread if needed. Not once stopped """
+        with self._cond:
+            if self._thread is None and not self._stop.is_set():
+                self._thread = threading.Thread(
+                    name="RS485Arbiter", target=self.loop, daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stop.set()
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def submit(self, a_id, order, answer, timeout=2):
+        """
+        Queue order for a_id, without blocking
+
+        :return: Transaction, wait() on it for the confirmation
+        """
+        self.add(a_id)
+        txn = Transaction(a_id, order, answer, timeout)
+        with self._cond:
+            self._orders[a_id].append(txn)
+            self._cond.notify()
+        self.start()
+        return txn
+
+    def listen(self, a_id, callback):
+        """ Call callback(), from the arbiter thread, when a_id reads a badge """
+        self._listeners[a_id] = callback
+
+    def recv(self, a_id):
+        """
+        :return: (monotonic time, str) oldest new read of a_id not consumed
+            yet, or None
+        """
+        self.add(a_id)
+        self.start()
+        try:
+            return self._inbox[a_id].popleft()
+        except IndexError:
+            return None
+
+    def loop(self):
+        while not self._stop.is_set():
+            with self._cond:
+                txn, a_id, wake = self._next_job(time.monotonic())
+                if txn is None and a_id is None:
+                    self._cond.wait(max(0, wake - time.monotonic()))
+                    continue
+
+            if txn is not None:
+                self._send(txn)
+            else:
+                self._poll(a_id)
+
+    def _next_job(self, now):
+        """
+        Orders go before polls, the oldest first. Called with _cond held
+
+        :return: (Transaction | None, a_id to poll | None, monotonic time to
+            look again if there is nothing to do)
+        """
+        wake = now + 1
+        ready = []
+        for a_id, orders in self._orders.items():
+            while orders and orders[0].expired(now):
+                txn = orders.popleft()
+                logging.warning(
+                    f"RS485 arduino {a_id} didn't confirm {txn.order}"
+                    f" after {txn.attempts} attempt(s)"
+                )
+                RS485_TIMEOUTS.inc(a_id)
+            if not orders:
+                continue
+            start = max(orders[0].next_try, self._deaf_until[a_id])
+            if start <= now:
+                ready.append(orders[0])
+            else:
+                wake = min(wake, start)
+
+        if ready:
+            return min(ready, key=lambda txn: txn.sent_at), None, wake
+
+        a_id, due = self.scheduler.next_due()
+        if due is not None and due <= now:
+            return None, a_id, wake
+        if due is not None:
+            wake = min(wake, due)
+        return None, None, wake
+
+    def _send(self, txn):
+        txn.attempts += 1
+        rsp = self.exchange(txn.a_id, txn.order)
+        now = time.monotonic()
+
+        if not txn.match(rsp):
+            # The arduino may have got the order and be blinking : whatever it
+            # is sent meanwhile piles up in its RX buffer and runs afterwards,
+            # each answer colliding with someone else's. Wait until it listens
+            deaf = self.DEAF_AFTER.get(txn.order, 0)
+            txn.next_try = now + max(self.RETRY_DELAY, deaf)
+            with self._cond:
+                self._deaf_until[txn.a_id] = max(self._deaf_until[txn.a_id], now + deaf)
+            self.scheduler.defer(txn.a_id, self._deaf_until[txn.a_id])
+            RS485_RETRIES.inc()
+            return
+
+        with self._cond:
+            self._orders[txn.a_id].popleft()
+            if txn.order in self.DEAF_AFTER:
+                self._deaf_until[txn.a_id] = now + self.DEAF_AFTER[txn.order]
+        if txn.order == "unlock":
+            self.scheduler.set_unlocked(txn.a_id, True)
+        elif txn.order == "lock":
+            self.scheduler.set_unlocked(txn.a_id, False)
+        self.scheduler.defer(txn.a_id, self._deaf_until[txn.a_id])
+        txn.complete(rsp)
+
+    def _negotiate(self, a_id):
+        """ Ask a_id whether it understands binary frames, in text """
+        rsp = self.exchange(a_id, "proto_binary")
+        if rsp == "confirm:proto_binary":
+            self._binary[a_id] = True
+        elif rsp:
+            self._binary[a_id] = False
+            # An old sketch blinks its leds on unknown orders
+            self._deaf_until[a_id] = time.monotonic() + 1.2
+            logging.warning(
+                f"RS485 arduino {a_id} doesn't understand binary frames,"
+                " the bus stays in text"
+            )
+        # No answer : try again next time
+        logging.info(f"RS485 arduino {a_id} talks binary : {self._binary.get(a_id)}")
+
+    def talks_binary(self):
+        """ :return: (bool) True once every arduino of the bus said it can """
+        with self._cond:
+            a_ids = list(self._orders)
+        return self.binary and bool(a_ids) and all(self._binary.get(a) for a in a_ids)
+
+    def _poll(self, a_id):
+        if self.binary and a_id not in self._binary:
+            self._negotiate(a_id)
+            self.scheduler.polled(a_id)
+            self.scheduler.defer(a_id, self._deaf_until[a_id])
+            return
+
+        rsp = self.exchange(a_id, "ask_for_new")
+        activity = rsp.startswith("new_read:") and rsp != "new_read:none"
+        self.scheduler.polled(a_id, activity=activity)
+        if activity:
+            self._inbox[a_id].append((time.monotonic(), rsp))
+            if a_id in self._listeners:
+                self._listeners[a_id]()
+
+    def exchange(self, a_id, order):
+        """
+        The send, wait and receive mechanisme via RS485 is implemented here
+
+        :a_id: (int) the id of arduino to poll
+        :order: (str) the message to poll arduino with, aka order
+        :return: (str) the answer without ';', empty on timeout or bus error
+        """
+        binary = order in codec.ORDERS and self.talks_binary()
+        if binary:
+            msg = codec.encode_order(a_id, order)
+        else:
+            msg = f"{a_id}:{order};".encode()
+        logging.info(f"<-- {msg}")
+
+        # Decoders are only used under the lock of the bus
+        decoder = self._frame_decoder if binary else self._text_decoder
+        start = time.perf_counter()
+        try:
+            rsp = self.bus.exchange(
+                msg, read=lambda ser: codec.read_message(ser, decoder)
+            )
+        except (serial.SerialException, OSError):
+            logging.exception(f"RS485 exchange with arduino {a_id} failed")
+            RS485_ERRORS.inc()
+            return ""
+        finally:
+            RS485_EXCHANGE_SECONDS.observe(time.perf_counter() - start)
+
+        logging.info(f"--> {rsp}")
+
+        if rsp is None:
+            RS485_NO_REPLY.inc()
+            return ""
+        if binary:
+            if rsp.address != a_id:
+                return ""
+            return codec.reply_text(rsp)
+        return rsp
+
+
 class Max485:
 
     # FIXME : only one pin is needed. To be updated on new hardware version
     RE_PIN = 23
     DE_PIN = 4
 
-    rsp_pending_for_id = None
-    pending_rsp = None
+    serial_bus = RS485Bus(
+        glob.RS485_PORT,
+        glob.RS485_BAUDRATE,
+        direction=make_direction(glob.RS485_DIRECTION, RE_PIN, DE_PIN),
+        timeout=glob.RS485_REPLY_TIMEOUT,
+        turnaround=glob.RS485_TURNAROUND,
+    )
+
+    scheduler = BusScheduler(
+        glob.RS485_ACTIVE_INTERVAL, glob.RS485_MAX_LATENCY, glob.RS485_ACTIVE_WINDOW
+    )
+
+    arbiter = BusArbiter(serial_bus, scheduler, binary=glob.RS485_BINARY)
+
+    @classmethod
+    def use_port(cls, port, direction=None):
+        """
+        Move the bus to another port, eg. a pty of okm.simulator
+
+        :direction: direction control to use with it, default unchanged
+        """
+        with cls.serial_bus.lock:
+            cls.serial_bus.close()
+            cls.serial_bus.port = port
+            if direction is not None:
+                cls.serial_bus.direction = direction
 
-    gpio.setmode(gpio.BCM)
+    @classmethod
+    def send_order(cls, a_id, msg, answer, timeout=2):
+        """
+        Queue msg ('order:xxx') for a_id, without blocking
 
-    # FIXME : This produces error. Maybe is not needed ...
-    gpio.setup(RE_PIN, gpio.OUT)
-    gpio.setup(DE_PIN, gpio.OUT)
+        :return: Transaction
+        """
+        _, order = msg.split(":")
+        return cls.arbiter.submit(a_id, order, answer, timeout)
 
     @classmethod
     def send_message(cls, a_id, msg):
         _, order = msg.split(":")
-        rsp = cls.poll(a_id, order)
-        cls.rsp_pending_for_id = a_id
-        cls.pending_rsp = rsp
+        cls.arbiter.submit(a_id, order, f"confirm:{order}")
 
     @classmethod
     def recv_message(cls, a_id):
-        if cls.rsp_pending_for_id is None:
-            # try to get new read for a_id
-            rsp = cls.ask_for_new_read(a_id)
-            return rsp
-        else:
-            if cls.rsp_pending_for_id == a_id:
-                # return pending answer
-                pending_rsp = cls.pending_rsp
-                cls.pending_rsp = None
-                cls.rsp_pending_for_id = None
-
-                return pending_rsp
-            else:
-                # this should not occur, since crawler waits for answer after an order
-                logging.fatal(
-                    f"Trying to read a message on a RS485 arduino {a_id}"
-                    f" while order in pending for {order_pending_for_id}"
-                )
-                return None
+        """ :return: (str) new read of a_id, None if there is none """
+        read = cls.arbiter.recv(a_id)
+        return None if read is None else read[1]
 
     @classmethod
     def ask_for_new_read(cls, a_id):
         """
-        Ask arduino with given id for new read over 485
-        
+        Ask arduino with given id for new read over 485, bypassing the arbiter
+
         :a_id: (int) id of arduino to ask
         """
         return cls.poll(a_id, "ask_for_new")
@@ -98,50 +764,32 @@ class Max485:
     @classmethod
     def poll(cls, a_id, order):
         """
-        The send, wait and receive mechanisme via RS485 is implemented here
+        Send order to a_id and return its answer, bypassing the arbiter
 
         :a_id: (int) the id of arduino to poll
         :order: (str) the message to poll arduino with, aka order
         """
+        return cls.arbiter.exchange(a_id, order)
 
-        with serial.Serial("/dev/ttyAMA0", 9600, timeout=2) as ser:
-
-            cls.set_send_mode()
-
-            msg = f"{a_id}:{order};"
-            msg = msg.encode()
-            ser.write(msg)
-            logging.info(f"<-- {msg}")
-            # wait 20ms to allow message to be transmitted
-            time.sleep(0.02)
-
-            # Wait for answer
-            cls.set_receive_mode()
-            rsp = ser.read_until(b";")
-
-            logging.info(f"--> {rsp}")
 
-            # FIXME Will not be needed when multiple devices
-            # wait 30ms to be shure device is ready to receive again
-            time.sleep(0.03)
-            time.sleep(0.1)
-
-        return rsp.decode().strip(";")
-
-    @classmethod
-    def set_send_mode(cls):
-        gpio.output(cls.RE_PIN, 1)
-        gpio.output(cls.DE_PIN, 1)
-
-    @classmethod
-    def set_receive_mode(cls):
-        gpio.output(cls.RE_PIN, 0)
-        gpio.output(cls.DE_PIN, 0)
+metrics.Gauge(
+    "okm_rs485_bus_utilization",
+    "Share of time the RS485 bus was busy",
+    func=Max485.serial_bus.utilization,
+)
+metrics.Gauge(
+    "okm_rs485_pending_orders",
+    "RS485 orders waiting for their confirmation",
+    func=lambda: sum(len(orders) for orders in Max485.arbiter._orders.values()),
+)
 
 
 if __name__ == "__main__":
 
+    Max485.arbiter.add(20)
     while True:
-        Max485.ask_for_new_read(20)
+        new_read = Max485.recv_message(20)
+        if new_read is not None:
+            print(new_read, Max485.scheduler.report(Max485.serial_bus))
 
-        time.sleep(0.5)
+        time.sleep(0.1)
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import bisect
+import http.server
+import logging
+import threading
+
+import okm.glob as glob
+
+"""
+Counters, gauges and latency histograms, served in Prometheus text format
+
+Opt-in : nothing is recorded until serve() is called, which main() does if
+glob.METRICS_PORT is set. Until then recording a value is a single test
+
+Usage :
+    from okm.backend import metrics
+
+    BADGES = metrics.Counter("okm_badges_total", "Badges read", ["outcome"])
+    BADGES.inc("unlocked")
+
+    curl http://127.0.0.1:<METRICS_PORT>/metrics
+
+Other modules may serve more on the same server with route()
+"""
+
+# Set by serve(). Instruments do nothing while False
+enabled = False
+
+# Seconds, from a reply on USB to an SD card commit
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Metric:
+    """
+    A metric and its values, one per set of label values
+
+    Instruments record in the calling thread, under a lock of their own
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=(), func=None):
+        """
+        :labels: [label name, ... ] values are given when recording
+        :func: callable() giving the value at scrape time instead, or
+            {(label values, ... ): value, ... }. Nothing to record then
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.func = func
+        # {(label values, ... ): value, ... }
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def samples(self):
+        """ :return: [(name suffix, {label: value}, value), ... ] """
+        if self.func is None:
+            with self._lock:
+                values = dict(self._values)
+            if not values and not self.labels:
+                # Nothing recorded yet, still worth a 0
+                values = {(): self._zero()}
+        else:
+            values = self.func()
+            if not isinstance(values, dict):
+                values = {(): values}
+        return [
+            ("", dict(zip(self.labels, key)), value) for key, value in values.items()
+        ]
+
+    def _zero(self):
+        return 0
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        if not enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        if not enabled:
+            return
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """ :value: (float) seconds """
+        if not enabled:
+            return
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = self._zero()
+            counts[i] += 1
+            counts[-1] += value
+
+    def _zero(self):
+        # Bucket counts, +Inf included, then sum
+        return [0] * (len(self.buckets) + 1) + [0]
+
+    def samples(self):
+        samples = []
+        for _, labels, counts in super().samples():
+            cumulated = 0
+            for le, count in zip(self.buckets + ("+Inf",), counts):
+                cumulated += count
+                samples.append(("_bucket", dict(labels, le=le), cumulated))
+            samples.append(("_sum", labels, counts[-1]))
+            samples.append(("_count", labels, cumulated))
+        return samples
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+class Registry:
+    """ Metrics by name, and their Prometheus text format """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """ A metric registered again under the same name replaces the former """
+        self._metrics[metric.name] = metric
+
+    def expose(self):
+        """ :return: (str) all metrics in Prometheus text format 0.0.4 """
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                samples = metric.samples()
+            except Exception:
+                logging.exception(f"Metric {metric.name} failed")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in samples:
+                if labels:
+                    labels = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                    labels = "{" + labels + "}"
+                else:
+                    labels = ""
+                lines.append(f"{metric.name}{suffix}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# {'/path': (content type, callable() giving the body), ... } served besides
+# /metrics, see route()
+routes = {}
+
+
+def route(path, func, content_type="application/json"):
+    """ Serve func() (str) on path too, eg. /traces of okm.backend.tracing """
+    routes[path] = (content_type, func)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path in ("/", "/metrics"):
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+            func = registry.expose
+        elif path in routes:
+            content_type, func = routes[path]
+        else:
+            self.send_error(404)
+            return
+        try:
+            body = func().encode()
+        except Exception:
+            logging.exception(f"Metrics : {path} failed")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Metrics : {format % args}")
+
+
+def serve(port=None, host=None):
+    """
+    Start recording, and serve metrics from a daemon thread
+
+    :port: default glob.METRICS_PORT
+    :host: default glob.METRICS_HOST
+    :return: the ThreadingHTTPServer, shutdown() it to stop
+    """
+    global enabled
+
+    if port is None:
+        port = glob.METRICS_PORT
+    server = http.server.ThreadingHTTPServer(
+        (host or glob.METRICS_HOST, port), MetricsHandler
+    )
+    server.daemon_threads = True
+    threading.Thread(name="Metrics", target=server.serve_forever, daemon=True).start()
+    enabled = True
+    host, port = server.server_address[:2]
+    logging.info(f"Metrics served on http://{host}:{port}/metrics")
+    return server
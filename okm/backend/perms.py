@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import logging
+import threading
+
+from okm.backend import metrics
+from okm.utils import DbCursor, Singleton
+
+"""
+In-memory index of permissions, for the badge authorization path of the crawler
+
+The DB stays the reference. The index is loaded once, then patched by whoever
+writes perms (see okm.gui.mainwindow), so the crawler never hits the DB to
+answer a badge
+"""
+
+
+class PermCache(metaclass=Singleton):
+    def __init__(self):
+
+        # {'key_id': {'arduino_id', ... }, ... }
+        # None until loaded
+        self._index = None
+        self._lock = threading.Lock()
+
+        # Lookups answered by the index / that needed the DB
+        self.hits = 0
+        self.misses = 0
+
+        metrics.Counter(
+            "okm_perm_cache_hits_total",
+            "Badges answered by the permission cache",
+            func=lambda: self.hits,
+        )
+        metrics.Counter(
+            "okm_perm_cache_misses_total",
+            "Badges of keys missing from the permission cache, asked to the DB",
+            func=lambda: self.misses,
+        )
+        metrics.Gauge(
+            "okm_perm_cache_keys",
+            "Keys in the permission cache",
+            func=lambda: len(self._index or ()),
+        )
+
+    @staticmethod
+    def _read_db(key_id=None):
+        """
+        Read permissions from DB
+
+        :key_id: (str) only read this key. All keys if None
+        :return: {'key_id': {'arduino_id', ... }, ... }
+        """
+        # Keys without any permission are known too : start from keys
+        sql = "SELECT key_id, arduino_id FROM keys LEFT JOIN perms USING (key_id)"
+        with DbCursor() as c:
+            if key_id is None:
+                c.execute(sql)
+            else:
+                c.execute(sql + " WHERE key_id=?", (key_id,))
+            rows = c.fetchall()
+
+        index = {}
+        for row in rows:
+            allowed = index.setdefault(row["key_id"], set())
+            if row["arduino_id"] is not None:
+                allowed.add(row["arduino_id"])
+        return index
+
+    def reload(self):
+        """
+        Force a full reload of the index from DB
+
+        :return: the new index
+        """
+        index = self._read_db()
+        with self._lock:
+            self._index = index
+        logging.info(f"Permission cache loaded with {len(index)} keys")
+        return index
+
+    def allowed_arduinos(self, key_id):
+        """
+        Arduinos the key is allowed to open
+
+        :return: ({'arduino_id', ... }) or None if the key is unknown
+        """
+        # Looked up in this index, even if another thread reloads meanwhile
+        index = self._index
+        if index is None:
+            index = self.reload()
+
+        with self._lock:
+            allowed = index.get(key_id)
+            if allowed is not None:
+                self.hits += 1
+                return allowed
+            self.misses += 1
+
+        # Not indexed : might have been written behind our back. Ask DB
+        allowed = self._read_db(key_id).get(key_id)
+        if allowed is not None:
+            self.update(key_id, allowed)
+        return allowed
+
+    def update(self, key_id, arduino_ids):
+        """
+        Patch the index after a write to perms
+
+        :arduino_ids: iterable of arduino ids the key is now allowed to open
+        """
+        with self._lock:
+            if self._index is not None:
+                self._index[key_id] = set(arduino_ids)
+
+    def stats(self):
+        """ :return: {'keys': int, 'hits': int, 'misses': int} """
+        with self._lock:
+            return {
+                "keys": 0 if self._index is None else len(self._index),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def verify(self):
+        """
+        Compare index with DB
+
+        :return: ({'key_id', ... }) keys whose cached permissions differ
+        """
+        db = self._read_db()
+        with self._lock:
+            index = dict(self._index or {})
+        return {k for k in db.keys() | index.keys() if db.get(k) != index.get(k)}
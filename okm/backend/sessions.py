@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import collections
+import unicodedata
+
+import okm.glob as glob
+from okm.utils import DbCursor
+
+"""
+Read access to sessions (see sessions table in okm.migrations) for the views
+
+Sessions are read page by page, so showing the recap doesn't depend on how much
+history we have. Sorting is done by SQL
+"""
+
+
+# Duration in seconds, NULL while session is open or when end is unknown
+DURATION = "CAST((julianday(end) - julianday(start)) * 86400 AS INTEGER)"
+
+
+def _fold(text):
+    """ Lower case, without accents """
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+class SessionPages:
+    """
+    Finished sessions, sorted and paged
+
+    Pages are fetched with keyset pagination (WHERE (sort, id) > last row of
+    previous page), which is an index seek whatever the page number. OFFSET is
+    only used when jumping to a page whose previous one isn't cached
+    """
+
+    PAGE_SIZE = 200
+
+    # Number of pages kept in memory
+    MAX_PAGES = 20
+
+    # {'sort_key': 'SQL expression', ... } NULLs would break keyset comparisons
+    SORT_KEYS = {
+        "name": "COALESCE(keys.name, '')",
+        "surname": "COALESCE(keys.surname, '')",
+        "arduino_id": "sessions.arduino_id",
+        "start": "sessions.start",
+        "end": "COALESCE(sessions.end, '')",
+        "duration": f"COALESCE({DURATION}, -1)",
+    }
+
+    def __init__(self, sort="start", ascending=False):
+        self.sort = sort
+        self.ascending = ascending
+
+        # Extra condition on sessions, see set_filter()
+        self._filter_sql = ""
+        self._filter_params = ()
+
+        # {page_number: [sqlite3.Row, ... ], ... } least recently used first
+        self._pages = collections.OrderedDict()
+        self._count = None
+
+    def _where(self):
+        return "WHERE status != 'open'" + self._filter_sql
+
+    def set_sort(self, sort, ascending):
+        if sort not in self.SORT_KEYS:
+            raise ValueError(f"Can't sort sessions by {sort}")
+        self.sort = sort
+        self.ascending = ascending
+        self.reset()
+
+    def set_filter(self, sql="", params=()):
+        """
+        Only keep sessions matching sql
+
+        :sql: (str) condition on sessions and keys columns, eg. "arduino_id = ?"
+        """
+        self._filter_sql = f" AND ({sql})" if sql else ""
+        self._filter_params = tuple(params)
+        self.reset()
+
+    def set_search(self, text):
+        """
+        Only keep sessions matching every word of text, as a prefix of name,
+        surname or email of the key (full text index), or in the description
+        of the arduino. Accents and case are ignored
+        """
+        sql = []
+        params = []
+        for word in text.split():
+            # Quoted, a word is never understood as FTS5 syntax
+            fts_query = '"' + word.replace('"', '""') + '"*'
+
+            word = _fold(word)
+            a_ids = [
+                a_id for a_id, desc in glob.ARDUINOS_DESC.items() if word in _fold(desc)
+            ]
+
+            sql.append(
+                "key_id IN (SELECT key_id FROM keys_fts WHERE keys_fts MATCH ?)"
+                " OR arduino_id IN (" + ", ".join("?" * len(a_ids)) + ")"
+            )
+            params += [fts_query, *a_ids]
+
+        self.set_filter(" AND ".join(f"({s})" for s in sql), params)
+
+    def reset(self):
+        """ Forget cached pages, eg. when sessions were added """
+        self._pages.clear()
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            with DbCursor() as c:
+                c.execute(
+                    "SELECT COUNT(*) FROM sessions JOIN keys USING (key_id) "
+                    + self._where(),
+                    self._filter_params,
+                )
+                self._count = c.fetchone()[0]
+        return self._count
+
+    def row(self, n):
+        """ :return: (sqlite3.Row) nth session in current order """
+        page_number, i = divmod(n, self.PAGE_SIZE)
+
+        page = self._pages.get(page_number)
+        if page is None:
+            page = self._fetch(page_number)
+            self._pages[page_number] = page
+            while len(self._pages) > self.MAX_PAGES:
+                self._pages.popitem(last=False)
+        else:
+            self._pages.move_to_end(page_number)
+
+        return page[i]
+
+    def _fetch(self, page_number):
+        sort = self.SORT_KEYS[self.sort]
+        direction = "ASC" if self.ascending else "DESC"
+
+        sql = (
+            f"SELECT sessions.*, keys.name, keys.surname, {DURATION} AS duration,"
+            f" {sort} AS sort_value"
+            " FROM sessions JOIN keys USING (key_id) " + self._where()
+        )
+        params = self._filter_params
+
+        previous = self._pages.get(page_number - 1)
+        if previous:
+            # Keyset : continue right after last row of previous page
+            last = previous[-1]
+            op = ">" if self.ascending else "<"
+            sql += f" AND ({sort}, sessions.id) {op} (?, ?)"
+            params += (last["sort_value"], last["id"])
+            offset = 0
+        else:
+            offset = page_number * self.PAGE_SIZE
+
+        sql += f" ORDER BY {sort} {direction}, sessions.id {direction} LIMIT ? OFFSET ?"
+        params += (self.PAGE_SIZE, offset)
+
+        with DbCursor() as c:
+            c.execute(sql, params)
+            return c.fetchall()
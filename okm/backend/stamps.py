@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import collections
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+
+import okm.glob as glob
+from okm.backend import metrics
+from okm.utils import DbCursor, Singleton
+
+"""
+Write-behind of stamps : the crawler hands them over and goes on, a writer
+thread commits them, several at once when they come in faster than commits
+
+Each stamp is first appended to a journal (glob.STAMP_JOURNAL), emptied once
+everything in it is committed. If the DB can't be written (locked, ...) the
+journal is synced to disk and the writer tries again later. Whatever is left
+in it, after a crash or a stop, is replayed when StampWriter starts. A stamp
+the DB refuses for good (bad data) is set aside in <journal>.rejected
+
+Usage :
+    StampWriter().submit(key_id, a_id, timestamp, "unlocked")
+"""
+
+STAMPS_COMMITTED = metrics.Counter("okm_stamps_committed_total", "Stamps in the DB")
+STAMP_BATCH_SIZE = metrics.Histogram(
+    "okm_stamp_batch_size", "Stamps per commit", buckets=(1, 2, 5, 10, 20, 50, 100)
+)
+STAMP_FAILURES = metrics.Counter(
+    "okm_stamp_commit_failures_total", "Stamp commits failed, retried later"
+)
+STAMPS_REJECTED = metrics.Counter(
+    "okm_stamps_rejected_total", "Stamps that can't be written, set aside"
+)
+
+# lock_state : 'unlocked' | 'locked'
+# timestamp : (str) as sqlite3 stores datetimes
+# replayed : (bool) from the journal of a former run, maybe committed already
+Stamp = collections.namedtuple(
+    "Stamp", ["key_id", "a_id", "timestamp", "lock_state", "replayed"]
+)
+
+
+def apply(c, stamp):
+    """ Write stamp with cursor c, and open or close its session """
+    if stamp.replayed:
+        c.execute(
+            "SELECT 1 FROM stamps WHERE key_id = ? AND arduino_id = ?"
+            " AND timestamp = ? AND lock_state = ?",
+            stamp[:4],
+        )
+        if c.fetchone() is not None:
+            return
+
+    c.execute("INSERT INTO stamps VALUES (?, ?, ?, ?)", stamp[:4])
+    if stamp.lock_state == "unlocked":
+        c.execute(
+            "INSERT INTO sessions (key_id, arduino_id, start, status)"
+            " VALUES (?, ?, ?, 'open')",
+            stamp[:3],
+        )
+    else:
+        c.execute(
+            "UPDATE sessions SET end = ?, status = 'closed'"
+            " WHERE arduino_id = ? AND key_id = ? AND status = 'open'",
+            (stamp.timestamp, stamp.a_id, stamp.key_id),
+        )
+
+
+class StampWriter(metaclass=Singleton):
+    """ Journal and writer thread of stamps """
+
+    # Stamps committed at most at once
+    BATCH_MAX = 100
+
+    def __init__(self, path=None):
+        """ :path: of the journal, default glob.STAMP_JOURNAL or next to the DB """
+        if path is None:
+            path = glob.STAMP_JOURNAL or glob.DB_PATH.with_suffix(".journal")
+        self.path = path
+
+        self._queue = queue.Queue()
+        # Stamps of the journal not committed yet. It is emptied at 0
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+
+        self._replay()
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+        metrics.Gauge(
+            "okm_stamps_pending", "Stamps not committed yet", func=lambda: self._pending
+        )
+
+        self._thread = threading.Thread(
+            name="StampWriter", target=self.loop, daemon=True
+        )
+        self._thread.start()
+
+    def _replay(self):
+        """ Queue stamps left in the journal by a former run """
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                stamp = Stamp(*json.loads(line), replayed=True)
+            except (ValueError, TypeError):
+                # Last line of a crash, half written
+                logging.warning(f"Stamp journal : skip {line!r}")
+                continue
+            self._queue.put(stamp)
+            self._pending += 1
+        if self._pending:
+            logging.warning(f"Stamp journal : replay {self._pending} stamp(s)")
+
+    def submit(self, key_id, a_id, timestamp, lock_state):
+        """
+        Journal the stamp and queue it for the writer. Doesn't wait for the DB
+
+        :timestamp: (datetime)
+        :lock_state: 'unlocked' | 'locked'
+        """
+        stamp = Stamp(key_id, a_id, timestamp.isoformat(" "), lock_state, False)
+        line = json.dumps(stamp[:4]) + "\n"
+        with self._cond:
+            # Not synced : survives a crash of okm, not a power cut. Synced
+            # as soon as the DB fails, see loop()
+            os.write(self._fd, line.encode())
+            self._pending += 1
+            self._queue.put(stamp)
+
+    def loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.BATCH_MAX:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # None only wakes us up, see stop()
+            batch = [stamp for stamp in batch if stamp is not None]
+
+            count = len(batch)
+            while batch:
+                try:
+                    self._commit(batch)
+                    break
+                except sqlite3.OperationalError:
+                    # Locked, disk full, ... worth a retry
+                    logging.exception(f"Can't write {len(batch)} stamp(s), retry")
+                except Exception:
+                    # Some stamp will never get in : write the others
+                    logging.exception(f"Can't write {len(batch)} stamp(s)")
+                    batch = self._commit_each(batch)
+                    if not batch:
+                        break
+                STAMP_FAILURES.inc()
+                # Durable until they get in the DB, maybe at next start
+                self._sync()
+                if self._stop.wait(glob.STAMP_RETRY_DELAY):
+                    return
+
+            with self._cond:
+                self._pending -= count
+                if self._pending == 0:
+                    # Everything journaled is in the DB
+                    try:
+                        os.ftruncate(self._fd, 0)
+                    except OSError:
+                        logging.exception("Can't empty the stamp journal")
+                    self._cond.notify_all()
+
+            if self._stop.is_set() and self._queue.empty():
+                return
+
+    def _commit(self, batch):
+        with DbCursor() as c:
+            for stamp in batch:
+                apply(c, stamp)
+        STAMPS_COMMITTED.inc(amount=len(batch))
+        STAMP_BATCH_SIZE.observe(len(batch))
+
+    def _commit_each(self, batch):
+        """
+        Commit stamps one by one. Those which can't ever be are moved to the
+        rejected journal (.rejected next to the journal), to be fixed by hand
+
+        :return: [Stamp, ... ] those worth a retry
+        """
+        retry = []
+        for stamp in batch:
+            try:
+                self._commit([stamp])
+            except sqlite3.OperationalError:
+                retry.append(stamp)
+            except Exception:
+                logging.exception(f"Reject stamp {stamp}")
+                STAMPS_REJECTED.inc()
+                try:
+                    with open(f"{self.path}.rejected", "a") as f:
+                        f.write(json.dumps(stamp[:4]) + "\n")
+                except (OSError, TypeError):
+                    logging.exception(f"Can't set stamp {stamp} aside")
+        return retry
+
+    def _sync(self):
+        try:
+            os.fsync(self._fd)
+        except OSError:
+            logging.exception("Can't sync the stamp journal")
+
+    def flush(self, timeout=None):
+        """ Wait for every stamp submitted to be committed :return: (bool) """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+
+    def stop(self, timeout=5):
+        """
+        Commit what is queued, for timeout seconds at most. What is left is
+        replayed at next start
+        """
+        self._stop.set()
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._sync()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import threading
+import time
+import urllib.request
+
+import okm.glob as glob
+from okm.backend import metrics
+from okm.utils import Singleton
+
+"""
+Per badge traces, to tell where the time went when a door took ages
+
+The crawler starts a Trace for each badge read and marks each stage :
+- received : the reader's message came in (transport thread)
+- picked : the crawler took it, queued before
+- permission : permissions resolved
+- order_sent : order sent to the reader, and maybe sent again
+- confirmed : the reader confirmed it, or no_confirm if it didn't in time
+- stamped : the stamp is journaled, the DB commit comes behind (see
+  okm.backend.stamps and its metrics)
+
+Finished traces go to a ring buffer of the glob.TRACE_BUFFER_SIZE last badges
+(Tracer().slowest()), served as JSON lines on /traces of the metrics server
+(okm.backend.metrics), and to glob.TRACE_FILE if set
+
+Usage : python -m okm.backend.tracing [trace.jsonl | URL] [-n 10] [--last 1000]
+prints the slowest of the last badges, stage by stage. From TRACE_FILE by
+default, else from /traces of the running okm if METRICS_PORT is set
+"""
+
+STAGES = [
+    "received",
+    "picked",
+    "permission",
+    "order_sent",
+    "confirmed",
+    "no_confirm",
+    "stamped",
+]
+
+
+class Trace:
+    """ Stages of one badge, as monotonic times """
+
+    __slots__ = ("a_id", "key_id", "timestamp", "outcome", "stages")
+
+    def __init__(self, a_id, key_id, received_at=None):
+        """
+        :received_at: (float) time.monotonic() the message came in, default now
+        """
+        self.a_id = a_id
+        self.key_id = key_id
+        self.timestamp = datetime.datetime.now()
+        # 'unlocked' | 'locked' | 'denied' | 'unknown_key' | 'failed' | None
+        self.outcome = None
+        # [(stage, monotonic time), ... ] in order
+        self.stages = []
+        self.mark("received", received_at)
+        self.mark("picked")
+
+    def mark(self, stage, at=None):
+        self.stages.append((stage, time.monotonic() if at is None else at))
+
+    @property
+    def total(self):
+        """ (float) seconds from the first to the last stage """
+        return self.stages[-1][1] - self.stages[0][1]
+
+    def durations(self):
+        """ :return: [(stage, seconds since the previous stage), ... ] """
+        durations = []
+        previous = self.stages[0][1]
+        for stage, at in self.stages:
+            durations.append((stage, at - previous))
+            previous = at
+        return durations
+
+    def to_dict(self):
+        return {
+            "a_id": self.a_id,
+            "key_id": self.key_id,
+            "timestamp": self.timestamp.isoformat(),
+            "outcome": self.outcome,
+            "total_ms": self.total * 1000,
+            "stages_ms": [[s, d * 1000] for s, d in self.durations()],
+        }
+
+
+class Tracer(metaclass=Singleton):
+    """ Finished traces : ring buffer of the last ones, and trace file """
+
+    def __init__(self, size=None, path=None):
+        """
+        :size: (int) traces kept, default glob.TRACE_BUFFER_SIZE
+        :path: trace file, default glob.TRACE_FILE
+        """
+        self.traces = collections.deque(maxlen=size or glob.TRACE_BUFFER_SIZE)
+        self._lock = threading.Lock()
+        self._file = None
+        path = path or glob.TRACE_FILE
+        if path is not None:
+            # Line buffered : a trace is on disk once finished
+            self._file = open(path, "a", buffering=1)
+
+    def finish(self, trace):
+        """ Keep trace, and write it to the trace file """
+        self.traces.append(trace)
+        if self._file is None:
+            return
+        line = json.dumps(trace.to_dict()) + "\n"
+        with self._lock:
+            try:
+                self._file.write(line)
+            except OSError as e:
+                logging.error(f"Can't write trace : {e}")
+
+    def slowest(self, n=10):
+        """ :return: [Trace, ... ] n slowest of the ring buffer, slowest first """
+        return sorted(list(self.traces), key=lambda t: t.total, reverse=True)[:n]
+
+
+def traces_json():
+    """ :return: (str) traces of the ring buffer, as JSON lines """
+    return "".join(json.dumps(t.to_dict()) + "\n" for t in list(Tracer().traces))
+
+
+metrics.route("/traces", traces_json, "application/x-ndjson")
+
+
+def load(source, last=None):
+    """
+    :source: trace file, or URL of /traces
+    :return: [dict, ... ] traces, the last ones only
+    """
+    if source.startswith(("http://", "https://")):
+        with urllib.request.urlopen(source, timeout=5) as rsp:
+            lines = rsp.read().decode().splitlines()
+    else:
+        with open(source) as f:
+            lines = f.readlines()
+    traces = collections.deque(maxlen=last)
+    for line in lines:
+        if line.strip():
+            traces.append(json.loads(line))
+    return list(traces)
+
+
+def format_traces(traces):
+    """ :traces: [dict, ... ] as Trace.to_dict() :return: (str) a table """
+    lines = [
+        f"{'timestamp':<20}{'a_id':>6} {'key_id':<10}{'outcome':<12}{'total':>8}"
+        + "".join(f"{stage:>11}" for stage in STAGES[1:])
+    ]
+    for t in traces:
+        # A stage may be there several times, eg. order_sent on retries
+        stages = collections.defaultdict(float)
+        for stage, duration in t["stages_ms"]:
+            stages[stage] += duration
+        lines.append(
+            f"{t['timestamp'][:19]:<20}{t['a_id']:>6} {t['key_id']:<10}"
+            f"{t['outcome'] or '-':<12}{t['total_ms']:>8.1f}"
+            + "".join(
+                f"{stages[stage]:>11.1f}" if stage in stages else f"{'-':>11}"
+                for stage in STAGES[1:]
+            )
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("source", nargs="?", help="Trace file or URL of /traces")
+    parser.add_argument("-n", type=int, default=10, help="Badges to print")
+    parser.add_argument("--last", type=int, default=1000, help="Badges to look at")
+    args = parser.parse_args()
+
+    source = args.source or glob.TRACE_FILE
+    if source is None and glob.METRICS_PORT is not None:
+        source = f"http://{glob.METRICS_HOST}:{glob.METRICS_PORT}/traces"
+    if source is None:
+        parser.error("No source given, and neither TRACE_FILE nor METRICS_PORT set")
+    traces = load(source, args.last)
+    traces.sort(key=lambda t: t["total_ms"], reverse=True)
+    print("Stage durations (ms) since the previous stage")
+    print(format_traces(traces[: args.n]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import logging
+import os
+import queue
+import selectors
+import threading
+
+from okm.backend.codec import TextDecoder
+from okm.utils import Singleton
+
+"""
+Serial transport shared by all USB arduinos
+
+A single thread waits on every serial port at once with selectors (epoll on
+the Pi). Whatever bytes are available are read straight into the buffer of a
+TextDecoder, cut into messages on ';' and handed to the device. Writes are done
+right away by the caller
+"""
+
+
+class SerialConnection:
+    """ A registered serial port and its partial incoming message """
+
+    # A message longer than that means we lost a ';'. Drop what we have
+    MAX_MESSAGE = 1024
+    # Bytes read at once
+    CHUNK = 4096
+
+    def __init__(self, ser, on_message):
+        self.ser = ser
+        self.fd = ser.fileno()
+        self.on_message = on_message
+        self.write_lock = threading.Lock()
+        self.decoder = TextDecoder(max_message=self.MAX_MESSAGE)
+        self._errors = 0
+
+    def read(self):
+        """
+        Read what is available, and dispatch every complete message
+
+        :return: (int) bytes read, 0 if the port is closed
+        """
+        count = self.decoder.fill(
+            lambda view: os.readv(self.fd, [view]), size=self.CHUNK
+        )
+        self._dispatch(self.decoder.decode())
+        return count
+
+    def write(self, data):
+        """
+        Write data (bytes) now, from the calling thread
+
+        Straight to the fd : pyserial select()s on each write, which is slower
+        and fails for fds above 1024, with hundreds of ports
+        """
+        with self.write_lock:
+            view = memoryview(data)
+            while view:
+                try:
+                    view = view[os.write(self.fd, view) :]
+                except BlockingIOError:
+                    # Output buffer full, let pyserial wait for room
+                    self.ser.write(view)
+                    return
+
+    def feed(self, chunk):
+        """ Add bytes read, and dispatch every complete message """
+        self._dispatch(self.decoder.feed(chunk))
+
+    def _dispatch(self, messages):
+        if self.decoder.errors != self._errors:
+            self._errors = self.decoder.errors
+            logging.warning(f"Drop bytes without ';' : {self.ser}")
+        for msg in messages:
+            self.on_message(msg)
+
+
+class USBTransport(metaclass=Singleton):
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+
+        # Registrations are done by the I/O thread. Others queue them here and
+        # wake it up through the pipe
+        self._requests = queue.SimpleQueue()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+        self.loop_flag = threading.Event()
+        # Daemon : arduinos close their port in stop(), the thread has nothing
+        # left to clean up
+        t = threading.Thread(name="USBTransport", target=self.loop, daemon=True)
+        t.start()
+
+    def register(self, ser, on_message):
+        """
+        Start reading ser
+
+        :ser: open serial.Serial
+        :on_message: callable(str) called from I/O thread for each message,
+            without the trailing ';'
+        :return: SerialConnection to pass to write() and unregister()
+        """
+        conn = SerialConnection(ser, on_message)
+        self._request(self._selector.register, conn.fd, selectors.EVENT_READ, conn)
+        return conn
+
+    def unregister(self, conn):
+        self._request(self._selector.unregister, conn.fd)
+
+    def write(self, conn, data):
+        """ Write data (bytes) now, from the calling thread """
+        conn.write(data)
+
+    def stop(self):
+        self.loop_flag.set()
+        self._wakeup()
+
+    def _request(self, func, *args):
+        self._requests.put((func, args))
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, b"\0")
+        except BlockingIOError:
+            # Pipe full : I/O thread has plenty of wake ups pending already
+            pass
+
+    def loop(self):
+
+        while not self.loop_flag.is_set():
+            for key, events in self._selector.select():
+
+                if key.data is None:
+                    # Woken up : apply pending (un)registrations
+                    try:
+                        os.read(self._wakeup_r, 4096)
+                    except BlockingIOError:
+                        pass
+                    while not self._requests.empty():
+                        func, args = self._requests.get()
+                        try:
+                            func(*args)
+                        except (KeyError, ValueError) as e:
+                            logging.warning(f"USBTransport : {e}")
+                    continue
+
+                conn = key.data
+                try:
+                    count = conn.read()
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    count = 0
+                    logging.error(f"USBTransport : error reading {conn.ser} : {e}")
+                except Exception:
+                    logging.exception(f"USBTransport : can't handle {conn.ser}")
+                    continue
+
+                if not count:
+                    # Device unplugged
+                    logging.error(f"USBTransport : {conn.ser} closed")
+                    self._selector.unregister(conn.fd)
+
+        print("end of USBTransport loop")
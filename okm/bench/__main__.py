@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import datetime
+import itertools
+import json
+import platform
+import subprocess
+import sys
+
+"""
+End to end benchmark suite : okm.bench.e2e for each scenario, in its own
+process, results in one JSON file to diff between releases
+
+Scenarios are all combinations of the given reader counts, rates and engines
+
+Usage :
+python -m okm.bench [--usb 10 100] [--rs485 0 8] [--output bench.json]
+python -m okm.bench --compare old.json  # exit code 1 on regressions
+"""
+
+# Measures compared with --compare, (path in results, True if higher is better)
+COMPARED = [
+    (("latency_ms", "p50"), False),
+    (("latency_ms", "p95"), False),
+    (("latency_ms", "p99"), False),
+    (("badges_per_s",), True),
+    (("cpu_ms_per_badge",), False),
+    (("db_write_ms", "p95"), False),
+]
+
+
+def scenarios(args):
+    """ :return: [[e2e arguments], ... ] """
+    for usb, rs485, rate, engine in itertools.product(
+        args.usb, args.rs485, args.rate, args.engine
+    ):
+        if not usb and not rs485:
+            continue
+        argv = [
+            f"--usb={usb}",
+            f"--rs485={rs485}",
+            f"--rate={rate}",
+            f"--engine={engine}",
+            f"--duration={args.duration}",
+            f"--seed={args.seed}",
+        ]
+        if args.binary:
+            argv.append("--binary")
+        yield argv
+
+
+def run(argv, verbose=False):
+    """ :return: (dict) result of okm.bench.e2e, None if it failed """
+    proc = subprocess.run(
+        [sys.executable, "-m", "okm.bench.e2e"] + argv,
+        stdout=subprocess.PIPE,
+        stderr=None if verbose else subprocess.DEVNULL,
+        text=True,
+    )
+    if proc.returncode:
+        print(f"{' '.join(argv)} failed ({proc.returncode})", file=sys.stderr)
+        return None
+    return json.loads(proc.stdout.splitlines()[-1])
+
+
+def key(result):
+    """ :return: what identifies a scenario between two runs """
+    return json.dumps(result["scenario"], sort_keys=True)
+
+
+def measure(result, path):
+    for name in path:
+        if result is None:
+            return None
+        result = result.get(name)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print measures which got worse than baseline by more than tolerance
+
+    :return: (int) number of regressions
+    """
+    old_results = {key(r): r for r in baseline["results"]}
+    regressions = 0
+    for result in results:
+        old = old_results.get(key(result))
+        if old is None:
+            continue
+        for path, higher_is_better in COMPARED:
+            new_value, old_value = measure(result, path), measure(old, path)
+            if not new_value or not old_value:
+                continue
+            ratio = new_value / old_value
+            if higher_is_better:
+                ratio = 1 / ratio
+            if ratio > 1 + tolerance:
+                regressions += 1
+                print(
+                    f"REGRESSION {'.'.join(path)} {old_value:.2f} -> {new_value:.2f}"
+                    f" : {result['scenario']}"
+                )
+    return regressions
+
+
+def print_result(result):
+    s = result["scenario"]
+    latency = result["latency_ms"] or {}
+    print(
+        f"{s['engine']:<8}{s['usb']:>5}{s['rs485']:>7}{s['rate']:>6}"
+        f"{latency.get('p50', 0):>8.1f}{latency.get('p95', 0):>8.1f}"
+        f"{latency.get('p99', 0):>8.1f}{result['badges_per_s']:>8.1f}"
+        f"{result['cpu_ms_per_badge']:>9.1f}"
+        f"{(result['db_write_ms'] or {}).get('p95', 0):>8.2f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--usb", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--rs485", type=int, nargs="+", default=[0, 8])
+    parser.add_argument("--binary", action="store_true", help="RS485 frames")
+    parser.add_argument("--rate", type=float, nargs="+", default=[0.2])
+    parser.add_argument(
+        "--engine", nargs="+", choices=["threads", "asyncio"], default=["threads"]
+    )
+    parser.add_argument("--duration", type=float, default=10, help="Seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file of the results")
+    parser.add_argument("--compare", help="JSON file of former results")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Of --compare")
+    parser.add_argument("--verbose", action="store_true", help="Show okm logs")
+    args = parser.parse_args()
+
+    print(
+        f"{'engine':<8}{'usb':>5}{'rs485':>7}{'rate':>6}{'p50':>8}{'p95':>8}"
+        f"{'p99':>8}{'badge/s':>8}{'cpu ms/b':>9}{'db p95':>8}"
+    )
+    results = []
+    for argv in scenarios(args):
+        result = run(argv, args.verbose)
+        if result is not None:
+            results.append(result)
+            print_result(result)
+
+    report = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
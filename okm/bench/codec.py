@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""
+Text protocol against binary frames of okm.backend.codec : bytes on the wire
+and bus time at 9600 baud for each exchange, and encode/decode speed on the Pi
+side
+
+The decoders are fuzzed by tests/test_codec.py
+
+Usage : python -m okm.bench.codec [-n 100000]
+"""
+
+import argparse
+import time
+
+from okm.backend import codec
+
+# 8N1 : 10 bits on the wire per byte
+BYTE_TIME = 10 / 9600
+
+# (order, reply) of a typical exchange, in text
+EXCHANGES = [
+    ("ask_for_new", "new_read:none"),
+    ("ask_for_new", "new_read:d7425919"),
+    ("unlock", "confirm:unlock"),
+]
+
+
+def text_wire(a_id, order, reply):
+    return f"{a_id}:{order};".encode(), f"{reply};".encode()
+
+
+def binary_wire(a_id, order, reply):
+    if reply.startswith("new_read:"):
+        uid = reply.split(":")[1]
+        payload = b"" if uid == "none" else bytes.fromhex(uid)
+        frame = codec.encode(a_id, codec.NEW_READ, payload)
+    else:
+        frame = codec.encode(a_id, codec.CONFIRM, bytes((codec.ORDERS[order],)))
+    return codec.encode_order(a_id, order), frame
+
+
+def wire_sizes():
+    print(f"{'exchange':<40}{'text':>16}{'binary':>16}")
+    for order, reply in EXCHANGES:
+        sizes = []
+        for wire in (text_wire, binary_wire):
+            request, answer = wire(20, order, reply)
+            size = len(request) + len(answer)
+            sizes.append(f"{size} B {size * BYTE_TIME * 1000:.1f} ms")
+        print(f"{order + ' -> ' + reply:<40}{sizes[0]:>16}{sizes[1]:>16}")
+
+
+def speed(n):
+    text_reply = b"new_read:d7425919;"
+    binary_reply = codec.encode(20, codec.NEW_READ, bytes.fromhex("d7425919"))
+
+    start = time.perf_counter()
+    for _ in range(n):
+        f"{20}:{'ask_for_new'};".encode()
+        text_reply.decode().strip(";").split(":")
+    text = n / (time.perf_counter() - start)
+
+    decoder = codec.FrameDecoder()
+    start = time.perf_counter()
+    for _ in range(n):
+        codec.encode_order(20, "ask_for_new")
+        codec.reply_text(decoder.feed(binary_reply)[0])
+    binary = n / (time.perf_counter() - start)
+
+    print(f"{'text encode+decode':<40}{text:>16.0f} /s")
+    print(f"{'binary encode+decode':<40}{binary:>16.0f} /s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=100000, help="Encode/decode loops")
+    args = parser.parse_args()
+
+    wire_sizes()
+    print()
+    speed(args.n)
+
+
+if __name__ == "__main__":
+    main()
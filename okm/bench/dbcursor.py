@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""
+Queries/sec of DbCursor against the former implementation, which opened a new
+connection for each query
+
+Usage : python -m okm.bench.dbcursor [-n 2000]
+"""
+
+import argparse
+import datetime
+import shutil
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+import okm.glob as glob
+from okm.utils import DbCursor
+
+
+class LegacyDbCursor:
+    """ DbCursor as it was : connect, query, commit and close each time """
+
+    def __enter__(self):
+        self.conn = sqlite3.connect(glob.DB_PATH)
+        self.conn.row_factory = sqlite3.Row
+        c = self.conn.cursor()
+
+        return c
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.commit()
+        self.conn.close()
+
+
+def read_perm(cursor_class):
+    """ What the crawler does for each badge """
+    with cursor_class() as c:
+        c.execute("SELECT * FROM perms WHERE key_id=?", ("1",))
+        c.fetchone()
+
+
+def write_stamp(cursor_class):
+    """ What the crawler does for each lock/unlock """
+    with cursor_class() as c:
+        c.execute(
+            "INSERT INTO stamps VALUES (?, ?, ?, ?)",
+            ("1", 10, datetime.datetime.now(), "locked"),
+        )
+
+
+def run(func, cursor_class, n):
+    """ :return: (float) queries per second """
+    start = time.perf_counter()
+    for _ in range(n):
+        func(cursor_class)
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=2000, help="Queries per case")
+    args = parser.parse_args()
+
+    src_db = glob.DB_PATH
+    tmp_dir = Path(tempfile.mkdtemp())
+
+    print(f"{'case':<12}{'legacy q/s':>14}{'pooled q/s':>14}{'speedup':>10}")
+    for func in (read_perm, write_stamp):
+        results = []
+        for cursor_class in (LegacyDbCursor, DbCursor):
+            # Fresh copy for each run, so both start from the same state
+            name = f"{func.__name__}_{cursor_class.__name__}.sqlite3"
+            glob.DB_PATH = tmp_dir / name
+            shutil.copy(src_db, glob.DB_PATH)
+            results.append(run(func, cursor_class, args.n))
+        legacy, pooled = results
+        print(
+            f"{func.__name__:<12}{legacy:>14.0f}{pooled:>14.0f}"
+            f"{pooled / legacy:>9.1f}x"
+        )
+
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""
+Messages/sec of the streaming decoders of okm.backend.codec on a synthetic
+stream cut in random chunks, against the former SerialConnection.feed()
+(slice, decode, strip and del for each message)
+
+Small reads are what a lightly loaded port gives, messages then mostly come
+one or two per read and the cost per read dominates. Big reads are a busy
+port or a slow consumer, where decoding all complete messages at once pays
+
+Usage : python -m okm.bench.decoder [-n 200000] [--seed 0]
+"""
+
+import argparse
+import random
+import time
+
+from okm.backend import codec
+
+
+class LegacyDecoder:
+    """ SerialConnection.feed() as it was """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, chunk):
+        messages = []
+        self._buffer += chunk
+        while True:
+            end = self._buffer.find(b";")
+            if end == -1:
+                break
+            messages.append(self._buffer[:end].decode(errors="replace").strip())
+            del self._buffer[: end + 1]
+        return messages
+
+
+def chunks(stream, rng, max_size):
+    """ Cut stream like reads of a serial port would """
+    chunks = []
+    view = memoryview(stream)
+    while view:
+        size = rng.randint(1, max_size)
+        chunks.append(bytes(view[:size]))
+        view = view[size:]
+    return chunks
+
+
+def run(decoder, chunks, n):
+    """ :return: (float) messages per second """
+    count = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        count += len(decoder.feed(chunk))
+    elapsed = time.perf_counter() - start
+    assert count == n, (count, n)
+    return n / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=200000, help="Messages in stream")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    replies = [b"new_read:none;", b"new_read:d7425919;", b"confirm:unlock;"]
+    text = b"".join(rng.choice(replies) for _ in range(args.n))
+
+    frames = [
+        codec.encode(20, codec.NEW_READ),
+        codec.encode(20, codec.NEW_READ, bytes.fromhex("d7425919")),
+        codec.encode(20, codec.CONFIRM, bytes((codec.UNLOCK,))),
+    ]
+    binary = b"".join(rng.choice(frames) for _ in range(args.n))
+
+    sizes = (64, 1024)
+    print(f"{'messages/s':<20}" + "".join(f"{f'reads <= {s} B':>20}" for s in sizes))
+    cases = [
+        ("legacy text", LegacyDecoder, text),
+        ("TextDecoder", codec.TextDecoder, text),
+        ("FrameDecoder", codec.FrameDecoder, binary),
+    ]
+    for name, decoder_class, stream in cases:
+        speeds = [
+            run(decoder_class(), chunks(stream, rng, size), args.n) for size in sizes
+        ]
+        print(f"{name:<20}" + "".join(f"{speed:>20.0f}" for speed in speeds))
+
+
+if __name__ == "__main__":
+    main()
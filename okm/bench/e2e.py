@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import time
+
+import okm.glob as glob
+from okm import simulator
+
+"""
+End to end run of the crawler against a simulated fleet (okm.simulator)
+
+Measures, for one scenario :
+- badge to order latency, as readers see it (p50/p95/p99/max)
+- badges/s handled, from the first badge to the last order
+- CPU per badge of okm, the fleet thread's CPU left out
+- DB write latency : commits of stamps by StampWriter, several at once
+
+ArduinoCrawler is a Singleton, so a process runs a single scenario : run
+several with python -m okm.bench
+
+Usage : python -m okm.bench.e2e [--usb 100] [--rs485 8] [--rate 0.2] ...
+"""
+
+# Seconds without new orders before the run is over, and at most
+SETTLE_TIME = 1
+SETTLE_TIMEOUT = 5
+
+
+def timed(func, samples):
+    """ :return: func, appending its durations (seconds) to samples """
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+
+    return wrapper
+
+
+def summary(values):
+    """ :return: (dict) p50/p95/p99/max of values (seconds) in ms """
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        "p50": simulator.percentile(values, 50) * 1000,
+        "p95": simulator.percentile(values, 95) * 1000,
+        "p99": simulator.percentile(values, 99) * 1000,
+        "max": values[-1] * 1000,
+    }
+
+
+def wait_settled(fleet, deadline):
+    """ Wait for the crawler to answer the last badges """
+    count = None
+    last_change = time.monotonic()
+    while time.monotonic() < deadline:
+        new_count = sum(len(r.orders) for r in fleet.readers())
+        if new_count != count:
+            count, last_change = new_count, time.monotonic()
+        elif time.monotonic() - last_change > SETTLE_TIME:
+            return
+        time.sleep(0.1)
+
+
+def run(usb=10, rs485=0, binary=False, rate=0.2, duration=10, seed=0):
+    """
+    Run one scenario, with the engine of glob.CRAWLER_ENGINE
+
+    :rate: (float) badges per second and per reader
+    :return: (dict) scenario and its measures
+    """
+    from okm.backend.stamps import StampWriter
+
+    db_latencies = []
+    StampWriter._commit = timed(StampWriter._commit, db_latencies)
+
+    rng = random.Random(seed)
+    fleet, crawler, uids = simulator.start(usb, rs485, binary, rng=rng)
+    a_ids = [r.id for r in fleet.readers()]
+    trace = simulator.random_trace(a_ids, uids, rate, duration, rng)
+
+    # Let USB readers boot
+    time.sleep(0.5)
+    # The fleet runs in this process : its CPU is taken out, over the same span
+    cpu_start, fleet_cpu_start = time.process_time(), fleet.cpu_time()
+    play_start = time.monotonic()
+    fleet.play(trace)
+    time.sleep(duration)
+    wait_settled(fleet, time.monotonic() + SETTLE_TIMEOUT)
+    cpu = time.process_time() - cpu_start
+    cpu -= fleet.cpu_time() - fleet_cpu_start
+    elapsed = time.monotonic() - play_start
+
+    crawler.stop()
+    fleet.stop()
+
+    latencies = []
+    last_order = play_start
+    for reader in fleet.readers():
+        latencies += reader.latencies()
+        if reader.orders:
+            last_order = max(last_order, reader.orders[-1][0])
+    handled = len(latencies)
+    return {
+        "scenario": {
+            "engine": glob.CRAWLER_ENGINE,
+            "usb": usb,
+            "rs485": rs485,
+            "binary": binary,
+            "rate": rate,
+            "duration": duration,
+            "seed": seed,
+        },
+        "badges": len(trace),
+        "handled": handled,
+        "latency_ms": summary(latencies),
+        "badges_per_s": handled / max(last_order - play_start, 1e-9),
+        "cpu_ms_per_badge": cpu * 1000 / max(handled, 1),
+        # Polls cost CPU too, badges or not
+        "cpu_percent": cpu * 100 / elapsed,
+        "db_write_ms": summary(db_latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--usb", type=int, default=10, help="USB readers")
+    parser.add_argument("--rs485", type=int, default=0, help="RS485 readers")
+    parser.add_argument("--binary", action="store_true", help="RS485 frames")
+    parser.add_argument("--rate", type=float, default=0.2, help="Badges/s/reader")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds")
+    parser.add_argument("--engine", choices=["threads", "asyncio"])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.engine:
+        glob.CRAWLER_ENGINE = args.engine
+
+    # The crawler prints each badge, keep stdout for the result
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result = run(
+            args.usb, args.rs485, args.binary, args.rate, args.duration, args.seed
+        )
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""
+Polls/sec on the RS485 bus : reopening the port for each poll (as Max485 used
+to) against the persistent RS485Bus
+
+A pty pair stands for the bus, and a thread answers like an arduino would,
+right away. Direction switching and its sleeps are left out, only the cost of
+the port itself is measured
+
+Usage : python -m okm.bench.rs485_bus [-n 500]
+"""
+
+import argparse
+import os
+import threading
+import time
+import tty
+
+import serial
+
+from okm.backend.max485 import RS485Bus
+
+
+def fake_arduino(fd, stop):
+    """ Answer every frame on fd with new_read:none """
+    buffer = b""
+    while not stop.is_set():
+        try:
+            buffer += os.read(fd, 256)
+        except OSError:
+            break
+        while b";" in buffer:
+            _, buffer = buffer.split(b";", 1)
+            os.write(fd, b"new_read:none;")
+
+
+def legacy_poll(port, frame):
+    """ What Max485.poll did : open, configure, exchange, close """
+    with serial.Serial(port, 9600, timeout=2) as ser:
+        ser.write(frame)
+        return ser.read_until(b";")
+
+
+def run(poll, n):
+    """ :return: (float) polls per second """
+    start = time.perf_counter()
+    for _ in range(n):
+        rsp = poll()
+        assert rsp == b"new_read:none;", rsp
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=500, help="Polls per case")
+    args = parser.parse_args()
+
+    # Arduino side is the master, the bus port is the slave
+    master, slave = os.openpty()
+    tty.setraw(master)
+    port = os.ttyname(slave)
+
+    stop = threading.Event()
+    threading.Thread(target=fake_arduino, args=(master, stop), daemon=True).start()
+
+    frame = b"20:ask_for_new;"
+    legacy = run(lambda: legacy_poll(port, frame), args.n)
+
+    bus = RS485Bus(port, 9600)
+    persistent = run(lambda: bus.exchange(frame), args.n)
+    bus.close()
+
+    stop.set()
+
+    print(f"{'reopen per poll':<20}{legacy:>10.0f} polls/s")
+    print(f"{'persistent bus':<20}{persistent:>10.0f} polls/s")
+    print(f"{'speedup':<20}{persistent / legacy:>10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -20,7 +20,6 @@
 #
 
 from pathlib import Path
-import threading
 
 """
 Global values
@@ -37,9 +36,63 @@ DB_PATH = Path(__file__).parent / "db.sqlite3"
 # {'id' : 'description', ... }
 ARDUINOS_DESC = {10: "Proto Simon", 20: "Proto rs485"}  # , 30: "autre"}
 
+# Nombre de transactions (badge -> ordre -> confirmation) que le crawler peut
+# mener en parallèle. Chaque arduino a son propre pipeline, ainsi un arduino lent
+# à confirmer ne bloque pas les autres. 1 = ancien comportement séquentiel
+CRAWLER_CONCURRENCY = 4
 
-# Brute force but might do the trick ...
-LOCK = threading.Lock()
+# Moteur du crawler :
+# 'threads' : threads (voir CRAWLER_CONCURRENCY) et USBTransport
+# 'asyncio' : une coroutine par arduino dans la boucle d'okm.backend.aio, les
+#   ports USB y sont surveillés avec add_reader. Un seul thread pour tout
+CRAWLER_ENGINE = "threads"
+
+# Port série du bus RS485 (voir okm.backend.max485)
+RS485_PORT = "/dev/ttyAMA0"
+RS485_BAUDRATE = 9600
+# Contrôle de la direction du max485 :
+# 'gpio' : pins RE/DE pilotées par RPi.GPIO
+# 'kernel' : RTS piloté par le driver (pyserial rs485_mode), RTS câblé sur RE/DE
+# 'none' : rien à piloter (adaptateur auto-direction)
+RS485_DIRECTION = "gpio"
+# Temps (s) dont un arduino a besoin après sa réponse avant d'écouter à nouveau
+# (voir send_message() dans arduino/rs485_key_reader)
+RS485_TURNAROUND = 0.03
+# Temps (s) max de réponse d'un arduino. Le bus reste bloqué tant qu'on attend
+RS485_REPLY_TIMEOUT = 0.25
+# Négocier avec chaque arduino le protocole binaire (voir okm.backend.codec),
+# plus court et avec CRC. Le bus ne passe en binaire que quand tous l'ont
+# accepté : un ancien sketch lirait les trames des autres comme du texte
+RS485_BINARY = False
+# Ordonnancement du bus RS485 (voir okm.backend.max485.BusScheduler) :
+# un arduino inactif est interrogé au moins toutes les RS485_MAX_LATENCY s, délai
+# maximal avant qu'un badge soit vu. Un arduino déverrouillé, ou ayant lu un badge
+# depuis moins de RS485_ACTIVE_WINDOW s, l'est toutes les RS485_ACTIVE_INTERVAL s
+RS485_MAX_LATENCY = 1.0
+RS485_ACTIVE_INTERVAL = 0.2
+RS485_ACTIVE_WINDOW = 30
+
+# Délai (s) avant de re-interroger un arduino qui n'avait rien à dire
+CRAWLER_POLL_INTERVAL = 0.2
+
+# Traces des badges, étape par étape (voir okm.backend.tracing) : nombre de
+# badges gardés en mémoire, et fichier (JSON lines) où les écrire aussi, ou None
+TRACE_BUFFER_SIZE = 1000
+TRACE_FILE = None
+
+# Métriques au format Prometheus (voir okm.backend.metrics), servies en HTTP sur
+# http://METRICS_HOST:METRICS_PORT/metrics. None : rien n'est mesuré
+METRICS_PORT = None
+METRICS_HOST = "127.0.0.1"
+
+# Écriture différée des passages (voir okm.backend.stamps) : le crawler n'attend
+# pas le commit sur la carte SD. Chaque passage est d'abord ajouté au journal,
+# rejoué au démarrage s'il n'a pas pu être commité. None : à côté de la DB
+STAMP_JOURNAL = None
+# Délai (s) avant de réessayer un commit qui a échoué (DB verrouillée ...)
+STAMP_RETRY_DELAY = 1.0
+# Attente max (s) au démarrage que le journal soit rejoué, avant d'ouvrir la GUI
+STAMP_REPLAY_TIMEOUT = 10
 
 # Other brute force approach ...
 # Define moc logger object ... Later, this will be shadowed by gui logger
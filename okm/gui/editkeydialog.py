@@ -92,17 +92,15 @@ class EditKeyDialog(wx.Dialog):
         conn.row_factory = sqlite3.Row
         c = conn.cursor()
         c.execute(
-            "SELECT * FROM perms WHERE key_id=?", (self.key_combobox.id[full_name],)
+            "SELECT arduino_id FROM perms WHERE key_id=?",
+            (self.key_combobox.id[full_name],),
         )
-        # key_id is UNIQUE, so fetchone() makes sense
-        r = c.fetchone()
+        # One row per arduino granted
+        granted = {line["arduino_id"] for line in c.fetchall()}
         conn.close()
 
         for a_id in self.arduinos_cb:
-            if r[str(a_id)] == 0:
-                self.arduinos_cb[a_id].SetValue(False)
-            else:
-                self.arduinos_cb[a_id].SetValue(True)
+            self.arduinos_cb[a_id].SetValue(int(a_id) in granted)
 
 
 if __name__ == "__main__":
@@ -27,12 +27,15 @@ import logging
 import datetime
 import sqlite3
 import threading
-import copy
 
 from okm.backend.arduino_crawler import ArduinoCrawler
+from okm.backend import eventbus
+from okm.backend.aio import call_in_gui
+from okm.backend.perms import PermCache
+from okm.backend.sessions import SessionPages
 from okm.gui.newkeydialog import NewKeyDialog
 from okm.gui.editkeydialog import EditKeyDialog
-from okm.glob import DB_PATH, ARDUINOS_DESC, LOCK
+from okm.glob import DB_PATH, ARDUINOS_DESC
 import okm.glob
 from okm.utils import DbCursor
 
@@ -185,10 +188,11 @@ class MainWindow(wx.Frame):
             conn = sqlite3.connect(DB_PATH)
             c = conn.cursor()
             c.execute("INSERT INTO keys VALUES (?, ?, ?, ?, ?)", new_data)
-            c.execute("INSERT INTO perms VALUES (?, ?, ?, ?)", (key_id, 0, 0, 0))
             conn.commit()
             conn.close()
 
+            PermCache().update(key_id, set())
+
     def onModifKey(self, event):
         dlg = EditKeyDialog(self)
         result = dlg.ShowModal()
@@ -196,13 +200,17 @@ class MainWindow(wx.Frame):
         if result == wx.ID_OK:
             key_id = dlg.key_combobox.id[dlg.key_combobox.GetValue()]
 
+            granted = [a_id for a_id, cb in dlg.arduinos_cb.items() if cb.GetValue()]
+
             # conn.set_trace_callback(print)
             with DbCursor() as c:
-                for a_id in dlg.arduinos_cb:
-                    c.execute(
-                        f"""UPDATE perms SET '{a_id}'=? WHERE key_id=?""",
-                        (dlg.arduinos_cb[a_id].GetValue(), key_id),
-                    )
+                c.execute("DELETE FROM perms WHERE key_id=?", (key_id,))
+                c.executemany(
+                    "INSERT INTO perms VALUES (?, ?)",
+                    [(key_id, a_id) for a_id in granted],
+                )
+
+            PermCache().update(key_id, granted)
 
     def onExit(self, event):
         """
@@ -302,70 +310,164 @@ class Vue1(wx.Panel):
 
         self.SetSizer(sizer)
 
+        # {'arduino_id': datetime of unlock | None if locked, ... }
+        self.start_times = {a_id: None for a_id in ARDUINOS_DESC}
+        # {'key_id': 'full name', ... }
+        self.full_names = {}
+
+        # Crawler tells us when something changes, from its own thread
+        self.events = eventbus.bus.subscribe(
+            "Vue1", notify=lambda: call_in_gui(self.onCrawlerEvents)
+        )
+
+        # Only ticks elapsed times, see tick()
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.tick, self.timer)
+
     def update_infos(self, *event):
+        """ Redraw everything. Afterwards, only crawler events update rows """
 
         logging.debug("Update de Vue1")
 
-        with LOCK:
-            # {'unknown_key', 'key_id',
-            #
-            # }
-            notify = copy.deepcopy(ArduinoCrawler().mainwindow_notify)
-            ArduinoCrawler().mainwindow_notify.clear()
-
-        new_key = notify.get("unknown_key", None)
-        if new_key is not None:
-            resp = wx.MessageBox(
-                "On a détecté une clé inconnue. Vous souhaitez l'ajouter ?",
-                "Nouvelle clé",
-                style=wx.OK | wx.CANCEL,
-            )
-            if resp == wx.OK:
-                self.GetParent().onNewKey(new_key=new_key)
-
-        with LOCK:
-            # {'arduino_id': 'unlock_key', ... }
-            states = copy.deepcopy(ArduinoCrawler().arduinos_states)
+        # {'arduino_id': 'unlock_key', ... }
+        states = ArduinoCrawler().states()
 
         with DbCursor() as c:
-            c.execute("SELECT * FROM keys")
-            r_keys = c.fetchall()
+            c.execute("SELECT arduino_id, start FROM sessions WHERE status = 'open'")
+            starts = {line["arduino_id"]: line["start"] for line in c.fetchall()}
 
         for a_id in self.staticTexts:
-            # key_id is None = > Pas d'utilisateur "loggé"
-            if states[a_id] is None:
-                self.staticTexts[a_id][1].SetLabel("LOCKED")
-                self.staticTexts[a_id][2].SetLabel("N/A")
-                self.staticTexts[a_id][3].SetLabel(" -- -- -- ")
-            else:
-                self.staticTexts[a_id][1].SetLabel("UNLOCKED")
-                for line in r_keys:
-                    if line["key_id"] == states[a_id]:
-                        self.staticTexts[a_id][2].SetLabel(
-                            line["name"] + " " + line["surname"]
-                        )
-
-                with DbCursor() as c:
-                    c.execute(
-                        "SELECT * FROM stamps WHERE key_id = ? AND arduino_id = ?"
-                        " ORDER BY timestamp DESC LIMIT 1",
-                        (states[a_id], a_id),
-                    )
-                    r_stamp = c.fetchone()
-
-                now = datetime.datetime.now()
-                starttime = datetime.datetime.strptime(
-                    r_stamp["timestamp"], "%Y-%m-%d %H:%M:%S.%f"
-                )
-                duration = now - starttime
-                self.staticTexts[a_id][3].SetLabel(str(duration).split(".")[0])
+            start = starts.get(a_id)
+            if start is not None:
+                start = datetime.datetime.fromisoformat(start)
+            self.update_row(a_id, states.get(a_id), start)
 
         # self.GetParent().Fit()
 
         if self.IsShownOnScreen():
-            self.timer = wx.Timer(self)
-            self.Bind(wx.EVT_TIMER, self.update_infos, self.timer)
-            self.timer.Start(1000, wx.TIMER_ONE_SHOT)
+            self.timer.Start(1000)
+
+    def update_row(self, a_id, key_id, start):
+        """
+        :key_id: key which unlocked arduino, None if locked
+        :start: (datetime) of unlock
+        """
+        if a_id not in self.staticTexts:
+            return
+
+        # key_id is None = > Pas d'utilisateur "loggé"
+        if key_id is None:
+            self.start_times[a_id] = None
+            self.staticTexts[a_id][1].SetLabel("LOCKED")
+            self.staticTexts[a_id][2].SetLabel("N/A")
+            self.staticTexts[a_id][3].SetLabel(" -- -- -- ")
+        else:
+            self.start_times[a_id] = start
+            self.staticTexts[a_id][1].SetLabel("UNLOCKED")
+            self.staticTexts[a_id][2].SetLabel(self.full_name(key_id))
+            self.tick()
+
+    def full_name(self, key_id):
+        if key_id not in self.full_names:
+            with DbCursor() as c:
+                c.execute("SELECT name, surname FROM keys WHERE key_id = ?", (key_id,))
+                line = c.fetchone()
+            if line is None:
+                return key_id
+            self.full_names[key_id] = line["name"] + " " + line["surname"]
+        return self.full_names[key_id]
+
+    def tick(self, *event):
+        """ Update elapsed time of unlocked arduinos, from cached start times """
+        now = datetime.datetime.now()
+        for a_id, start in self.start_times.items():
+            if start is not None:
+                duration = now - start
+                self.staticTexts[a_id][3].SetLabel(str(duration).split(".")[0])
+
+    def onCrawlerEvents(self):
+
+        # Several unknown keys may come at once : ask for each of them
+        for event in self.events.drain():
+
+            if event.kind == eventbus.UNLOCKED:
+                self.update_row(event.a_id, event.key_id, event.timestamp)
+
+            elif event.kind == eventbus.LOCKED:
+                self.update_row(event.a_id, None, None)
+
+            elif event.kind == eventbus.UNKNOWN_KEY:
+                resp = wx.MessageBox(
+                    f"On a détecté une clé inconnue ({event.key_id})."
+                    " Vous souhaitez l'ajouter ?",
+                    "Nouvelle clé",
+                    style=wx.OK | wx.CANCEL,
+                )
+                if resp == wx.OK:
+                    self.GetParent().onNewKey(new_key=event.key_id)
+
+
+class SessionsModel(dataview.DataViewVirtualListModel):
+    """
+    Finished sessions, fetched lazily page by page when the view asks for rows
+    """
+
+    # [('column title', 'sort key' | None if not sortable), ... ]
+    COLUMNS = [
+        ("Nom", "name"),
+        ("Prénom", "surname"),
+        ("Machine", "arduino_id"),
+        ("Début", "start"),
+        ("Fin", "end"),
+        ("Durée", "duration"),
+        ("Remarque", None),
+    ]
+
+    def __init__(self):
+        self.pages = SessionPages()
+        super().__init__(self.pages.count())
+
+    def GetColumnCount(self):
+        return len(self.COLUMNS)
+
+    def GetColumnType(self, col):
+        return "string"
+
+    def GetValueByRow(self, row, col):
+        session = self.pages.row(row)
+
+        if col == 0:
+            return session["name"]
+        elif col == 1:
+            return session["surname"]
+        elif col == 2:
+            a_id = session["arduino_id"]
+            return ARDUINOS_DESC.get(a_id, str(a_id))
+        elif col == 3:
+            return session["start"]
+        elif col == 4:
+            return session["end"] or ""
+        elif col == 5:
+            if session["duration"] is None:
+                return ""
+            return str(datetime.timedelta(seconds=session["duration"]))
+        elif col == 6:
+            if session["status"] == "error":
+                return "Inscrit après un crash. Peut être incorrect"
+            return ""
+
+    def refresh(self):
+        """ Drop cached rows. Only visible ones are fetched again """
+        self.pages.reset()
+        self.Reset(self.pages.count())
+
+    def sort(self, sort_key, ascending):
+        self.pages.set_sort(sort_key, ascending)
+        self.Reset(self.pages.count())
+
+    def search(self, text):
+        self.pages.set_search(text)
+        self.Reset(self.pages.count())
 
 
 class Vue2(wx.Panel):
@@ -381,76 +483,57 @@ class Vue2(wx.Panel):
 
         self.searchCtrl = wx.SearchCtrl(self, size=wx.Size(80, 40))
         self.searchCtrl.ShowCancelButton(True)
+        self.searchCtrl.Bind(wx.EVT_TEXT, self.onSearchText)
+        self.searchCtrl.Bind(wx.EVT_SEARCHCTRL_CANCEL_BTN, self.onSearchCancel)
+        # Search once typing pauses, not on every key stroke
+        self.search_timer = wx.CallLater(150, self.onSearch)
+        self.search_timer.Stop()
 
         sizer.Add(self.searchCtrl, border=15, flag=wx.ALIGN_CENTER_HORIZONTAL | wx.BOTH)
 
-        self.stampTab = dataview.DataViewListCtrl(self)
-        self.stampTab.AppendTextColumn("Nom", flags=col_flags)
-        self.stampTab.AppendTextColumn("Prénom", flags=col_flags)
-        self.stampTab.AppendTextColumn("Machine", flags=col_flags)
-        self.stampTab.AppendTextColumn("Début", flags=col_flags)
-        self.stampTab.AppendTextColumn("Fin", flags=col_flags)
-        self.stampTab.AppendTextColumn("Durée", flags=col_flags)
-        self.stampTab.AppendTextColumn("Remarque", flags=col_flags)
+        self.model = SessionsModel()
+        self.stampTab = dataview.DataViewCtrl(self)
+        self.stampTab.AssociateModel(self.model)
+        for col, (title, sort_key) in enumerate(SessionsModel.COLUMNS):
+            if sort_key is None:
+                self.stampTab.AppendTextColumn(title, col)
+            else:
+                self.stampTab.AppendTextColumn(title, col, flags=col_flags)
+
+        # Sorting is done by SQL, not by the control
+        self.stampTab.Bind(
+            dataview.EVT_DATAVIEW_COLUMN_HEADER_CLICK, self.onHeaderClick
+        )
 
         sizer.Add(self.stampTab, flags)
 
         self.SetSizerAndFit(sizer)
 
-    def update_infos(self):
+    def onHeaderClick(self, event):
+        sort_key = SessionsModel.COLUMNS[event.GetColumn()][1]
+        if sort_key is None:
+            return
 
-        self.stampTab.DeleteAllItems()
+        pages = self.model.pages
+        # Same column again : reverse order. New column : ascending
+        ascending = sort_key != pages.sort or not pages.ascending
+        event.GetDataViewColumn().SetSortOrder(ascending)
+        self.model.sort(sort_key, ascending)
 
-        with DbCursor() as c:
-            c.execute("SELECT key_id,name,surname FROM keys")
-            keys = c.fetchall()
-
-        for key in keys:
-            for a_id in ARDUINOS_DESC:
-
-                with DbCursor() as c:
-                    c.execute(
-                        "SELECT * FROM stamps WHERE key_id=? AND arduino_id=? "
-                        "ORDER BY timestamp DESC ",
-                        (key["key_id"], a_id,),
-                    )
-                    stamps = c.fetchall()
-
-                new_entry = ["", "", "", "", "", "", ""]
-
-                for stamp in stamps:
-
-                    if (
-                        stamp["lock_state"] == "locked"
-                        or stamp["lock_state"] == "error"
-                    ):
-                        new_entry[0] = key["name"]
-                        new_entry[1] = key["surname"]
-                        new_entry[2] = ARDUINOS_DESC[stamp["arduino_id"]]
-
-                        new_entry[4] = stamp["timestamp"]
-                        if stamp["lock_state"] == "error":
-                            new_entry[6] = "Inscrit après un crash. Peut être incorrect"
-
-                    elif stamp["lock_state"] == "unlocked" and new_entry != []:
-                        new_entry[3] = stamp["timestamp"]
-                    else:
-                        raise RuntimeError(
-                            "Inconsistant DB state. Impossilbe to extract data properly"
-                        )
-
-                    if new_entry[3] != "" and new_entry[4] != "" and new_entry[5] == "":
-                        starttime = datetime.datetime.strptime(
-                            new_entry[3], "%Y-%m-%d %H:%M:%S.%f"
-                        )
-                        endtime = datetime.datetime.strptime(
-                            new_entry[4], "%Y-%m-%d %H:%M:%S.%f"
-                        )
-                        duration = endtime - starttime
-                        new_entry[5] = str(duration).split(".")[0]
-
-                        self.stampTab.AppendItem(new_entry)
-                        new_entry = ["", "", "", "", "", "", ""]
+    def onSearchText(self, event):
+        self.search_timer.Start()
+
+    def onSearchCancel(self, event):
+        self.searchCtrl.ChangeValue("")
+        self.onSearch()
+
+    def onSearch(self):
+        self.model.search(self.searchCtrl.GetValue())
+
+    def update_infos(self):
+
+        # Sessions in progress are shown in Vue1
+        self.model.refresh()
 
 
 class Vue3(wx.Panel):
@@ -469,6 +552,10 @@ class Vue3(wx.Panel):
 
         okm.glob.logger = self
 
+        self.events = eventbus.bus.subscribe(
+            "Vue3", notify=lambda: call_in_gui(self.onCrawlerEvents)
+        )
+
     def log(self, string):
         """ Add a string to the view with time """
 
@@ -476,6 +563,11 @@ class Vue3(wx.Panel):
         self.logger.InsertItems([f"{datetime.datetime.now()} // {string}"], n)
         self.logger.EnsureVisible(n)
 
+    def onCrawlerEvents(self):
+        for event in self.events.drain():
+            desc = ARDUINOS_DESC.get(event.a_id, event.a_id)
+            self.log(f"{desc} : {event.kind} ({event.key_id})")
+
     def onScrollUp(self, event):
         print(event)
 
@@ -23,12 +23,14 @@ import wx
 
 from okm.gui.mainwindow import MainWindow
 from okm.backend.arduino_crawler import ArduinoCrawler
-from okm.glob import DB_PATH, ARDUINOS_DESC
+import okm.glob as glob
+from okm.backend import metrics
+from okm.backend.stamps import StampWriter
 from okm.utils import DbCursor
+from okm.migrations import migrate
 
 import argparse
 import logging
-import sqlite3
 import datetime
 
 
@@ -64,34 +66,34 @@ def main():
 
         simulatorwindow = SimulatorWindow(None)
 
-    # Verify that we don't have entry in DB that stayed open (from a crash)
-    with DbCursor() as c:
-        c.execute("SELECT key_id FROM keys")
-        r1 = c.fetchall()
-        c.execute("SELECT * FROM stamps ORDER BY timestamp DESC ")
-        r2 = c.fetchall()
-
-    key_to_check = [l[0] for l in r1]
-    key_to_check.sort()
-    key_already_checked = []
-    for line in r2:
-        if line["key_id"] not in key_already_checked:
-            key_already_checked.append(line["key_id"])
-            if line["lock_state"] == "unlocked":
+    # Bring DB schema up to date
+    migrate()
+
+    # Opt-in, see okm.backend.metrics
+    if glob.METRICS_PORT is not None:
+        metrics.serve()
+
+    # Stamps a former run couldn't commit, before looking at its sessions.
+    # Not forever : if the DB can't be written, they stay in the journal
+    # and sessions are looked at next time
+    if not StampWriter().flush(timeout=glob.STAMP_REPLAY_TIMEOUT):
+        logging.warning("Stamp journal not replayed yet, open sessions left as is")
+    else:
+        # Verify that we don't have session in DB that stayed open (from a crash)
+        with DbCursor() as c:
+            c.execute("SELECT * FROM sessions WHERE status = 'open'")
+            for line in c.fetchall():
 
                 print(f"La clé {line['key_id']} est restée ouverte. On y remédie...")
 
                 timestamp = datetime.datetime.now()
                 new_data = (line["key_id"], line["arduino_id"], timestamp, "error")
 
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
                 c.execute("INSERT INTO stamps VALUES (?, ?, ?, ?)", new_data)
-                conn.commit()
-                conn.close()
-
-        if key_to_check == sorted(key_already_checked):
-            break
+                c.execute(
+                    "UPDATE sessions SET end = ?, status = 'error' WHERE id = ?",
+                    (timestamp, line["id"]),
+                )
 
     app = wx.App(False)
     # Start crawler
@@ -100,5 +102,8 @@ def main():
     mainwindow = MainWindow(None)
     app.MainLoop()
 
+    # Commit the last stamps, what can't be is replayed at next start
+    StampWriter().stop()
+
     # TODO :
     # Close all stamps in DB and close all arduinos when quitting application
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import logging
+
+from okm.utils import DbCursor
+
+"""
+Schema migrations of the DB
+
+Migrations are applied once, in order, on startup (see okm.main). The number of
+migrations already applied is stored in the DB itself with PRAGMA user_version
+
+To change the schema, append a function to MIGRATIONS. Never edit or reorder
+those already shipped : DBs in the wild already ran them
+"""
+
+
+def initial_schema(c):
+    """ Schema as it was before migrations existed """
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS "keys" (
+            "key_id" TEXT UNIQUE,
+            "name" text,
+            "surname" text,
+            "email" text,
+            "phone" text
+        )"""
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS "perms" (
+            "key_id" TEXT UNIQUE,
+            "10" INTEGER,
+            "20" INTEGER,
+            "30" INTEGER,
+            FOREIGN KEY("key_id") REFERENCES "keys"("key_id")
+                ON UPDATE CASCADE ON DELETE CASCADE
+        )"""
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS "stamps" (
+            "key_id" TEXT,
+            "arduino_id" INTEGER,
+            "timestamp" NUMERIC,
+            "lock_state" TEXT,
+            FOREIGN KEY("key_id") REFERENCES "keys"("key_id")
+                ON UPDATE CASCADE ON DELETE CASCADE
+        )"""
+    )
+
+
+def stamps_indexes(c):
+    """ Last stamp of a key on an arduino (Vue1, Vue2), and stamps by date """
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS stamps_key_arduino_timestamp"
+        " ON stamps(key_id, arduino_id, timestamp)"
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS stamps_timestamp ON stamps(timestamp)")
+
+
+def normalize_perms(c):
+    """
+    One row per (key, arduino) granted, instead of one column per arduino
+
+    Adding an arduino doesn't need an ALTER TABLE anymore, and a permission
+    check is a single probe of the primary key
+    """
+    c.execute("PRAGMA table_info(perms)")
+    arduino_cols = [row["name"] for row in c.fetchall() if row["name"] != "key_id"]
+
+    c.execute("ALTER TABLE perms RENAME TO perms_by_column")
+    c.execute(
+        """CREATE TABLE "perms" (
+            "key_id" TEXT NOT NULL,
+            "arduino_id" INTEGER NOT NULL,
+            PRIMARY KEY("key_id", "arduino_id"),
+            FOREIGN KEY("key_id") REFERENCES "keys"("key_id")
+                ON UPDATE CASCADE ON DELETE CASCADE
+        ) WITHOUT ROWID"""
+    )
+    for col in arduino_cols:
+        c.execute(
+            f"""INSERT INTO perms SELECT key_id, ? FROM perms_by_column
+            WHERE "{col}" = 1""",
+            (int(col),),
+        )
+    c.execute("DROP TABLE perms_by_column")
+
+
+def sessions_table(c):
+    """
+    Sessions (an unlock and its matching lock) maintained by the crawler, so
+    views don't have to pair stamps themselves. Backfilled from stamps
+    """
+    c.execute(
+        """CREATE TABLE "sessions" (
+            "id" INTEGER PRIMARY KEY,
+            "key_id" TEXT NOT NULL,
+            "arduino_id" INTEGER NOT NULL,
+            "start" NUMERIC NOT NULL,
+            "end" NUMERIC,
+            "status" TEXT NOT NULL,
+            FOREIGN KEY("key_id") REFERENCES "keys"("key_id")
+                ON UPDATE CASCADE ON DELETE CASCADE
+        )"""
+    )
+    c.execute("CREATE INDEX sessions_start ON sessions(start)")
+    # Sessions in progress, at most one per arduino
+    c.execute(
+        "CREATE INDEX sessions_open ON sessions(arduino_id) WHERE status = 'open'"
+    )
+
+    c.execute("SELECT * FROM stamps ORDER BY key_id, arduino_id, timestamp")
+    stamps = c.fetchall()
+
+    # {('key_id', 'arduino_id'): 'start', ... }
+    opened = {}
+    # [(key_id, arduino_id, start, end, status), ... ]
+    sessions = []
+    for stamp in stamps:
+        k = (stamp["key_id"], stamp["arduino_id"])
+        # Some crawler versions wrote 'unlocked;'
+        lock_state = stamp["lock_state"].rstrip(";")
+
+        if lock_state == "unlocked":
+            if k in opened:
+                # Never locked : we don't know when it ended
+                sessions.append((*k, opened[k], None, "error"))
+            opened[k] = stamp["timestamp"]
+        elif k in opened:
+            status = "error" if lock_state == "error" else "closed"
+            sessions.append((*k, opened.pop(k), stamp["timestamp"], status))
+        else:
+            logging.warning(f"Stamp without matching unlock ignored : {tuple(stamp)}")
+
+    # Still unlocked. Closed on startup if it comes from a crash (see okm.main)
+    sessions.extend((*k, start, None, "open") for k, start in opened.items())
+
+    c.executemany(
+        "INSERT INTO sessions (key_id, arduino_id, start, end, status)"
+        " VALUES (?, ?, ?, ?, ?)",
+        sessions,
+    )
+
+
+def keys_full_text_search(c):
+    """
+    FTS5 index on keys, kept in sync by triggers, to search sessions by person
+    """
+    c.execute(
+        """CREATE VIRTUAL TABLE keys_fts USING fts5(
+            name, surname, email,
+            content='keys', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        )"""
+    )
+    c.execute(
+        """CREATE TRIGGER keys_fts_insert AFTER INSERT ON keys BEGIN
+            INSERT INTO keys_fts(rowid, name, surname, email)
+            VALUES (new.rowid, new.name, new.surname, new.email);
+        END"""
+    )
+    c.execute(
+        """CREATE TRIGGER keys_fts_delete AFTER DELETE ON keys BEGIN
+            INSERT INTO keys_fts(keys_fts, rowid, name, surname, email)
+            VALUES ('delete', old.rowid, old.name, old.surname, old.email);
+        END"""
+    )
+    c.execute(
+        """CREATE TRIGGER keys_fts_update AFTER UPDATE ON keys BEGIN
+            INSERT INTO keys_fts(keys_fts, rowid, name, surname, email)
+            VALUES ('delete', old.rowid, old.name, old.surname, old.email);
+            INSERT INTO keys_fts(rowid, name, surname, email)
+            VALUES (new.rowid, new.name, new.surname, new.email);
+        END"""
+    )
+    c.execute("INSERT INTO keys_fts(keys_fts) VALUES ('rebuild')")
+
+    # Sessions of the keys found
+    c.execute("CREATE INDEX sessions_key_start ON sessions(key_id, start)")
+
+
+def keys_fts_by_key_id(c):
+    """
+    keys_fts holds key_id instead of pointing to the rowid of keys
+
+    keys has no INTEGER PRIMARY KEY, so a VACUUM may renumber its rowids and
+    the external content index would then return other keys. keys_fts now
+    stores its own copy of the text, next to key_id
+    """
+    for trigger in ("insert", "delete", "update"):
+        c.execute(f"DROP TRIGGER keys_fts_{trigger}")
+    c.execute("DROP TABLE keys_fts")
+
+    c.execute(
+        """CREATE VIRTUAL TABLE keys_fts USING fts5(
+            key_id UNINDEXED, name, surname, email,
+            tokenize='unicode61 remove_diacritics 2'
+        )"""
+    )
+    c.execute(
+        """CREATE TRIGGER keys_fts_insert AFTER INSERT ON keys BEGIN
+            INSERT INTO keys_fts(key_id, name, surname, email)
+            VALUES (new.key_id, new.name, new.surname, new.email);
+        END"""
+    )
+    # key_id isn't indexed by FTS5 : a scan, fine for the number of keys we have
+    c.execute(
+        """CREATE TRIGGER keys_fts_delete AFTER DELETE ON keys BEGIN
+            DELETE FROM keys_fts WHERE key_id = old.key_id;
+        END"""
+    )
+    c.execute(
+        """CREATE TRIGGER keys_fts_update AFTER UPDATE ON keys BEGIN
+            DELETE FROM keys_fts WHERE key_id = old.key_id;
+            INSERT INTO keys_fts(key_id, name, surname, email)
+            VALUES (new.key_id, new.name, new.surname, new.email);
+        END"""
+    )
+    c.execute(
+        "INSERT INTO keys_fts(key_id, name, surname, email)"
+        " SELECT key_id, name, surname, email FROM keys"
+    )
+
+
+# [function(cursor), ... ] Append only !
+MIGRATIONS = [
+    initial_schema,
+    stamps_indexes,
+    normalize_perms,
+    sessions_table,
+    keys_full_text_search,
+    keys_fts_by_key_id,
+]
+
+
+def schema_version():
+    with DbCursor() as c:
+        c.execute("PRAGMA user_version")
+        return c.fetchone()[0]
+
+
+def migrate():
+    """
+    Apply pending migrations. Each one runs in its own transaction, together
+    with the version bump, so a failure leaves the DB at the previous version
+
+    :return: (int) schema version
+    """
+    version = schema_version()
+
+    for n, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logging.info(f"Apply DB migration {n} : {migration.__name__}")
+        with DbCursor() as c:
+            # DDL doesn't open a transaction implicitly
+            c.execute("BEGIN")
+            migration(c)
+            # PRAGMA doesn't accept parameters
+            c.execute(f"PRAGMA user_version = {n:d}")
+
+    return schema_version()
+
+
+def query_plan(sql, params=()):
+    """ :return: (str) EXPLAIN QUERY PLAN of sql, one step per line """
+    with DbCursor() as c:
+        c.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return "\n".join(row["detail"] for row in c.fetchall())
@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import selectors
+import shutil
+import tempfile
+import threading
+import time
+import tty
+from pathlib import Path
+
+import okm.glob as glob
+from okm.backend import codec
+
+"""
+Headless fleet of simulated readers, for load testing without boards
+
+Each simulated USB reader is a pty pair. okm opens the slave side with the
+unmodified USBArduino, the simulator plays the usb_key_reader sketch on the
+master side : boot noise then 'confirm:ready;', 'new_read:<uid>;' when a badge
+is read, 'confirm:<order>;' for each 'order:<order>;'
+
+A simulated RS485 bus is a single pty where several addressed readers play the
+rs485_key_reader sketch : they answer '<id>:ask_for_new;' and '<id>:<order>;'
+addressed to them, after the sketch's delay, in text or in binary frames
+(okm.backend.codec) once asked 'proto_binary'
+
+A single thread serves the whole fleet, with selectors, so hundreds of readers
+run on a laptop. Badges come from a trace : scripted (JSON lines of
+{"t": seconds, "a_id": int, "uid": str}) or random (random_trace())
+
+Usage : python -m okm.simulator [--usb 100] [--rs485 8] [--rate 0.2] ...
+"""
+
+
+def sketch_uid(uid_bytes):
+    """ uid as the sketches write it : lowercase hex, bytes not zero padded """
+    return "".join(f"{b:x}" for b in uid_bytes)
+
+
+class SimulatedReader:
+    """ What a simulated reader saw, for latency measures """
+
+    def __init__(self, a_id):
+        self.id = a_id
+        # [(monotonic time, uid), ... ] badges read
+        self.badges = []
+        # [(monotonic time, order), ... ] orders received
+        self.orders = []
+
+    def latencies(self):
+        """ :return: [seconds between each badge and the next order, ... ] """
+        latencies = []
+        orders = iter(self.orders)
+        order = next(orders, None)
+        for badge_time, _ in self.badges:
+            while order is not None and order[0] < badge_time:
+                order = next(orders, None)
+            if order is None:
+                break
+            latencies.append(order[0] - badge_time)
+            order = next(orders, None)
+        return latencies
+
+
+class SimulatedUSBReader(SimulatedReader):
+    """ usb_key_reader sketch on the master side of a pty """
+
+    def __init__(self, fleet, a_id, confirm=True):
+        """ :confirm: (bool) False for a reader that never confirms orders """
+        super().__init__(a_id)
+        self.fleet = fleet
+        self.confirm = confirm
+        self.decoder = codec.TextDecoder()
+
+        self.fd, self._slave = os.openpty()
+        tty.setraw(self.fd)
+        # Port to give to USBArduino
+        self.device = os.ttyname(self._slave)
+
+    def boot(self):
+        self.fleet.write(self.fd, b"Initialisation of USB_KEY_READER done\r\n")
+        self.fleet.write(self.fd, b"confirm:ready;")
+
+    def badge(self, uid):
+        self.badges.append((time.monotonic(), uid))
+        self.fleet.write(self.fd, f"new_read:{uid};".encode())
+
+    def on_data(self, data):
+        for msg in self.decoder.feed(data):
+            if msg.startswith("order:"):
+                order = msg.value
+                self.orders.append((time.monotonic(), order))
+                if self.confirm:
+                    self.fleet.write(self.fd, f"confirm:{order};".encode())
+            else:
+                # Sketch echoes what it doesn't know
+                self.fleet.write(self.fd, f"{msg};".encode())
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self._slave)
+
+
+class SimulatedRS485Bus:
+    """ Addressed readers of the rs485_key_reader sketch, sharing one pty """
+
+    # delay(20) of send_message() in the sketch
+    REPLY_DELAY = 0.02
+    # Seconds of delay() after confirming an order, in the sketch
+    DEAF_AFTER = {"unlock": 1.0, "lock": 2.0, "denied": 2.2}
+
+    def __init__(self, fleet, a_ids, binary=True, deaf=False):
+        """
+        :a_ids: [int, ... ] addresses of the readers, below 256
+        :binary: (bool) readers understand binary frames, or {a_id, ... } the
+            ones that do on a mixed bus. The others ignore frames
+        :deaf: (bool) readers ignore the bus while blinking after an order, as
+            the sketch does with delay()
+        """
+        self.fleet = fleet
+        self.binary = set(a_ids) if binary is True else set(binary or ())
+        self.deaf = deaf
+        self.readers = {a_id: SimulatedReader(a_id) for a_id in a_ids}
+        # {'a_id': uid of the last badge not asked for yet, ... }
+        self._pending = {}
+        # {'a_id': monotonic time it listens again, ... }
+        self._deaf_until = {}
+        self._buffer = bytearray()
+
+        self.fd, self._slave = os.openpty()
+        tty.setraw(self.fd)
+        tty.setraw(self._slave)
+        # Port to give to Max485.use_port()
+        self.device = os.ttyname(self._slave)
+
+    def badge(self, a_id, uid):
+        """ :uid: (bytes) 4 bytes. Overwrites a badge not read yet, like readCard """
+        self.readers[a_id].badges.append((time.monotonic(), sketch_uid(uid)))
+        self._pending[a_id] = uid
+
+    def on_data(self, data):
+        buffer = self._buffer
+        buffer += data
+        while buffer:
+            if buffer[0] == codec.SOF:
+                if len(buffer) < codec.HEADER_SIZE:
+                    return
+                size = codec.HEADER_SIZE + buffer[3] + codec.CRC_SIZE
+                if len(buffer) < size:
+                    return
+                frames = codec.FrameDecoder().feed(bytes(buffer[:size]))
+                del buffer[:size]
+                for frame in frames:
+                    order = codec.ORDER_NAMES.get(frame.opcode)
+                    self._request(frame.address, order, True)
+            else:
+                end = buffer.find(b";")
+                if end < 0:
+                    return
+                text = buffer[:end].decode(errors="replace")
+                del buffer[: end + 1]
+                address, _, order = text.partition(":")
+                if address.isdigit():
+                    self._request(int(address), order, False)
+
+    def _request(self, a_id, order, binary):
+        if a_id not in self.readers or binary and a_id not in self.binary:
+            return
+        now = time.monotonic()
+        if self.deaf and self._deaf_until.get(a_id, 0) > now:
+            return
+
+        if order == "ask_for_new":
+            uid = self._pending.pop(a_id, None)
+            if binary:
+                reply = codec.encode(a_id, codec.NEW_READ, uid or b"")
+            else:
+                reply = f"new_read:{sketch_uid(uid) if uid else 'none'};".encode()
+        elif order in ("lock", "unlock", "denied"):
+            self.readers[a_id].orders.append((now, order))
+            self._deaf_until[a_id] = now + self.DEAF_AFTER[order]
+            if binary:
+                confirmed = bytes((codec.ORDERS[order],))
+                reply = codec.encode(a_id, codec.CONFIRM, confirmed)
+            else:
+                reply = f"confirm:{order};".encode()
+        elif order == "proto_binary" and not binary and a_id in self.binary:
+            reply = b"confirm:proto_binary;"
+        elif binary:
+            reply = codec.encode(a_id, codec.UNKNOWN_ORDER)
+        else:
+            reply = f"{a_id}:unknown_order;".encode()
+
+        self.fleet.schedule(self.REPLY_DELAY, self.fleet.write, self.fd, reply)
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self._slave)
+
+
+class Fleet:
+    """
+    Simulated readers, all served by one thread
+
+    Writes and badges of traces are scheduled on the same thread, so readers
+    never need a thread of their own
+    """
+
+    def __init__(self):
+        self.usb = []
+        self.buses = []
+
+        self._selector = selectors.DefaultSelector()
+        # [(monotonic time, seq, func, args), ... ] heap of scheduled calls
+        self._timers = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+        self.loop_flag = threading.Event()
+        self._thread = threading.Thread(name="Simulator", target=self.loop, daemon=True)
+        self._thread.start()
+
+    def add_usb(self, a_id, confirm=True):
+        """ :return: SimulatedUSBReader, give its device to USBArduino """
+        reader = SimulatedUSBReader(self, a_id, confirm)
+        self.usb.append(reader)
+        self._selector.register(reader.fd, selectors.EVENT_READ, reader)
+        return reader
+
+    def add_rs485_bus(self, a_ids, binary=True, deaf=False):
+        """ :return: SimulatedRS485Bus, give its device to Max485.use_port() """
+        bus = SimulatedRS485Bus(self, a_ids, binary, deaf)
+        self.buses.append(bus)
+        self._selector.register(bus.fd, selectors.EVENT_READ, bus)
+        return bus
+
+    def boot(self):
+        """
+        USB readers say they are ready. Once their port is opened : opening
+        flushes what was written before
+        """
+        for reader in self.usb:
+            self.schedule(0, reader.boot)
+
+    def readers(self):
+        """ :return: [SimulatedReader, ... ] of all kinds """
+        readers = list(self.usb)
+        for bus in self.buses:
+            readers += bus.readers.values()
+        return readers
+
+    def badge(self, a_id, uid):
+        """ :uid: (str) sketch written uid, 8 hex digits for RS485 readers """
+        for reader in self.usb:
+            if reader.id == a_id:
+                reader.badge(uid)
+                return
+        for bus in self.buses:
+            if a_id in bus.readers:
+                bus.badge(a_id, bytes.fromhex(uid))
+                return
+        raise KeyError(f"No simulated reader {a_id}")
+
+    def play(self, trace):
+        """ Badge along trace [(seconds from now, a_id, uid), ... ], no wait """
+        for t, a_id, uid in trace:
+            self.schedule(t, self.badge, a_id, uid)
+
+    def write(self, fd, data):
+        try:
+            os.write(fd, data)
+        except OSError as e:
+            logging.error(f"Simulator : can't write to {fd} : {e}")
+
+    def schedule(self, delay, func, *args):
+        """ Call func(*args) in the fleet thread after delay seconds """
+        with self._lock:
+            heapq.heappush(
+                self._timers, (time.monotonic() + delay, next(self._seq), func, args)
+            )
+        os.write(self._wakeup_w, b"\0")
+
+    def loop(self):
+        while not self.loop_flag.is_set():
+            with self._lock:
+                timeout = None
+                if self._timers:
+                    timeout = max(0, self._timers[0][0] - time.monotonic())
+
+            for key, _ in self._selector.select(timeout):
+                if key.data is None:
+                    os.read(self._wakeup_r, 4096)
+                    continue
+                try:
+                    data = os.read(key.fd, 4096)
+                except OSError:
+                    # Nobody on the other side (yet)
+                    continue
+                key.data.on_data(data)
+
+            now = time.monotonic()
+            while True:
+                with self._lock:
+                    if not self._timers or self._timers[0][0] > now:
+                        break
+                    _, _, func, args = heapq.heappop(self._timers)
+                try:
+                    func(*args)
+                except Exception:
+                    logging.exception(f"Simulator : {func} failed")
+
+    def cpu_time(self):
+        """
+        :return: (float) CPU seconds the fleet thread took so far, to tell it
+            from the crawler's in benchmarks
+        """
+        return time.clock_gettime(time.pthread_getcpuclockid(self._thread.ident))
+
+    def stop(self):
+        self.loop_flag.set()
+        os.write(self._wakeup_w, b"\0")
+        self._thread.join()
+        for reader in self.usb:
+            reader.close()
+        for bus in self.buses:
+            bus.close()
+
+    def report(self):
+        """ :return: (dict) badges, orders and badge to order latencies (ms) """
+        latencies = []
+        for reader in self.readers():
+            latencies += reader.latencies()
+        latencies.sort()
+        report = {
+            "readers": len(self.readers()),
+            "badges": sum(len(r.badges) for r in self.readers()),
+            "orders": sum(len(r.orders) for r in self.readers()),
+        }
+        if latencies:
+            report["latency_ms"] = {
+                "p50": percentile(latencies, 50) * 1000,
+                "p95": percentile(latencies, 95) * 1000,
+                "p99": percentile(latencies, 99) * 1000,
+                "max": latencies[-1] * 1000,
+            }
+        return report
+
+
+def percentile(values, p):
+    """ :values: sorted list """
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def random_trace(a_ids, uids, rate, duration, rng=random):
+    """
+    Badges at random times (Poisson), on random readers, with random uids
+
+    :rate: (float) badges per second and per reader
+    :return: [(seconds, a_id, uid), ... ] sorted by time
+    """
+    trace = []
+    t = 0
+    total_rate = rate * len(a_ids)
+    while True:
+        t += rng.expovariate(total_rate)
+        if t > duration:
+            return trace
+        trace.append((t, rng.choice(a_ids), rng.choice(uids)))
+
+
+def load_trace(path):
+    """ :path: JSON lines of {"t": seconds, "a_id": int, "uid": str} """
+    trace = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                badge = json.loads(line)
+                trace.append((badge["t"], badge["a_id"], badge["uid"]))
+    return sorted(trace)
+
+
+def make_keys(count, a_ids, rng=random):
+    """
+    Add count keys to the DB, allowed on every a_id. Use on a copy of the DB
+
+    :return: [uid, ... ] as readers send them
+    """
+    from okm.utils import DbCursor
+
+    # Bytes from 0x10 : not zero padded by the sketch, uids are still 8 hex
+    # digits and RS485 readers can turn them back into bytes
+    uids = [
+        sketch_uid(bytes(rng.randrange(0x10, 0x100) for _ in range(4)))
+        for _ in range(count)
+    ]
+    with DbCursor() as c:
+        c.executemany(
+            "INSERT OR IGNORE INTO keys (key_id, name, surname) VALUES (?, ?, ?)",
+            [(uid, "Simulated", uid) for uid in uids],
+        )
+        c.executemany(
+            "INSERT OR IGNORE INTO perms (key_id, arduino_id) VALUES (?, ?)",
+            [(uid, a_id) for uid in uids for a_id in a_ids],
+        )
+    return uids
+
+
+def start(usb=0, rs485=0, binary=False, deaf=False, keys=20, rng=random):
+    """
+    Copy the DB, start a fleet and a crawler on it with the real transports
+
+    USB readers get ids from 1000, RS485 ones from 100
+
+    :return: (fleet, crawler, uids)
+    """
+    from okm.migrations import migrate
+
+    # The fleet writes stamps, so work on a copy of the DB
+    db_path = glob.DB_PATH
+    glob.DB_PATH = Path(tempfile.mkdtemp()) / "db.sqlite3"
+    shutil.copy(db_path, glob.DB_PATH)
+    migrate()
+
+    # Each USB reader takes 2 fds here, and 5 in pyserial
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    usb_ids = list(range(1000, 1000 + usb))
+    rs485_ids = list(range(100, 100 + rs485))
+    for a_id in usb_ids + rs485_ids:
+        glob.ARDUINOS_DESC[a_id] = f"Simulated {a_id}"
+    uids = make_keys(keys, usb_ids + rs485_ids, rng)
+
+    from okm.backend.arduino_crawler import ArduinoCrawler
+    from okm.backend.arduinos import RS485Arduino, USBArduino
+    from okm.backend.max485 import Max485
+    from okm.backend.perms import PermCache
+
+    PermCache().reload()
+
+    fleet = Fleet()
+    arduinos = []
+    if rs485_ids:
+        bus = fleet.add_rs485_bus(rs485_ids, binary=binary, deaf=deaf)
+        Max485.use_port(bus.device)
+        # Opened before USB ports : RS485Bus writes with pyserial, which
+        # select()s on its fd, and fds above 1024 can't be
+        Max485.serial_bus.open()
+        Max485.arbiter.binary = binary
+        arduinos += [RS485Arduino(a_id) for a_id in rs485_ids]
+    arduinos += [
+        USBArduino(a_id, device=fleet.add_usb(a_id).device) for a_id in usb_ids
+    ]
+
+    fleet.boot()
+    crawler = ArduinoCrawler(arduinos=arduinos)
+    return fleet, crawler, uids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--usb", type=int, default=10, help="USB readers")
+    parser.add_argument("--rs485", type=int, default=0, help="RS485 readers")
+    parser.add_argument("--binary", action="store_true", help="RS485 frames")
+    parser.add_argument("--deaf", action="store_true", help="RS485 delay()s")
+    parser.add_argument("--rate", type=float, default=0.2, help="Badges/s/reader")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds")
+    parser.add_argument("--trace", help="JSON lines trace instead of random")
+    parser.add_argument("--engine", choices=["threads", "asyncio"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--metrics", type=int, help="Serve metrics on this port")
+    args = parser.parse_args()
+
+    if args.engine:
+        glob.CRAWLER_ENGINE = args.engine
+    if args.metrics is not None:
+        from okm.backend import metrics
+
+        metrics.serve(args.metrics)
+    rng = random.Random(args.seed)
+
+    fleet, crawler, uids = start(args.usb, args.rs485, args.binary, args.deaf, rng=rng)
+    a_ids = [r.id for r in fleet.readers()]
+
+    # Let USB readers boot
+    time.sleep(0.5)
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = random_trace(a_ids, uids, args.rate, args.duration, rng)
+    fleet.play(trace)
+
+    # Last orders may take the confirm timeout
+    time.sleep((trace[-1][0] if trace else 0) + 3)
+    crawler.stop()
+    fleet.stop()
+
+    print(json.dumps(fleet.report(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
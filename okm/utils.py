@@ -20,19 +20,124 @@
 #
 
 import sqlite3
+import threading
+import time
 
-from okm.glob import DB_PATH
+import okm.glob as glob
+from okm.backend import metrics
+
+DB_SECONDS = metrics.Histogram(
+    "okm_db_seconds", "Outermost DbCursor blocks, commit included"
+)
+DB_COMMIT_SECONDS = metrics.Histogram("okm_db_commit_seconds", "DbCursor commits")
+DB_ROLLBACKS = metrics.Counter(
+    "okm_db_rollbacks_total", "DbCursor blocks rolled back on exception"
+)
+
+
+class Singleton(type):
+    _instances = {}
+
+    def __call__(cls, *args, **kwargs):
+        if cls not in cls._instances:
+            new_instance = super(Singleton, cls).__call__(*args, **kwargs)
+            new_instance._instances = cls._instances
+            cls._instances[cls] = new_instance
+        return cls._instances[cls]
+
+
+class DbConnections:
+    """
+    Keep one long-lived connection per thread
+
+    sqlite3 connections can't be shared between threads, but opening one for
+    each query is what costs the most on the SD card of the Pi. So each thread
+    opens its connection once, tuned for our workload, and reuses it
+    """
+
+    # Pragmas applied once per connection
+    PRAGMAS = (
+        # Readers (GUI) don't block the writer (crawler) and vice versa
+        "PRAGMA journal_mode=WAL",
+        # Safe with WAL, only the last transactions can be lost on power loss
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA mmap_size=67108864",
+        "PRAGMA temp_store=MEMORY",
+    )
+
+    # Number of prepared statements kept by each connection
+    STATEMENT_CACHE = 256
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self):
+        """ Return the connection of current thread, open it if needed """
+        conn = getattr(self._local, "conn", None)
+        # glob.DB_PATH may be pointed elsewhere (tests, demos) : follow it
+        if conn is not None and self._local.path != glob.DB_PATH:
+            self.close()
+            conn = None
+
+        if conn is None:
+            conn = sqlite3.connect(glob.DB_PATH, cached_statements=self.STATEMENT_CACHE)
+            conn.row_factory = sqlite3.Row
+            for pragma in self.PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            self._local.path = glob.DB_PATH
+            # Nesting level of DbCursor in this thread
+            self._local.depth = 0
+
+        return conn
+
+    def close(self):
+        """ Close the connection of current thread, if any """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+connections = DbConnections()
 
 
 class DbCursor:
+    """
+    Cursor on the connection of current thread
+
+    Commits on exit only if something was written, rollbacks on exception or
+    if the commit fails.
+    Nested DbCursor share the transaction of the outermost one
+    """
+
     def __enter__(self):
-        self.conn = sqlite3.connect(DB_PATH)
-        self.conn.row_factory = sqlite3.Row
+        self.conn = connections.get()
         # self.conn.set_trace_callback(print)
+        if connections._local.depth == 0:
+            self._start = time.perf_counter()
+        connections._local.depth += 1
         c = self.conn.cursor()
 
         return c
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.conn.commit()
-        self.conn.close()
+        connections._local.depth -= 1
+        if connections._local.depth != 0:
+            return
+        if self.conn.in_transaction:
+            if exc_type is None:
+                commit_start = time.perf_counter()
+                try:
+                    self.conn.commit()
+                except Exception:
+                    # Else next DbCursor of this thread would run in this
+                    # transaction, and commit it with its own writes
+                    self.conn.rollback()
+                    DB_ROLLBACKS.inc()
+                    raise
+                DB_COMMIT_SECONDS.observe(time.perf_counter() - commit_start)
+            else:
+                self.conn.rollback()
+                DB_ROLLBACKS.inc()
+        DB_SECONDS.observe(time.perf_counter() - self._start)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import shutil
+
+import pytest
+
+import okm.glob as glob
+from okm.migrations import migrate
+
+"""
+Fixtures shared by the tests
+"""
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """ :return: (Path) a migrated copy of the DB, that DbCursor now points to """
+    db_path = tmp_path / "db.sqlite3"
+    shutil.copy(glob.DB_PATH, db_path)
+    monkeypatch.setattr(glob, "DB_PATH", db_path)
+    migrate()
+    return db_path
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import random
+
+import pytest
+
+from okm.backend import codec
+
+"""
+Streaming decoders of okm.backend.codec, fed bytes cut anywhere
+
+Run from the repository root : python -m pytest
+"""
+
+
+def feed_chunks(decoder, stream, rng, max_size=20):
+    """ :return: [message, ... ] decoded from stream, cut in random chunks """
+    messages = []
+    stream = bytes(stream)
+    while stream:
+        size = rng.randint(1, max_size)
+        messages += decoder.feed(stream[:size])
+        stream = stream[size:]
+    return messages
+
+
+def random_frame(rng, opcode):
+    payload = bytes(rng.randrange(256) for _ in range(rng.randint(0, 16)))
+    return codec.Frame(rng.randrange(256), opcode, payload)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_frames_round_trip_in_random_chunks(seed):
+    rng = random.Random(seed)
+    frames = [random_frame(rng, i) for i in range(50)]
+    stream = b"".join(codec.encode(*frame) for frame in frames)
+
+    decoder = codec.FrameDecoder()
+    assert feed_chunks(decoder, stream, rng) == frames
+    assert decoder.errors == decoder.skipped == 0
+    assert len(decoder.buffer) == 0
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_frames_fuzz_garbage_and_corruption(seed):
+    rng = random.Random(seed)
+    stream = bytearray()
+    expected = []
+    for i in range(50):
+        if rng.random() < 0.2:
+            # Garbage, SOF included sometimes
+            stream += bytes(rng.randrange(256) for _ in range(rng.randint(1, 10)))
+        frame = random_frame(rng, i)
+        wire = bytearray(codec.encode(*frame))
+        if rng.random() < 0.1:
+            # Corrupt one byte after SOF : must not come out
+            wire[rng.randrange(1, len(wire))] ^= 1 << rng.randrange(8)
+        else:
+            expected.append(frame)
+        stream += wire
+
+    # A corrupted frame passing the CRC is possible (1/65536) but its opcode
+    # (= index) would show it out of place
+    assert feed_chunks(codec.FrameDecoder(), stream, rng) == expected
+
+
+def test_frame_with_bad_crc_is_dropped():
+    good = codec.encode(20, codec.NEW_READ, b"\xd7\x42\x59\x19")
+    bad = bytearray(good)
+    bad[-1] ^= 0xFF
+
+    decoder = codec.FrameDecoder()
+    assert decoder.feed(bad) == []
+    assert decoder.errors == 1
+    assert decoder.feed(good) == [codec.Frame(20, codec.NEW_READ, b"\xd7\x42\x59\x19")]
+
+
+def test_frame_found_after_garbage():
+    garbage = bytes((0x00, codec.SOF, 0xFF, codec.SOF, 0x01, 0x02))
+    frame = codec.encode(30, codec.CONFIRM, bytes((codec.UNLOCK,)))
+
+    decoder = codec.FrameDecoder()
+    assert decoder.feed(garbage + frame) == [
+        codec.Frame(30, codec.CONFIRM, bytes((codec.UNLOCK,)))
+    ]
+    assert decoder.skipped > 0
+
+
+def test_truncated_frame():
+    expected = codec.Frame(20, codec.NEW_READ, b"\x01\x02\x03\x04")
+    frame = codec.encode(*expected)
+    decoder = codec.FrameDecoder()
+
+    # Incomplete : kept, and needed() says how much is missing
+    assert decoder.feed(frame[:2]) == []
+    assert decoder.needed() == codec.HEADER_SIZE - 2
+    assert decoder.feed(frame[2:6]) == []
+    assert decoder.needed() == len(frame) - 6
+    assert decoder.feed(frame[6:]) == [expected]
+
+    # Cut short by the next frame : only the next one comes out
+    assert decoder.feed(frame[:6] + frame) == [expected]
+    assert decoder.errors == 1
+
+
+def test_frames_filled_in_place():
+    frames = [codec.Frame(i, codec.NEW_READ, bytes(range(i))) for i in range(17)]
+    stream = memoryview(b"".join(codec.encode(*frame) for frame in frames))
+    # A small buffer, so that it has to move or grow
+    decoder = codec.FrameDecoder(capacity=8)
+
+    def readinto(view):
+        nonlocal stream
+        size = min(len(view), len(stream))
+        view[:size] = stream[:size]
+        stream = stream[size:]
+        return size
+
+    decoded = []
+    while stream:
+        decoder.fill(readinto)
+        decoded += decoder.decode()
+    assert decoded == frames
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_text_round_trip_in_random_chunks(seed):
+    rng = random.Random(seed)
+    messages = [
+        rng.choice(["new_read:none", "confirm:unlock", f"new_read:{i:x}", "é:ü"])
+        for i in range(200)
+    ]
+    stream = "".join(f"{message};" for message in messages).encode()
+
+    decoded = feed_chunks(codec.TextDecoder(), stream, rng)
+    assert decoded == messages
+    assert all(isinstance(message, codec.TextMessage) for message in decoded)
+
+
+def test_text_message_parts():
+    decoder = codec.TextDecoder()
+    (message,) = decoder.feed(b" new_read:d7425919 \r\n;")
+    assert message == "new_read:d7425919"
+    assert (message.kind, message.value) == ("new_read", "d7425919")
+    (message,) = decoder.feed(b"ready;")
+    assert (message.kind, message.value) == ("ready", None)
+
+
+def test_text_truncated_and_garbled():
+    decoder = codec.TextDecoder(max_message=16)
+
+    assert decoder.feed(b"confirm:un") == []
+    assert decoder.feed(b"lock;new_") == ["confirm:unlock"]
+    assert len(decoder.buffer) == len(b"new_")
+
+    # A lost ';' : dropped once too long, then back in sync
+    assert decoder.feed(b"read:" + b"x" * 16) == []
+    assert decoder.errors == 1
+    assert decoder.feed(b"new_read:none;") == ["new_read:none"]
+
+    # Not UTF-8 : replaced, not raised
+    assert decoder.feed(b"new_read:\xff;") == ["new_read:�"]
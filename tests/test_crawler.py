@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import time
+
+import pytest
+
+import okm.glob as glob
+from okm import simulator
+
+"""
+Crawler against the simulator (okm.simulator) : a reader that never confirms
+must not hold up the others, and an idle crawler must not spin
+
+Run from the repository root : python -m pytest
+"""
+
+
+@pytest.fixture(scope="module")
+def fleet():
+    # start() points the DB to a copy and adds its readers : undone after
+    db_path, arduinos_desc = glob.DB_PATH, dict(glob.ARDUINOS_DESC)
+
+    # ArduinoCrawler is a Singleton : one crawler for the whole module
+    fleet, crawler, uids = simulator.start(usb=3)
+    # Let readers boot
+    time.sleep(0.5)
+    yield fleet, uids
+    crawler.stop()
+    fleet.stop()
+
+    glob.DB_PATH = db_path
+    glob.ARDUINOS_DESC.clear()
+    glob.ARDUINOS_DESC.update(arduinos_desc)
+
+
+def test_idle_crawler_sleeps(fleet):
+    start = time.process_time()
+    time.sleep(1)
+    cpu = time.process_time() - start
+    # Spinning took a whole core
+    assert cpu < 0.1
+
+
+def test_reader_unaffected_by_unconfirmed_order(fleet):
+    fleet, uids = fleet
+    reader_a, reader_b, _ = fleet.usb
+    reader_a.confirm = False
+
+    fleet.badge(reader_a.id, uids[0])
+    time.sleep(0.05)
+    fleet.badge(reader_b.id, uids[1])
+    time.sleep(0.5)
+
+    # A still waits for its confirm (2 s timeout), B got its order meanwhile
+    assert [order for _, order in reader_a.orders] == ["unlock"]
+    (latency,) = reader_b.latencies()
+    assert latency < 0.2
+
+    # A gets the fallback lock once its unlock timed out
+    time.sleep(2)
+    assert [order for _, order in reader_a.orders] == ["unlock", "lock"]
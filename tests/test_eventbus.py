@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import threading
+import time
+
+from okm.backend.eventbus import UNLOCKED, Event, EventBus
+
+"""
+Event bus (okm.backend.eventbus) : a slow subscriber neither stalls the
+publisher nor loses events
+
+Run from the repository root : python -m pytest
+"""
+
+
+def events(n):
+    return [Event(UNLOCKED, 10, f"k{i}", None) for i in range(n)]
+
+
+def test_stuck_subscriber_does_not_block_publisher():
+    bus = EventBus()
+    stuck = bus.subscribe("stuck", warn_size=10)
+    fast = bus.subscribe("fast")
+    sent = events(1000)
+
+    start = time.perf_counter()
+    for event in sent:
+        bus.publish(event)
+    assert time.perf_counter() - start < 0.5
+
+    assert fast.drain() == sent
+    assert stuck.drain() == sent
+    assert stuck.high_watermark == len(sent)
+
+
+def test_bursts_from_many_publishers_are_all_delivered():
+    bus = EventBus()
+    notified = threading.Event()
+    sub = bus.subscribe("gui", notify=notified.set)
+    sent = events(2000)
+
+    publishers = [
+        threading.Thread(target=lambda part: [bus.publish(e) for e in part], args=(p,))
+        for p in (sent[::4], sent[1::4], sent[2::4], sent[3::4])
+    ]
+    for publisher in publishers:
+        publisher.start()
+
+    received = []
+    while len(received) < len(sent):
+        event = sub.get(timeout=2)
+        assert event is not None
+        received.append(event)
+    for publisher in publishers:
+        publisher.join()
+
+    assert notified.is_set()
+    assert sorted(received, key=sent.index) == sent
+    assert len(sub) == 0
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import shutil
+import sqlite3
+
+import pytest
+
+import okm.glob as glob
+from okm.migrations import MIGRATIONS, migrate, query_plan, schema_version
+from okm.utils import DbCursor
+
+"""
+Schema migrations (okm.migrations) on temporary DBs
+
+Run from the repository root : python -m pytest
+"""
+
+
+def tables():
+    with DbCursor() as c:
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        return {row["name"] for row in c.fetchall()}
+
+
+def test_migrate_new_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(glob, "DB_PATH", tmp_path / "db.sqlite3")
+    assert schema_version() == 0
+
+    assert migrate() == len(MIGRATIONS)
+    assert {"keys", "perms", "stamps", "sessions", "keys_fts"} <= tables()
+    # Already up to date : nothing to apply
+    assert migrate() == len(MIGRATIONS)
+
+
+def test_migrate_shipped_db(tmp_path, monkeypatch):
+    db_path = tmp_path / "db.sqlite3"
+    shutil.copy(glob.DB_PATH, db_path)
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == 0
+        perms_by_column = conn.execute("SELECT * FROM perms").fetchall()
+        n_stamps = conn.execute("SELECT COUNT(*) FROM stamps").fetchone()[0]
+    monkeypatch.setattr(glob, "DB_PATH", db_path)
+
+    assert migrate() == len(MIGRATIONS)
+
+    with DbCursor() as c:
+        c.execute("SELECT key_id, arduino_id FROM perms")
+        perms = {tuple(row) for row in c.fetchall()}
+        c.execute("SELECT COUNT(*) FROM stamps")
+        assert c.fetchone()[0] == n_stamps
+    # One row per granted arduino, columns 10, 20, 30
+    expected = {
+        (row[0], arduino_id)
+        for row in perms_by_column
+        for arduino_id, granted in zip((10, 20, 30), row[1:])
+        if granted == 1
+    }
+    assert perms == expected
+
+
+@pytest.mark.parametrize(
+    "sql, params, index",
+    [
+        # Last stamp of a key on an arduino (Vue1, Vue2)
+        (
+            "SELECT * FROM stamps WHERE key_id = ? AND arduino_id = ?"
+            " ORDER BY timestamp DESC LIMIT 1",
+            ("1", 10),
+            "stamps_key_arduino_timestamp",
+        ),
+        ("SELECT * FROM stamps ORDER BY timestamp DESC", (), "stamps_timestamp"),
+    ],
+)
+def test_hot_queries_use_indexes(db, sql, params, index):
+    plan = query_plan(sql, params)
+    assert index in plan
+    # Sort not covered by the index
+    assert "TEMP B-TREE" not in plan
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import pytest
+
+from okm.backend.perms import PermCache
+from okm.utils import DbCursor, Singleton
+
+"""
+Permission cache (okm.backend.perms) against a copy of the DB
+
+Run from the repository root : python -m pytest
+"""
+
+
+@pytest.fixture
+def cache(db):
+    # A Singleton : a fresh one for each test, on its own DB copy
+    Singleton._instances.pop(PermCache, None)
+    yield PermCache()
+    Singleton._instances.pop(PermCache, None)
+
+
+def write_key(key_id, arduino_ids):
+    """ Write a key and its perms to DB, behind the cache """
+    with DbCursor() as c:
+        c.execute("INSERT OR IGNORE INTO keys (key_id) VALUES (?)", (key_id,))
+        c.execute("DELETE FROM perms WHERE key_id = ?", (key_id,))
+        c.executemany(
+            "INSERT INTO perms (key_id, arduino_id) VALUES (?, ?)",
+            [(key_id, arduino_id) for arduino_id in arduino_ids],
+        )
+
+
+def test_loaded_index_matches_db(cache):
+    write_key("t1", [10, 30])
+    assert cache.allowed_arduinos("t1") == {10, 30}
+    assert cache.verify() == set()
+    assert cache.stats()["keys"] == len(cache._read_db())
+
+
+def test_update_patches_index(cache):
+    write_key("t1", [10])
+    assert cache.allowed_arduinos("t1") == {10}
+
+    # As the GUI does : write DB, then patch the cache
+    write_key("t1", [20])
+    assert cache.verify() == {"t1"}
+    cache.update("t1", {20})
+    assert cache.verify() == set()
+    assert cache.allowed_arduinos("t1") == {20}
+    assert cache.stats()["misses"] == 0
+
+
+def test_miss_falls_back_to_db(cache):
+    cache.reload()
+    write_key("t2", [10, 20])
+
+    assert cache.allowed_arduinos("t2") == {10, 20}
+    assert cache.stats()["misses"] == 1
+    # Indexed since : next badge is a hit
+    assert cache.allowed_arduinos("t2") == {10, 20}
+    assert cache.stats()["misses"] == 1
+    assert cache.allowed_arduinos("unknown") is None
+    assert cache.stats()["misses"] == 2
+
+
+def test_reload_catches_up_with_db(cache):
+    write_key("t1", [10])
+    cache.reload()
+    write_key("t1", [])
+    assert cache.verify() == {"t1"}
+
+    cache.reload()
+    assert cache.verify() == set()
+    assert cache.allowed_arduinos("t1") == set()
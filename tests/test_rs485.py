@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+import time
+
+import pytest
+
+from okm import simulator
+from okm.backend.max485 import (
+    BusArbiter,
+    BusScheduler,
+    FakeGpio,
+    GpioDirection,
+    KernelDirection,
+    NoDirection,
+    RS485Bus,
+    make_direction,
+)
+
+"""
+RS485 bus : arbiter against a simulated bus (okm.simulator), scheduler, and
+direction control on a pty
+
+Run from the repository root : python -m pytest
+"""
+
+
+def arbiter_on(fleet, a_ids, binary):
+    """ :return: (SimulatedRS485Bus, started BusArbiter asking for frames) """
+    bus = fleet.add_rs485_bus(a_ids, binary=binary)
+    arbiter = BusArbiter(
+        RS485Bus(bus.device, 9600, timeout=0.25),
+        BusScheduler(0.05, 0.2, 30),
+        binary=True,
+    )
+    for a_id in a_ids:
+        arbiter.add(a_id)
+    arbiter.start()
+    return bus, arbiter
+
+
+def test_mixed_bus_stays_in_text():
+    fleet = simulator.Fleet()
+    bus, arbiter = arbiter_on(fleet, [1, 2], binary={1})
+    try:
+        # Reader 2 declines, then blinks 1.2 s
+        time.sleep(1.5)
+        assert not arbiter.talks_binary()
+        txn = arbiter.submit(2, "unlock", "confirm:unlock", timeout=2)
+        assert txn.wait()
+        assert bus.readers[2].orders[-1][1] == "unlock"
+    finally:
+        arbiter.stop()
+        fleet.stop()
+
+
+def test_binary_bus():
+    fleet = simulator.Fleet()
+    bus, arbiter = arbiter_on(fleet, [1, 2], binary=True)
+    try:
+        time.sleep(0.5)
+        assert arbiter.talks_binary()
+        txn = arbiter.submit(2, "unlock", "confirm:unlock", timeout=2)
+        assert txn.wait()
+        assert bus.readers[2].orders[-1][1] == "unlock"
+    finally:
+        arbiter.stop()
+        fleet.stop()
+
+
+def test_scheduler_slack_is_one_exchange():
+    bus = RS485Bus("/dev/null", 9600, timeout=0.25, turnaround=0.03)
+    scheduler = BusScheduler(0.2, 1.0, 30)
+    BusArbiter(bus, scheduler)
+    assert scheduler.slack == pytest.approx(0.28)
+
+    # Idle : polled early enough that a late poll still meets max_latency
+    scheduler.polled(1)
+    _, due = scheduler.next_due()
+    assert due - time.monotonic() == pytest.approx(0.72, abs=0.01)
+
+    # Given explicitly, it is kept
+    scheduler = BusScheduler(0.2, 1.0, 30, slack=0.1)
+    BusArbiter(bus, scheduler)
+    assert scheduler.slack == 0.1
+
+
+class RecordingGpio(FakeGpio):
+    """ FakeGpio logging pin changes in events, with the time they happen """
+
+    def __init__(self, events):
+        super().__init__()
+        self.events = events
+
+    def output(self, pin, value):
+        super().output(pin, value)
+        self.events.append((time.monotonic(), f"pin {pin}={value}"))
+
+
+def test_gpio_direction_spans_the_write():
+    master, slave = os.openpty()
+    # [(monotonic time, what happened), ... ]
+    events = []
+    direction = GpioDirection(RecordingGpio(events), 23, 4)
+    bus = RS485Bus(os.ttyname(slave), 9600, direction, timeout=0.05)
+
+    # Log what the bus does with the port too
+    ser = bus.open()
+    for method in ("write", "flush"):
+
+        def logged(*args, method=method, real=getattr(ser, method)):
+            events.append((time.monotonic(), method))
+            return real(*args)
+
+        setattr(ser, method, logged)
+
+    frame = b"20:ask_for_new;"
+    try:
+        # Nobody answers : timeout
+        assert bus.exchange(frame) == b""
+        assert os.read(master, 64) == frame
+    finally:
+        bus.close()
+        os.close(slave)
+        os.close(master)
+
+    # Send mode before the write, receive mode once the UART is drained
+    assert [what for _, what in events] == [
+        "pin 23=1",
+        "pin 4=1",
+        "write",
+        "flush",
+        "pin 23=0",
+        "pin 4=0",
+    ]
+    # The last character leaves the shift register after flush() returns
+    flushed, released = events[3][0], events[4][0]
+    assert released - flushed >= 10 / 9600
+
+
+def test_make_direction():
+    assert isinstance(make_direction("kernel", 23, 4), KernelDirection)
+    assert isinstance(make_direction("none", 23, 4), NoDirection)
+    # RPi.GPIO isn't there off the Pi : pins faked
+    direction = make_direction("gpio", 23, 4)
+    assert isinstance(direction, GpioDirection)
+    with pytest.raises(ValueError):
+        make_direction("rts", 23, 4)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import datetime
+
+import pytest
+
+from okm.backend.sessions import SessionPages
+from okm.utils import DbCursor
+
+"""
+Paged and sorted sessions (okm.backend.sessions) on a copy of the DB
+
+Run from the repository root : python -m pytest
+"""
+
+
+@pytest.fixture
+def sessions(db):
+    """ Sessions of keys with and without a name, some never locked """
+    keys = [
+        ("s1", "Zoé", "Martin"),
+        ("s2", None, None),
+        ("s3", "Adèle", None),
+    ]
+    start = datetime.datetime(2026, 1, 1)
+    rows = []
+    for i in range(50):
+        key_id = keys[i % len(keys)][0]
+        begin = start + datetime.timedelta(hours=i)
+        end = None if i % 7 == 0 else begin + datetime.timedelta(minutes=i % 5)
+        status = "error" if end is None else "closed"
+        rows.append((key_id, 10 * (1 + i % 3), begin, end, status))
+
+    with DbCursor() as c:
+        c.executemany("INSERT INTO keys (key_id, name, surname) VALUES (?, ?, ?)", keys)
+        c.executemany(
+            "INSERT INTO sessions (key_id, arduino_id, start, end, status)"
+            " VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+
+
+def all_rows(pages):
+    return [pages.row(n)["id"] for n in range(pages.count())]
+
+
+@pytest.mark.parametrize("sort", SessionPages.SORT_KEYS)
+@pytest.mark.parametrize("ascending", [True, False])
+def test_keyset_pages_match_offset(sessions, monkeypatch, sort, ascending):
+    pages = SessionPages(sort, ascending)
+    # One page : the order SQL gives, without keyset
+    monkeypatch.setattr(SessionPages, "PAGE_SIZE", 10000)
+    expected = all_rows(pages)
+
+    pages.reset()
+    monkeypatch.setattr(SessionPages, "PAGE_SIZE", 7)
+    assert all_rows(pages) == expected
+    assert len(set(expected)) == len(expected)
+
+
+def searched(text):
+    pages = SessionPages()
+    pages.set_search(text)
+    return {pages.row(n)["key_id"] for n in range(pages.count())}
+
+
+def test_search_by_name_accents_and_prefix(sessions):
+    assert searched("zoe") == {"s1"}
+    assert searched("ADE") == {"s3"}
+    assert searched("mart zo") == {"s1"}
+    assert searched("nobody") == set()
+
+
+def test_search_follows_keys(sessions):
+    with DbCursor() as c:
+        c.execute("UPDATE keys SET name = 'Camille' WHERE key_id = 's2'")
+    assert searched("camille") == {"s2"}
+
+    with DbCursor() as c:
+        c.execute("DELETE FROM sessions WHERE key_id = 's1'")
+        c.execute("DELETE FROM keys WHERE key_id = 's1'")
+    assert searched("zoe") == set()
+
+
+def test_search_survives_renumbered_keys(sessions):
+    # keys has no INTEGER PRIMARY KEY : its rowids aren't stable. Renumber them
+    # as a VACUUM may do, or as a DB editor rebuilding the table does
+    with DbCursor() as c:
+        c.execute("SELECT key_id FROM keys ORDER BY rowid LIMIT 1")
+        (first,) = c.fetchone()
+        c.execute("DELETE FROM keys WHERE key_id = ?", (first,))
+        c.execute("CREATE TABLE keys_copy AS SELECT * FROM keys ORDER BY key_id DESC")
+        c.execute("DROP TABLE keys")
+        c.execute("ALTER TABLE keys_copy RENAME TO keys")
+
+    assert searched("zoe") == {"s1"}
+    assert searched("adele") == {"s3"}
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import datetime
+import json
+import sqlite3
+
+import pytest
+
+import okm.glob as glob
+from okm.utils import DbCursor, Singleton
+
+"""
+Write-behind of stamps (okm.backend.stamps) on a copy of the DB
+
+Run from the repository root : python -m pytest
+"""
+
+
+@pytest.fixture
+def writer_factory(db, monkeypatch):
+    """ :return: callable() giving a new StampWriter, on a fresh DB copy """
+    from okm.backend.stamps import StampWriter
+
+    monkeypatch.setattr(glob, "STAMP_RETRY_DELAY", 0.05)
+    writers = []
+
+    def new_writer():
+        # A Singleton : forget the former one, as a restart would
+        Singleton._instances.pop(StampWriter, None)
+        writers.append(StampWriter())
+        return writers[-1]
+
+    yield new_writer
+    for writer in writers:
+        writer.stop()
+    Singleton._instances.pop(StampWriter, None)
+
+
+def stamps(key_id):
+    with DbCursor() as c:
+        c.execute(
+            "SELECT lock_state FROM stamps WHERE key_id = ? ORDER BY timestamp",
+            (key_id,),
+        )
+        return [line["lock_state"] for line in c.fetchall()]
+
+
+def test_submit_commits_and_empties_journal(writer_factory):
+    writer = writer_factory()
+    now = datetime.datetime.now()
+    writer.submit("k1", 10, now, "unlocked")
+    writer.submit("k1", 10, now + datetime.timedelta(seconds=1), "locked")
+    assert writer.flush(5)
+    assert stamps("k1") == ["unlocked", "locked"]
+    assert writer.path.stat().st_size == 0
+
+
+def test_replay_skips_committed_and_bad_stamps(writer_factory):
+    writer = writer_factory()
+    ts = datetime.datetime(2026, 1, 2, 3, 4, 5, 678901)
+    writer.submit("k1", 10, ts, "unlocked")
+    assert writer.flush(5)
+    writer.stop()
+
+    # A crash right after commit, a bad stamp and a half written line
+    lines = [
+        ["k1", 10, ts.isoformat(" "), "unlocked"],
+        ["k1", 10, [], "locked"],
+        ["k1", 10, (ts + datetime.timedelta(seconds=1)).isoformat(" "), "locked"],
+    ]
+    writer.path.write_text(
+        "".join(json.dumps(line) + "\n" for line in lines) + '["k2", 1'
+    )
+
+    writer = writer_factory()
+    assert writer.flush(5)
+    assert stamps("k1") == ["unlocked", "locked"]
+    rejected = writer.path.with_name(writer.path.name + ".rejected")
+    assert json.loads(rejected.read_text()) == lines[1]
+
+    # The writer survived
+    writer.submit("k3", 10, datetime.datetime.now(), "unlocked")
+    assert writer.flush(5)
+    assert stamps("k3") == ["unlocked"]
+
+
+def test_locked_db_retries(writer_factory):
+    writer = writer_factory()
+    other = sqlite3.connect(glob.DB_PATH, timeout=0)
+    other.execute("BEGIN EXCLUSIVE")
+    try:
+        writer.submit("k4", 10, datetime.datetime.now(), "unlocked")
+        assert not writer.flush(0.3)
+        assert writer.path.read_text()
+    finally:
+        other.rollback()
+        other.close()
+    assert writer.flush(10)
+    assert stamps("k4") == ["unlocked"]
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the Open Key Managment
+# A rfid key manager system based on raspberryPi and Arduino
+#
+# Copyright 2020 Aurélien Cibrario <aurelien.cibrario@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import sqlite3
+
+import pytest
+
+import okm.glob as glob
+from okm.utils import DbCursor, connections
+
+"""
+DbCursor (okm.utils) on the connection of the current thread
+
+Run from the repository root : python -m pytest
+"""
+
+
+@pytest.fixture
+def tables(tmp_path, monkeypatch):
+    """ A parent and a child table, whose foreign key is checked on commit """
+    monkeypatch.setattr(glob, "DB_PATH", tmp_path / "db.sqlite3")
+    with DbCursor() as c:
+        c.execute("PRAGMA foreign_keys = ON")
+        c.execute("CREATE TABLE parent (id INTEGER PRIMARY KEY)")
+        c.execute(
+            "CREATE TABLE child (parent_id INTEGER REFERENCES parent(id)"
+            " DEFERRABLE INITIALLY DEFERRED)"
+        )
+    yield
+    connections.close()
+
+
+def count(table):
+    with DbCursor() as c:
+        c.execute(f"SELECT COUNT(*) FROM {table}")
+        return c.fetchone()[0]
+
+
+def test_nested_cursors_share_transaction(tables):
+    with DbCursor() as c:
+        c.execute("INSERT INTO parent VALUES (1)")
+        with DbCursor() as nested:
+            nested.execute("INSERT INTO child VALUES (1)")
+        assert connections.get().in_transaction
+    assert not connections.get().in_transaction
+    assert count("child") == 1
+
+
+def test_exception_rolls_back(tables):
+    with pytest.raises(ZeroDivisionError):
+        with DbCursor() as c:
+            c.execute("INSERT INTO parent VALUES (1)")
+            1 / 0
+    assert count("parent") == 0
+
+
+def test_failed_commit_rolls_back(tables):
+    with pytest.raises(sqlite3.IntegrityError):
+        with DbCursor() as c:
+            c.execute("INSERT INTO parent VALUES (1)")
+            # Only checked on commit, which then fails
+            c.execute("INSERT INTO child VALUES (2)")
+    assert not connections.get().in_transaction
+
+    # Next block of this thread doesn't commit the failed writes with its own
+    with DbCursor() as c:
+        c.execute("INSERT INTO parent VALUES (2)")
+    assert count("parent") == 1
+    assert count("child") == 0